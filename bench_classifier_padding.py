@@ -0,0 +1,142 @@
+"""Benchmark fixed vs length-bucketed padding for classification inputs.
+
+Runs forward passes of a randomly initialized XLNet on synthetic sentences
+whose lengths follow a GLUE-like (log-normal) distribution, and reports the
+real (non-padding) tokens processed per second.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+from absl import flags
+import absl.logging as _logging  # pylint: disable=unused-import
+
+import numpy as np
+
+import tensorflow as tf
+
+import xlnet
+from classifier_utils import bucket_by_length, parse_length_buckets
+from classifier_utils import SEG_ID_A, SEG_ID_CLS, SEG_ID_PAD
+from data_utils import SEP_ID, CLS_ID
+
+# Model config (same meaning as in train.py)
+flags.DEFINE_integer("n_layer", default=6, help="Number of layers.")
+flags.DEFINE_integer("d_model", default=512, help="Dimension of the model.")
+flags.DEFINE_integer("n_head", default=8, help="Number of attention heads.")
+flags.DEFINE_integer("d_head", default=64, help="Dimension of each head.")
+flags.DEFINE_integer("d_inner", default=2048,
+      help="Dimension of inner hidden size in positionwise feed-forward.")
+flags.DEFINE_string("ff_activation", default="gelu",
+      help="Activation type used in position-wise feed-forward.")
+flags.DEFINE_bool("untie_r", default=True, help="Untie r_w_bias and r_r_bias")
+flags.DEFINE_integer("n_token", default=32000, help="Vocab size")
+
+# Data config
+flags.DEFINE_integer("num_examples", default=4096,
+      help="Number of synthetic examples.")
+flags.DEFINE_float("mean_len", default=25.,
+      help="Mean length in tokens of the synthetic sentences, "
+      "about 25 for SST-2 and 40 for MNLI pairs.")
+flags.DEFINE_integer("max_seq_length", default=128, help="Max sequence length")
+flags.DEFINE_integer("batch_size", default=32,
+      help="Batch size of the fixed padding.")
+flags.DEFINE_string("length_buckets", default="16,32,64",
+      help="Bucket lengths, see run_classifier.py.")
+flags.DEFINE_integer("bucket_tokens", default=None,
+      help="Tokens per bucketed batch. Defaults to batch_size * "
+      "max_seq_length.")
+
+FLAGS = flags.FLAGS
+
+
+def _synthetic_features():
+  """Left-padded features of the synthetic sentences."""
+  rng = np.random.RandomState(0)
+  sigma = 0.6
+  lens = rng.lognormal(np.log(FLAGS.mean_len) - sigma ** 2 / 2, sigma,
+                       size=FLAGS.num_examples)
+  lens = np.clip(lens.astype(np.int64), 1, FLAGS.max_seq_length - 2) + 2
+
+  shape = [FLAGS.num_examples, FLAGS.max_seq_length]
+  input_ids = np.zeros(shape, dtype=np.int32)
+  input_mask = np.ones(shape, dtype=np.float32)
+  segment_ids = np.full(shape, SEG_ID_PAD, dtype=np.int32)
+  for i, seq_len in enumerate(lens):
+    input_ids[i, -seq_len:] = rng.randint(10, FLAGS.n_token, size=seq_len)
+    input_ids[i, -2:] = [SEP_ID, CLS_ID]
+    input_mask[i, -seq_len:] = 0
+    segment_ids[i, -seq_len:-1] = SEG_ID_A
+    segment_ids[i, -1] = SEG_ID_CLS
+
+  return {
+      "input_ids": input_ids,
+      "input_mask": input_mask,
+      "segment_ids": segment_ids,
+      "seq_len": lens.astype(np.int32),
+  }
+
+
+def _bench(name, make_dataset, num_tokens):
+  """Time one pass of the model over `make_dataset()`."""
+  with tf.Graph().as_default():
+    features = make_dataset().make_one_shot_iterator().get_next()
+    xlnet_config = xlnet.XLNetConfig(FLAGS=FLAGS)
+    run_config = xlnet.RunConfig(is_training=False, use_tpu=False,
+                                 use_bfloat16=False, dropout=0., dropatt=0.)
+    model = xlnet.XLNetModel(
+        xlnet_config=xlnet_config,
+        run_config=run_config,
+        input_ids=tf.transpose(features["input_ids"], [1, 0]),
+        seg_ids=tf.transpose(features["segment_ids"], [1, 0]),
+        input_mask=tf.transpose(features["input_mask"], [1, 0]))
+    summary = model.get_pooled_out("last")
+
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      num_batches, padded_tokens = 0, 0
+      start_time = time.time()
+      while True:
+        try:
+          ids, _ = sess.run([features["input_ids"], summary])
+        except tf.errors.OutOfRangeError:
+          break
+        num_batches += 1
+        padded_tokens += ids.size
+      elapsed = time.time() - start_time
+
+  tf.logging.info(
+      "[%s] %d batches, %.1f%% padding | %.0f tokens/sec, "
+      "%.1f examples/sec", name, num_batches,
+      100. * (1 - float(num_tokens) / padded_tokens),
+      num_tokens / elapsed, FLAGS.num_examples / elapsed)
+  return elapsed
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  features = _synthetic_features()
+  num_tokens = int(features["seq_len"].sum())
+  buckets = parse_length_buckets(FLAGS.length_buckets, FLAGS.max_seq_length)
+  bucket_tokens = (FLAGS.bucket_tokens or
+                   FLAGS.batch_size * FLAGS.max_seq_length)
+
+  def fixed_dataset():
+    d = tf.data.Dataset.from_tensor_slices(features)
+    return d.batch(FLAGS.batch_size)
+
+  def bucketed_dataset():
+    d = tf.data.Dataset.from_tensor_slices(features)
+    return bucket_by_length(d, buckets, bucket_tokens, drop_remainder=False)
+
+  fixed_time = _bench("fixed", fixed_dataset, num_tokens)
+  bucketed_time = _bench("bucketed", bucketed_dataset, num_tokens)
+  tf.logging.info("Speedup of length bucketing: %.2fx",
+                  fixed_time / bucketed_time)
+
+
+if __name__ == "__main__":
+  tf.app.run()
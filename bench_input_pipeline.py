@@ -0,0 +1,233 @@
+"""Benchmark the pretraining input pipeline of `data_utils.get_input_fn`."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+import time
+
+from absl import flags
+import absl.logging as _logging  # pylint: disable=unused-import
+
+import numpy as np
+
+import tensorflow as tf
+
+import data_utils
+
+# Data config (same meaning as in train.py)
+flags.DEFINE_string("record_info_dir", default=None,
+      help="Path to local directory containing the record infos.")
+flags.DEFINE_integer("num_passes", default=1,
+      help="Number of passed used for training.")
+flags.DEFINE_integer("train_batch_size", default=16,
+      help="Size of the batch per host.")
+flags.DEFINE_integer("num_core_per_host", default=1,
+      help="Number of cores per host.")
+flags.DEFINE_integer("seq_len", default=0,
+      help="Sequence length for pretraining.")
+flags.DEFINE_integer("reuse_len", default=0,
+      help="How many tokens to be reused in the next batch.")
+flags.DEFINE_bool("uncased", False,
+      help="Use uncased inputs or not.")
+flags.DEFINE_integer("perm_size", 0,
+      help="Window size of permutation.")
+flags.DEFINE_bool("bi_data", default=True,
+      help="Use bidirectional data streams, i.e., forward & backward.")
+flags.DEFINE_integer("mask_alpha", default=6,
+      help="How many tokens to form a group.")
+flags.DEFINE_integer("mask_beta", default=1,
+      help="How many tokens to mask within each group.")
+flags.DEFINE_integer("num_predict", default=None,
+      help="Number of tokens to predict in partial prediction.")
+flags.DEFINE_enum("record_format", "int64", ["int64", "compact"],
+      help="Layout of the tfrecords, see `record_format` in corpus_info.json.")
+flags.DEFINE_bool("compact_masks", default=False,
+      help="Feed the permutation ranks and target positions instead of the "
+      "dense `perm_mask` and `target_mapping`, which are then built inside "
+      "the model.")
+flags.DEFINE_enum("record_cache", "memory", ["memory", "none", "disk",
+                                             "bounded"],
+      help="How to cache the raw records: all in memory, not at all, in a "
+      "file per host under `record_cache_dir`, or in memory "
+      "up to `record_cache_mb`, streaming the files that do not fit.")
+flags.DEFINE_string("record_cache_dir", default=None,
+      help="Scratch dir for the `disk` record cache.")
+flags.DEFINE_integer("record_cache_mb", default=None,
+      help="Size limit in MB of the `bounded` record cache.")
+
+# Benchmark config
+flags.DEFINE_integer("num_parallel_calls", default=-1,
+      help="`num_parallel_calls` of the batched pipeline (-1 for autotune).")
+flags.DEFINE_string("prefetch_to_device", default=None,
+      help="Device to prefetch batches onto in the batched pipeline.")
+flags.DEFINE_integer("warmup_steps", default=10,
+      help="Number of batches to skip before timing.")
+flags.DEFINE_integer("bench_steps", default=100,
+      help="Number of timed batches per stage.")
+flags.DEFINE_bool("bench_record_formats", default=False,
+      help="Instead of the pipeline, compare the size on disk and the parse "
+      "throughput of the `int64` and `compact` record formats on a synthetic "
+      "corpus. Only needs `seq_len`, `reuse_len` and `train_batch_size`.")
+flags.DEFINE_integer("format_bench_records", default=4096,
+      help="Number of synthetic records per format.")
+
+FLAGS = flags.FLAGS
+
+
+def _get_input_fn(num_parallel_calls, prefetch_to_device=None):
+  return data_utils.get_input_fn(
+      tfrecord_dir=FLAGS.record_info_dir,
+      split="train",
+      bsz_per_host=FLAGS.train_batch_size,
+      seq_len=FLAGS.seq_len,
+      reuse_len=FLAGS.reuse_len,
+      bi_data=FLAGS.bi_data,
+      num_hosts=1,
+      num_core_per_host=FLAGS.num_core_per_host,
+      perm_size=FLAGS.perm_size,
+      mask_alpha=FLAGS.mask_alpha,
+      mask_beta=FLAGS.mask_beta,
+      uncased=FLAGS.uncased,
+      num_passes=FLAGS.num_passes,
+      num_predict=FLAGS.num_predict,
+      record_format=FLAGS.record_format,
+      num_parallel_calls=num_parallel_calls,
+      prefetch_to_device=prefetch_to_device,
+      compact_masks=FLAGS.compact_masks,
+      record_cache=FLAGS.record_cache,
+      record_cache_dir=FLAGS.record_cache_dir,
+      record_cache_mb=FLAGS.record_cache_mb)
+
+
+def _bench_dataset(name, dataset, bsz_per_core):
+  """Time `FLAGS.bench_steps` batches of `dataset`."""
+  with tf.Graph().as_default():
+    next_batch = dataset().make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      for _ in range(FLAGS.warmup_steps):
+        sess.run(next_batch)
+
+      latencies = []
+      for _ in range(FLAGS.bench_steps):
+        start_time = time.time()
+        sess.run(next_batch)
+        latencies.append(time.time() - start_time)
+
+  latencies = np.array(latencies) * 1000.
+  examples_per_sec = bsz_per_core * FLAGS.bench_steps / (
+      latencies.sum() / 1000.)
+  tf.logging.info(
+      "[%s] %.1f examples/sec | ms/batch: mean %.2f, p50 %.2f, p90 %.2f, "
+      "max %.2f", name, examples_per_sec, latencies.mean(),
+      np.percentile(latencies, 50), np.percentile(latencies, 90),
+      latencies.max())
+
+  return latencies.mean()
+
+
+def _synthetic_example(rng, seq_len, reuse_len, mask_rate):
+  """A random example laid out as in `data_utils.create_tfrecords`."""
+  # Zipf-distributed ids, as the token ids of natural text
+  row = np.minimum(rng.zipf(1.2, size=seq_len), data_utils.VOCAB_SIZE - 1)
+  tot_len = seq_len - reuse_len - 3
+  a_end = reuse_len + rng.randint(1, tot_len)
+  b_len = seq_len - a_end - 3
+  # segment B followed by its true next token
+  b_data = row[a_end + 1: a_end + b_len + 2]
+
+  cat_data = np.concatenate([row[:a_end], [data_utils.SEP_ID], b_data[:-1],
+                             [data_utils.SEP_ID, data_utils.CLS_ID]])
+  seg_id = [0] * (a_end + 1) + [1] * (b_len + 1) + [2]
+  tgt = np.concatenate([row[1: a_end + 1], b_data,
+                        [data_utils.CLS_ID, data_utils.CLS_ID]])
+  is_masked = (rng.rand(seq_len) < mask_rate).astype(np.int64)
+
+  return cat_data, tgt, seg_id, is_masked, rng.randint(2)
+
+
+def _bench_record_formats(bsz_per_core):
+  """Write the same synthetic corpus in both record formats, and compare
+  their size on disk and their (batched) parse throughput."""
+  seq_len = FLAGS.seq_len
+  mask_rate = (FLAGS.num_predict or 0.15 * seq_len) / seq_len
+  bench_dir = tempfile.mkdtemp()
+
+  num_bytes = {}
+  parse_ms = {}
+  for record_format in ["int64", "compact"]:
+    path = os.path.join(bench_dir, "{}.tfrecords".format(record_format))
+    rng = np.random.RandomState(0)
+    with tf.python_io.TFRecordWriter(path) as writer:
+      for _ in range(FLAGS.format_bench_records):
+        feature = data_utils._record_feature(
+            record_format,
+            *_synthetic_example(rng, seq_len, FLAGS.reuse_len, mask_rate))
+        example = tf.train.Example(
+            features=tf.train.Features(feature=feature))
+        writer.write(example.SerializeToString())
+    num_bytes[record_format] = tf.gfile.Stat(path).length
+
+    def parse_dataset(path=path, record_format=record_format):
+      # records in memory: time the parsing, not the disk
+      dataset = tf.data.TFRecordDataset(path).cache().repeat()
+      dataset = dataset.batch(bsz_per_core, drop_remainder=True)
+      return dataset.map(lambda records: data_utils._parse_records(
+          records, seq_len, record_format, bsz_per_core)[1:])
+
+    parse_ms[record_format] = _bench_dataset(
+        "{} parse".format(record_format), parse_dataset, bsz_per_core)
+
+  tf.gfile.DeleteRecursively(bench_dir)
+
+  for record_format in ["int64", "compact"]:
+    tf.logging.info(
+        "[%s] %.2f MB, %.0f bytes/record, %.0f parsed records/sec",
+        record_format, num_bytes[record_format] / 2 ** 20,
+        num_bytes[record_format] / FLAGS.format_bench_records,
+        bsz_per_core * 1000. / parse_ms[record_format])
+  tf.logging.info("compact vs int64: %.2fx smaller, %.2fx parse throughput",
+                  num_bytes["int64"] / num_bytes["compact"],
+                  parse_ms["int64"] / parse_ms["compact"])
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  bsz_per_core = FLAGS.train_batch_size // FLAGS.num_core_per_host
+  if FLAGS.bench_record_formats:
+    _bench_record_formats(bsz_per_core)
+    return
+
+  params = {"batch_size": bsz_per_core}
+
+  _, record_info = _get_input_fn(None)
+  file_names = record_info["filenames"]
+
+  def read_dataset():
+    dataset = tf.data.TFRecordDataset(file_names).repeat()
+    return dataset.batch(bsz_per_core, drop_remainder=True)
+
+  def per_record_dataset():
+    input_fn, _ = _get_input_fn(None)
+    return input_fn(params)
+
+  def batched_dataset():
+    input_fn, _ = _get_input_fn(FLAGS.num_parallel_calls,
+                                FLAGS.prefetch_to_device)
+    return input_fn(params)
+
+  read_ms = _bench_dataset("read", read_dataset, bsz_per_core)
+  per_record_ms = _bench_dataset("per-record parse", per_record_dataset,
+                                 bsz_per_core)
+  batched_ms = _bench_dataset("batched parse", batched_dataset, bsz_per_core)
+
+  tf.logging.info("Parse + permutation latency per batch: per-record %.2f ms, "
+                  "batched %.2f ms (speedup %.2fx)",
+                  per_record_ms - read_ms, batched_ms - read_ms,
+                  per_record_ms / max(batched_ms, 1e-6))
+
+
+if __name__ == "__main__":
+  tf.app.run()
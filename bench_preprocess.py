@@ -0,0 +1,93 @@
+"""Benchmark `prepro_utils.preprocess_text` at its call sites in the repo."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import time
+import unicodedata
+
+from absl import app
+from absl import flags
+
+from prepro_utils import preprocess_text
+
+flags.DEFINE_string("input_glob", "data/example/*.txt",
+      help="Text files to benchmark on, one text per line.")
+flags.DEFINE_integer("max_lines", default=100000,
+      help="Maximum number of lines to read.")
+flags.DEFINE_bool("uncased", False,
+      help="Use uncased inputs or not.")
+flags.DEFINE_integer("repeat", default=3,
+      help="Number of timed runs per call site, the best one is reported.")
+
+FLAGS = flags.FLAGS
+
+
+def reference_preprocess_text(inputs, lower=False, remove_space=True,
+                              keep_accents=False):
+  """`preprocess_text` without the ASCII fast path and the per-character
+  normalization cache."""
+  if remove_space:
+    outputs = ' '.join(inputs.strip().split())
+  else:
+    outputs = inputs
+  outputs = outputs.replace("``", '"').replace("''", '"')
+
+  if not keep_accents:
+    outputs = unicodedata.normalize('NFKD', outputs)
+    outputs = ''.join([c for c in outputs if not unicodedata.combining(c)])
+  if lower:
+    outputs = outputs.lower()
+
+  return outputs
+
+
+def _line_site(func, lines):
+  """data_utils, run_classifier, run_race: one call per text."""
+  lower = FLAGS.uncased
+  return [func(line, lower=lower) for line in lines]
+
+
+def _char_site(func, lines):
+  """run_squad: one call per paragraph character when aligning tokens."""
+  lower = FLAGS.uncased
+  return [func(c, lower=lower, remove_space=False)
+          for line in lines for c in line]
+
+
+def _chars_per_sec(site, func, lines, num_chars):
+  best = None
+  for _ in range(FLAGS.repeat):
+    start_time = time.time()
+    site(func, lines)
+    elapsed = time.time() - start_time
+    best = elapsed if best is None else min(best, elapsed)
+  return num_chars / max(best, 1e-9)
+
+
+def main(_):
+  lines = []
+  for path in sorted(glob.glob(FLAGS.input_glob)):
+    with open(path, "rb") as fp:
+      for line in fp:
+        line = line.decode("utf-8").strip()
+        if line:
+          lines.append(line)
+  lines = lines[:FLAGS.max_lines]
+  num_chars = sum(len(line) for line in lines)
+  num_ascii = sum(1 for line in lines for c in line if ord(c) < 128)
+  print("{} lines, {} chars ({:.1f}% ASCII)".format(
+      len(lines), num_chars, 100. * num_ascii / max(num_chars, 1)))
+
+  for name, site in [("per text", _line_site), ("per char", _char_site)]:
+    assert site(preprocess_text, lines) == site(reference_preprocess_text,
+                                                lines)
+    before = _chars_per_sec(site, reference_preprocess_text, lines, num_chars)
+    after = _chars_per_sec(site, preprocess_text, lines, num_chars)
+    print("[{}] before {:.0f} chars/sec, after {:.0f} chars/sec "
+          "(speedup {:.2f}x)".format(name, before, after, after / before))
+
+
+if __name__ == "__main__":
+  app.run(main)
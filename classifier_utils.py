@@ -41,6 +41,153 @@ class InputFeatures(object):
     self.is_real_example = is_real_example
 
 
+def classification_metric_fn(per_example_loss, label_ids, logits,
+                             is_real_example):
+  """Eval metrics of classification, fake examples have a weight of 0."""
+  predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
+  eval_input_dict = {
+      'labels': label_ids,
+      'predictions': predictions,
+      'weights': is_real_example
+  }
+  accuracy = tf.metrics.accuracy(**eval_input_dict)
+
+  loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
+  return {
+      'eval_accuracy': accuracy,
+      'eval_loss': loss}
+
+
+def regression_metric_fn(per_example_loss, label_ids, logits,
+                         is_real_example):
+  """Eval metrics of regression, fake examples have a weight of 0."""
+  loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
+  pearsonr = tf.contrib.metrics.streaming_pearson_correlation(
+      logits, label_ids, weights=is_real_example)
+  return {'eval_loss': loss, 'eval_pearsonr': pearsonr}
+
+
+def parse_length_buckets(length_buckets, max_seq_length):
+  """Parse a comma separated list of bucket lengths, `max_seq_length` is
+  always the last bucket."""
+  buckets = sorted(set(int(x) for x in length_buckets.split(",") if x.strip()))
+  buckets = [x for x in buckets if 0 < x < max_seq_length]
+  return buckets + [max_seq_length]
+
+
+def bucket_by_length(dataset, buckets, bucket_tokens, drop_remainder,
+                     seq_features=("input_ids", "input_mask", "segment_ids")):
+  """Batch examples of similar lengths together.
+
+  `dataset` yields examples left-padded to `buckets[-1]` tokens, whose
+  number of real tokens is the number of zeros in `input_mask`. Each example
+  goes to the smallest bucket that holds it. A bucket of length `l` is
+  batched by `max(1, bucket_tokens // l)` examples, and the padding beyond
+  `l` is cropped, so batches are in shape [bsz, l].
+  """
+  bucket_lens = tf.constant(buckets, dtype=tf.int64)
+  batch_sizes = tf.constant([max(1, bucket_tokens // x) for x in buckets],
+                            dtype=tf.int64)
+
+  def key_func(example):
+    seq_len = tf.reduce_sum(tf.cast(tf.equal(example["input_mask"], 0),
+                                    tf.int64))
+    return tf.reduce_sum(tf.cast(seq_len > bucket_lens, tf.int64))
+
+  def window_size_func(key):
+    return batch_sizes[key]
+
+  def reduce_func(key, window):
+    crop_len = tf.cast(bucket_lens[key], tf.int32)
+
+    def crop(example):
+      for name in seq_features:
+        example[name] = example[name][:, -crop_len:]
+      return example
+
+    window = window.batch(window_size_func(key), drop_remainder=drop_remainder)
+    return window.map(crop)
+
+  return dataset.apply(tf.contrib.data.group_by_window(
+      key_func, reduce_func, window_size_func=window_size_func))
+
+
+class PackedInputFeatures(object):
+  """Several InputFeatures packed into one sequence.
+
+  `pack_ids` gives the slot of the example each token belongs to, -1 for
+  padding. The other per-example fields have one entry per slot, with
+  `is_real_example=0` for the unused slots.
+  """
+
+  def __init__(self,
+               input_ids,
+               input_mask,
+               segment_ids,
+               pack_ids,
+               cls_index,
+               label_ids,
+               is_real_example):
+    self.input_ids = input_ids
+    self.input_mask = input_mask
+    self.segment_ids = segment_ids
+    self.pack_ids = pack_ids
+    self.cls_index = cls_index
+    self.label_ids = label_ids
+    self.is_real_example = is_real_example
+
+
+def pack_features(features, max_seq_length, max_pack):
+  """Greedily pack consecutive InputFeatures into PackedInputFeatures of
+  `max_seq_length` tokens and at most `max_pack` examples.
+
+  Fake (padding) features are dropped, their slots are left unused.
+  """
+  packs = []
+  cur = []
+  cur_len = 0
+
+  def flush():
+    input_ids, segment_ids, pack_ids = [], [], []
+    cls_index, label_ids, is_real_example = [], [], []
+    delta_len = max_seq_length - cur_len
+    for slot, (feature, length) in enumerate(cur):
+      input_ids.extend(feature.input_ids[-length:])
+      segment_ids.extend(feature.segment_ids[-length:])
+      pack_ids.extend([slot] * length)
+      # the last token of each example is its CLS
+      cls_index.append(delta_len + len(input_ids) - 1)
+      label_ids.append(feature.label_id)
+      is_real_example.append(1)
+    for _ in range(max_pack - len(cur)):
+      cls_index.append(max_seq_length - 1)
+      label_ids.append(0)
+      is_real_example.append(0)
+
+    packs.append(PackedInputFeatures(
+        input_ids=[0] * delta_len + input_ids,
+        input_mask=[1] * delta_len + [0] * len(input_ids),
+        segment_ids=[SEG_ID_PAD] * delta_len + segment_ids,
+        pack_ids=[-1] * delta_len + pack_ids,
+        cls_index=cls_index,
+        label_ids=label_ids,
+        is_real_example=is_real_example))
+
+  for feature in features:
+    if not feature.is_real_example:
+      continue
+    length = len(feature.input_mask) - int(sum(feature.input_mask))
+    if cur and (cur_len + length > max_seq_length or len(cur) == max_pack):
+      flush()
+      cur, cur_len = [], 0
+    cur.append((feature, length))
+    cur_len += length
+  if cur:
+    flush()
+
+  return packs
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
   """Truncates a sequence pair in place to the maximum length."""
 
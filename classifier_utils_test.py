@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+import classifier_utils
+
+
+_Example = collections.namedtuple("_Example",
+                                  ["guid", "text_a", "text_b", "label"])
+
+
+class TailBatchMetricsTest(tf.test.TestCase):
+  """Eval metrics are the same whether the eval set is padded with
+  `PaddingInputExample`s to full batches (TPUs) or its last batch is only
+  partial (`drop_remainder=False` on other backends)."""
+
+  max_seq_length = 16
+  batch_size = 4
+  label_list = ["0", "1", "2"]
+
+  def setUp(self):
+    super(TailBatchMetricsTest, self).setUp()
+    # classifier_utils is written against the TF 1.x API
+    self._tf = classifier_utils.tf
+    classifier_utils.tf = tf.compat.v1
+
+    rng = np.random.RandomState(0)
+    self.examples = []
+    for i in range(10):
+      words = ["w{}".format(w) for w in rng.randint(0, 50, size=5)]
+      self.examples.append(_Example(
+          guid=i, text_a=" ".join(words[:3]), text_b=" ".join(words[3:]),
+          label=self.label_list[rng.randint(len(self.label_list))]))
+    # stands for the model: logits from a fixed projection of the inputs
+    self.proj = rng.randn(100, len(self.label_list))
+
+  def tearDown(self):
+    classifier_utils.tf = self._tf
+    super(TailBatchMetricsTest, self).tearDown()
+
+  def _tokenize(self, text):
+    return [10 + int(word[1:]) for word in text.split()]
+
+  def _batches(self, examples):
+    features = [classifier_utils.convert_single_example(
+        i, example, self.label_list, self.max_seq_length, self._tokenize)
+                for i, example in enumerate(examples)]
+    for start in range(0, len(features), self.batch_size):
+      batch = features[start:start + self.batch_size]
+      input_ids = np.array([f.input_ids for f in batch])
+      logits = self.proj[input_ids].sum(axis=1)
+      label_ids = np.array([f.label_id for f in batch], dtype=np.int32)
+      log_probs = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+      per_example_loss = -log_probs[np.arange(len(batch)), label_ids]
+      is_real_example = np.array([f.is_real_example for f in batch],
+                                 dtype=np.float32)
+      yield per_example_loss, label_ids, logits, is_real_example
+
+  def _evaluate(self, examples):
+    with tf.Graph().as_default():
+      per_example_loss = tf.compat.v1.placeholder(tf.float32, [None])
+      label_ids = tf.compat.v1.placeholder(tf.int32, [None])
+      logits = tf.compat.v1.placeholder(tf.float32,
+                                        [None, len(self.label_list)])
+      is_real_example = tf.compat.v1.placeholder(tf.float32, [None])
+      metrics = classifier_utils.classification_metric_fn(
+          per_example_loss, label_ids, logits, is_real_example)
+
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.local_variables_initializer())
+        num_batches = 0
+        for batch in self._batches(examples):
+          sess.run([op[1] for op in metrics.values()],
+                   dict(zip([per_example_loss, label_ids, logits,
+                             is_real_example], batch)))
+          num_batches += 1
+        values = sess.run(dict((key, op[0]) for key, op in metrics.items()))
+
+    return values, num_batches
+
+  def test_padding_does_not_change_metrics(self):
+    padded_examples = list(self.examples)
+    while len(padded_examples) % self.batch_size != 0:
+      padded_examples.append(classifier_utils.PaddingInputExample())
+
+    padded, num_padded_batches = self._evaluate(padded_examples)
+    unpadded, num_unpadded_batches = self._evaluate(self.examples)
+
+    padding = classifier_utils.convert_single_example(
+        0, classifier_utils.PaddingInputExample(), self.label_list,
+        self.max_seq_length, self._tokenize)
+    self.assertFalse(padding.is_real_example)
+
+    self.assertEqual(num_padded_batches, num_unpadded_batches)
+    self.assertEqual(sorted(padded.keys()), ["eval_accuracy", "eval_loss"])
+    for key in padded:
+      self.assertAllClose(padded[key], unpadded[key], rtol=1e-6, atol=1e-6)
+
+
+if __name__ == "__main__":
+  tf.test.main()
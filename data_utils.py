@@ -4,19 +4,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import hashlib
 import json
+import multiprocessing
 import os
 import random
+import sys
+import time
+import traceback
 
 from absl import flags
 import absl.logging as _logging  # pylint: disable=unused-import
 
 import numpy as np
+from six.moves import queue
 
 
 import tensorflow as tf
 
-from prepro_utils import preprocess_text, encode_ids
+from prepro_utils import BatchTokenizer
 import sentencepiece as spm
 
 
@@ -48,6 +55,10 @@ def _float_feature(values):
   return tf.train.Feature(float_list=tf.train.FloatList(value=values))
 
 
+def _bytes_feature(values):
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+
 def format_filename(prefix, bsz_per_host, seq_len, bi_data, suffix,
                     mask_alpha=5, mask_beta=1, reuse_len=None, uncased=False,
                     fixed_num_predict=None):
@@ -76,18 +87,227 @@ def format_filename(prefix, bsz_per_host, seq_len, bi_data, suffix,
   return file_name
 
 
-def _create_data(idx, input_paths):
-  # Load sentence-piece model
-  sp = spm.SentencePieceProcessor()
-  sp.Load(FLAGS.sp_path)
+###############
+# token store #
+###############
+class PackedBits(object):
+  """Read-only view over a bit-packed (`np.packbits`) bool array.
 
-  input_shards = []
-  total_line_cnt = 0
-  for input_path in input_paths:
-    input_data, sent_ids = [], []
-    sent_id, line_cnt = True, 0
-    tf.logging.info("Processing %s", input_path)
-    for line in tf.gfile.Open(input_path):
+  Supports `len`, integer indexing and slicing with step 1 or -1, where
+  slicing returns another view without copying the underlying bytes.
+  """
+
+  def __init__(self, bits, start, length, step=1):
+    self._bits = bits
+    self._start = start
+    self._length = length
+    self._step = step
+
+  def __len__(self):
+    return self._length
+
+  @property
+  def shape(self):
+    return (self._length,)
+
+  def _pos(self, i):
+    if self._step == 1:
+      return self._start + i
+    return self._start + self._length - 1 - i
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      beg, end, step = key.indices(self._length)
+      assert step in (1, -1), "Only supports slicing with step 1 or -1."
+      if step == -1:
+        beg, end = end + 1, beg + 1
+      length = max(0, end - beg)
+      if self._step == 1:
+        start = self._start + beg
+      else:
+        start = self._start + self._length - end
+      return PackedBits(self._bits, start, length, self._step * step)
+
+    if key < 0:
+      key += self._length
+    if key < 0 or key >= self._length:
+      raise IndexError("index {} out of range".format(key))
+    pos = self._pos(key)
+    return bool((self._bits[pos >> 3] >> (7 - (pos & 7))) & 1)
+
+  def read(self, start, stop):
+    """Unpack `[start, stop)` of a forward view into a bool array."""
+    assert self._step == 1
+    beg, end = self._start + start, self._start + stop
+    bits = np.unpackbits(self._bits[beg >> 3: (end + 7) >> 3])
+    return bits[beg & 7: (beg & 7) + end - beg].astype(np.bool)
+
+
+class TokenStoreWriter(object):
+  """Streaming writer of an on-disk tokenized corpus.
+
+  A store with prefix `prefix` consists of three local files:
+    - `{prefix}.ids`: token ids as a flat uint16 (or uint32) array.
+    - `{prefix}.sent`: bit-packed `sent_ids`, i.e. the sentence boundaries.
+    - `{prefix}.json`: dtype, number of tokens and document offsets.
+
+  As in the in-memory concatenation of shards, the `sent_ids` of a new
+  document are flipped when its first id equals the last id of the previous
+  document, so that a document boundary is always a sentence boundary.
+  """
+
+  def __init__(self, prefix, vocab_size=VOCAB_SIZE, buffer_size=1 << 20):
+    self.prefix = prefix
+    self.dtype = np.uint16 if vocab_size <= 1 << 16 else np.uint32
+    self.buffer_size = buffer_size
+
+    self._ids_fp = open(prefix + ".ids", "wb")
+    self._sent_fp = open(prefix + ".sent", "wb")
+    self._ids_buf, self._sent_buf, self._buf_len = [], [], 0
+    self._bit_remainder = np.zeros([0], dtype=np.bool)
+
+    self.num_token = 0
+    self.doc_offsets = [0]
+    self._prev_sent_id = None
+    self._flip = None
+
+  def add(self, ids, sent_ids):
+    """Append `ids` with their `sent_ids` to the current document."""
+    if len(ids) == 0:
+      return
+    sent_ids = np.asarray(sent_ids, dtype=np.bool)
+    if self._flip is None:
+      self._flip = (self._prev_sent_id is not None and
+                    sent_ids[0] == self._prev_sent_id)
+    if self._flip:
+      sent_ids = np.logical_not(sent_ids)
+
+    self._ids_buf.append(np.asarray(ids, dtype=self.dtype))
+    self._sent_buf.append(sent_ids)
+    self._prev_sent_id = bool(sent_ids[-1])
+    self._buf_len += len(ids)
+    self.num_token += len(ids)
+
+    if self._buf_len >= self.buffer_size:
+      self._flush()
+
+  def end_document(self):
+    if self.num_token > self.doc_offsets[-1]:
+      self.doc_offsets.append(self.num_token)
+    self._flip = None
+
+  def _flush(self):
+    if not self._ids_buf:
+      return
+    self._ids_fp.write(np.concatenate(self._ids_buf).tobytes())
+
+    sent_ids = np.concatenate([self._bit_remainder] + self._sent_buf)
+    num_full = sent_ids.shape[0] // 8 * 8
+    self._sent_fp.write(np.packbits(sent_ids[:num_full]).tobytes())
+    self._bit_remainder = sent_ids[num_full:]
+
+    self._ids_buf, self._sent_buf, self._buf_len = [], [], 0
+
+  def close(self, meta=None):
+    """Flush and write the index, with optional extra `meta` fields."""
+    self._flush()
+    self.end_document()
+    if self._bit_remainder.shape[0] > 0:
+      self._sent_fp.write(np.packbits(self._bit_remainder).tobytes())
+    self._ids_fp.close()
+    self._sent_fp.close()
+
+    index = {
+        "dtype": np.dtype(self.dtype).name,
+        "num_token": self.num_token,
+        "doc_offsets": self.doc_offsets,
+    }
+    if meta is not None:
+      index.update(meta)
+    with open(self.prefix + ".json", "w") as fp:
+      json.dump(index, fp)
+
+
+def load_token_store_index(prefix):
+  with open(prefix + ".json") as fp:
+    return json.load(fp)
+
+
+def load_token_store(prefix):
+  """Memory-map a store written by `TokenStoreWriter`.
+
+  Returns:
+    ids: flat token ids (a read-only `np.memmap`).
+    sent_ids: `PackedBits` view over the sentence ids.
+    doc_offsets: list of document offsets into `ids`.
+  """
+  index = load_token_store_index(prefix)
+  num_token = index["num_token"]
+  if num_token == 0:
+    ids = np.zeros([0], dtype=index["dtype"])
+    bits = np.zeros([0], dtype=np.uint8)
+  else:
+    ids = np.memmap(prefix + ".ids", dtype=index["dtype"], mode="r",
+                    shape=(num_token,))
+    bits = np.memmap(prefix + ".sent", dtype=np.uint8, mode="r",
+                     shape=((num_token + 7) // 8,))
+
+  return ids, PackedBits(bits, 0, num_token), index["doc_offsets"]
+
+
+def concat_token_stores(prefixes, out_prefix, vocab_size=VOCAB_SIZE,
+                        chunk_size=1 << 20):
+  """Stream the stores `prefixes` in order into a new store `out_prefix`."""
+  writer = TokenStoreWriter(out_prefix, vocab_size=vocab_size)
+  for prefix in prefixes:
+    ids, sent_ids, doc_offsets = load_token_store(prefix)
+    for doc_beg, doc_end in zip(doc_offsets[:-1], doc_offsets[1:]):
+      for beg in range(doc_beg, doc_end, chunk_size):
+        end = min(beg + chunk_size, doc_end)
+        writer.add(ids[beg:end], sent_ids.read(beg, end))
+      writer.end_document()
+    del ids, sent_ids
+  writer.close()
+
+
+def remove_token_store(prefix):
+  for suffix in [".ids", ".sent", ".json"]:
+    if os.path.exists(prefix + suffix):
+      os.remove(prefix + suffix)
+
+
+def rename_token_store(prefix, new_prefix):
+  # the index goes last as its existence marks a complete store
+  for suffix in [".ids", ".sent", ".json"]:
+    os.rename(prefix + suffix, new_prefix + suffix)
+
+
+def _read_line_blocks(input_path, block_size=16384):
+  """Yield the lines of `input_path` in lists of `block_size` lines."""
+  block = []
+  for line in tf.gfile.Open(input_path):
+    block.append(line)
+    if len(block) == block_size:
+      yield block
+      block = []
+  if block:
+    yield block
+
+
+def _tokenize_lines(sp, input_path):
+  """Yield `(ids, sent_id)` of every non-skipped line of `input_path`."""
+  sent_id, line_cnt = True, 0
+  tokenizer = BatchTokenizer(
+      sp, lower=FLAGS.uncased,
+      num_threads=max(1, multiprocessing.cpu_count() // FLAGS.num_workers))
+  tf.logging.info("Processing %s", input_path)
+  for block in _read_line_blocks(input_path):
+    texts = [line.strip() for line in block if line.strip()]
+    if FLAGS.from_raw_text:
+      ids, offsets = tokenizer.encode_ids(texts)
+    text_idx = 0
+
+    for line in block:
       if line_cnt % 100000 == 0:
         tf.logging.info("Loading line %d", line_cnt)
       line_cnt += 1
@@ -100,59 +320,181 @@ def _create_data(idx, input_paths):
           continue
       else:
         if FLAGS.from_raw_text:
-          cur_sent = preprocess_text(line.strip(), lower=FLAGS.uncased)
-          cur_sent = encode_ids(sp, cur_sent)
+          cur_sent = ids[offsets[text_idx]:offsets[text_idx + 1]]
         else:
-          cur_sent = list(map(int, line.strip().split()))
+          cur_sent = list(map(int, texts[text_idx].split()))
+        text_idx += 1
 
-      input_data.extend(cur_sent)
-      sent_ids.extend([sent_id] * len(cur_sent))
+      yield cur_sent, sent_id
       sent_id = not sent_id
 
-    tf.logging.info("Finish with line %d", line_cnt)
-    if line_cnt == 0:
-      continue
+  tf.logging.info("Finish with line %d", line_cnt)
+
+
+def _file_hash(path):
+  md5 = hashlib.md5()
+  with tf.gfile.GFile(path, "rb") as fp:
+    while True:
+      chunk = fp.read(1 << 24)
+      if not chunk:
+        break
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+def _token_cache_key(input_path, sp_hash):
+  """Key of the tokenized `input_path` under the current tokenization setup."""
+  key = "{}-{}-{}-{}-{}".format(_file_hash(input_path), sp_hash,
+                                FLAGS.uncased, FLAGS.from_raw_text,
+                                FLAGS.use_eod)
+  return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _tokenize_file(sp, input_path, sp_hash):
+  """Tokenize a single input file into a shard.
+
+  If `FLAGS.token_store_dir` is set, the shard is a token store cached under
+  a key of (file content, `sp_hash`, tokenization flags), which is reused
+  as is by later passes and runs.
+
+  Returns:
+    shard: `(input_data, sent_ids)` arrays or the prefix of a token store.
+    line_cnt: number of lines in the file.
+    num_token: number of tokens in the shard.
+  """
+  line_cnt = 0
+  if FLAGS.token_store_dir:
+    prefix = os.path.join(FLAGS.token_store_dir,
+                          "tokens-" + _token_cache_key(input_path, sp_hash))
+    if os.path.exists(prefix + ".json"):
+      index = load_token_store_index(prefix)
+      tf.logging.info("Use cached tokens %s for %s", prefix, input_path)
+      return prefix, index["line_cnt"], index["num_token"]
+
+    tmp_prefix = "{}.tmp-{}".format(prefix, os.getpid())
+    writer = TokenStoreWriter(tmp_prefix, vocab_size=sp.GetPieceSize())
+    for cur_sent, sent_id in _tokenize_lines(sp, input_path):
+      writer.add(cur_sent, [sent_id] * len(cur_sent))
+      line_cnt += 1
+    writer.close(meta={"line_cnt": line_cnt, "input_path": input_path})
+    rename_token_store(tmp_prefix, prefix)
+    return prefix, line_cnt, writer.num_token
+
+  input_data, sent_ids = [], []
+  for cur_sent, sent_id in _tokenize_lines(sp, input_path):
+    input_data.extend(cur_sent)
+    sent_ids.extend([sent_id] * len(cur_sent))
+    line_cnt += 1
+
+  input_data = np.array(input_data, dtype=np.int64)
+  sent_ids = np.array(sent_ids, dtype=np.bool)
+
+  return (input_data, sent_ids), line_cnt, input_data.shape[0]
+
+
+def _get_pass_ids():
+  return list(range(FLAGS.pass_id, FLAGS.pass_id + FLAGS.num_passes))
+
+
+def _log_estimated_pass_speedup(name, tokenize_time, record_time,
+                                num_passes):
+  """Log the timed tokenization and record phases, and an estimate of the
+  speedup over one run per pass.
 
-    input_data = np.array(input_data, dtype=np.int64)
-    sent_ids = np.array(sent_ids, dtype=np.bool)
+  The separate runs are not timed: each is assumed to tokenize again and to
+  write one pass of records, i.e. `num_passes * tokenize_time +
+  record_time` in total.
+  """
+  tot_time = tokenize_time + record_time
+  sep_time = num_passes * tokenize_time + record_time
+  tf.logging.info(
+      "[%s] timed: tokenize %.1fs, %d passes of records %.1fs. Estimate, "
+      "not timed: %.2fx speedup over %d separate runs (%.1fs vs %.1fs)",
+      name, tokenize_time, num_passes, record_time,
+      sep_time / max(tot_time, 1e-6), num_passes, tot_time, sep_time)
+
+
+def _create_data(idx, input_paths, pass_ids):
+  """Tokenize `input_paths` once and create the records of `pass_ids`.
+
+  Returns:
+    dict from pass id to the record info of that pass.
+  """
+  # Load sentence-piece model
+  sp = spm.SentencePieceProcessor()
+  sp.Load(FLAGS.sp_path)
+  sp_hash = _file_hash(FLAGS.sp_path)
+
+  start_time = time.time()
+  input_shards = []
+  total_line_cnt = 0
+  for input_path in input_paths:
+    shard, line_cnt, num_token = _tokenize_file(sp, input_path, sp_hash)
+    if num_token == 0:
+      continue
 
     total_line_cnt += line_cnt
-    input_shards.append((input_data, sent_ids))
+    input_shards.append(shard)
 
   tf.logging.info("[Task %d] Total number line: %d", idx, total_line_cnt)
+  tokenize_time = time.time() - start_time
+
+  record_infos = {}
+  for pass_id in pass_ids:
+    if input_shards:
+      record_infos[pass_id] = _create_records_from_shards(
+          idx, input_shards, sp, pass_id)
+    else:
+      record_infos[pass_id] = {"filenames": [], "num_batch": 0}
+  _log_estimated_pass_speedup("Task {}".format(idx), tokenize_time,
+                              time.time() - start_time - tokenize_time,
+                              len(pass_ids))
+
+  return record_infos
 
+
+def _create_records_from_shards(idx, input_shards, sp, pass_id):
+  """Shuffle, concatenate and write `input_shards` into tfrecords."""
   tfrecord_dir = os.path.join(FLAGS.save_dir, "tfrecords")
 
   filenames, num_batch = [], 0
 
   # Randomly shuffle input shards (with a fixed but distinct random seed)
-  np.random.seed(100 * FLAGS.task + FLAGS.pass_id)
-
+  np.random.seed(100 * idx + pass_id)
+  random.seed(100 * idx + pass_id)
   perm_indices = np.random.permutation(len(input_shards))
   tf.logging.info("Using perm indices %s for pass %d",
-                  perm_indices.tolist(), FLAGS.pass_id)
-
-  input_data_list, sent_ids_list = [], []
-  prev_sent_id = None
-  for perm_idx in perm_indices:
-    input_data, sent_ids = input_shards[perm_idx]
-    # make sure the `send_ids[0] == not prev_sent_id`
-    if prev_sent_id is not None and sent_ids[0] == prev_sent_id:
-      sent_ids = np.logical_not(sent_ids)
+                  perm_indices.tolist(), pass_id)
+
+  basename = "{}-{}-{}".format(FLAGS.split, idx, pass_id)
+  if FLAGS.token_store_dir:
+    # shards are token stores: stream them into a single memory-mapped one
+    store_prefix = os.path.join(FLAGS.token_store_dir, basename)
+    concat_token_stores([input_shards[i] for i in perm_indices], store_prefix,
+                        vocab_size=sp.GetPieceSize())
+    input_data, sent_ids, _ = load_token_store(store_prefix)
+  else:
+    input_data_list, sent_ids_list = [], []
+    prev_sent_id = None
+    for perm_idx in perm_indices:
+      input_data, sent_ids = input_shards[perm_idx]
+      # make sure the `send_ids[0] == not prev_sent_id`
+      if prev_sent_id is not None and sent_ids[0] == prev_sent_id:
+        sent_ids = np.logical_not(sent_ids)
 
-    # append to temporary list
-    input_data_list.append(input_data)
-    sent_ids_list.append(sent_ids)
+      # append to temporary list
+      input_data_list.append(input_data)
+      sent_ids_list.append(sent_ids)
 
-    # update `prev_sent_id`
-    prev_sent_id = sent_ids[-1]
+      # update `prev_sent_id`
+      prev_sent_id = sent_ids[-1]
 
-  input_data = np.concatenate(input_data_list)
-  sent_ids = np.concatenate(sent_ids_list)
+    input_data = np.concatenate(input_data_list)
+    sent_ids = np.concatenate(sent_ids_list)
 
   file_name, cur_num_batch = create_tfrecords(
       save_dir=tfrecord_dir,
-      basename="{}-{}-{}".format(FLAGS.split, idx, FLAGS.pass_id),
+      basename=basename,
       data=[input_data, sent_ids],
       bsz_per_host=FLAGS.bsz_per_host,
       seq_len=FLAGS.seq_len,
@@ -163,6 +505,10 @@ def _create_data(idx, input_paths):
   filenames.append(file_name)
   num_batch += cur_num_batch
 
+  if FLAGS.token_store_dir:
+    del input_data, sent_ids
+    remove_token_store(store_prefix)
+
   record_info = {
       "filenames": filenames,
       "num_batch": num_batch
@@ -171,6 +517,248 @@ def _create_data(idx, input_paths):
   return record_info
 
 
+def _create_data_worker(worker_idx, pass_ids, path_queue, result_queue):
+  """Worker loop of `_create_data_parallel`.
+
+  Input files are pulled one at a time from `path_queue` until a `None`
+  sentinel is seen, so that idle workers keep stealing the remaining files.
+  The tokenized shards are then written as the tfrecords of `worker_idx`
+  for every pass.
+  """
+  try:
+    sp = spm.SentencePieceProcessor()
+    sp.Load(FLAGS.sp_path)
+    sp_hash = _file_hash(FLAGS.sp_path)
+
+    input_shards = []
+    stats = {"num_file": 0, "num_line": 0, "num_token": 0}
+    start_time = time.time()
+    while True:
+      input_path = path_queue.get()
+      if input_path is None:
+        break
+      shard, line_cnt, num_token = _tokenize_file(sp, input_path, sp_hash)
+      stats["num_file"] += 1
+      if num_token == 0:
+        continue
+
+      stats["num_line"] += line_cnt
+      stats["num_token"] += num_token
+      input_shards.append(shard)
+    stats["tokenize_time"] = time.time() - start_time
+
+    record_infos = {}
+    for pass_id in pass_ids:
+      if input_shards:
+        record_infos[pass_id] = _create_records_from_shards(
+            worker_idx, input_shards, sp, pass_id)
+      else:
+        record_infos[pass_id] = {"filenames": [], "num_batch": 0}
+    stats["total_time"] = time.time() - start_time
+
+    result_queue.put((worker_idx, record_infos, stats, None))
+  except Exception:  # pylint: disable=broad-except
+    result_queue.put((worker_idx, None, None, traceback.format_exc()))
+
+
+# seconds between two liveness checks of the workers of _create_data_parallel
+_RESULT_POLL_SECS = 10
+
+
+def _create_data_parallel(first_worker_idx, input_paths, pass_ids):
+  """Process `input_paths` with a local pool of `FLAGS.num_workers` workers.
+
+  Files are scheduled largest first and handed out dynamically, and for every
+  pass the record infos of all workers are merged into a single one. Workers
+  are numbered from `first_worker_idx`.
+  """
+  num_workers = min(FLAGS.num_workers, len(input_paths))
+  input_paths = sorted(input_paths, key=lambda x: -tf.gfile.Stat(x).length)
+
+  path_queue = multiprocessing.Queue()
+  result_queue = multiprocessing.Queue()
+  for input_path in input_paths:
+    path_queue.put(input_path)
+  for _ in range(num_workers):
+    path_queue.put(None)
+
+  workers = []
+  for i in range(num_workers):
+    worker = multiprocessing.Process(
+        target=_create_data_worker,
+        args=(first_worker_idx + i, pass_ids, path_queue, result_queue))
+    worker.start()
+    workers.append(worker)
+
+  # collect before join so that workers never block on a full result pipe
+  results = []
+  while len(results) < num_workers:
+    try:
+      results.append(result_queue.get(timeout=_RESULT_POLL_SECS))
+    except queue.Empty:
+      # workers report their own errors, a non-zero exit code means that one
+      # died without reporting (e.g. killed by the OOM killer)
+      dead = [(first_worker_idx + i, worker.exitcode)
+              for i, worker in enumerate(workers)
+              if not worker.is_alive() and worker.exitcode != 0]
+      if dead:
+        for worker in workers:
+          if worker.is_alive():
+            worker.terminate()
+        raise RuntimeError("Workers died without a result (worker, exit "
+                           "code): {}".format(dead))
+  for worker in workers:
+    worker.join()
+
+  record_infos = {}
+  for pass_id in pass_ids:
+    record_infos[pass_id] = {"filenames": [], "num_batch": 0}
+  for worker_idx, worker_infos, stats, error in sorted(results,
+                                                       key=lambda x: x[0]):
+    if error is not None:
+      raise RuntimeError("Worker {} failed:\n{}".format(worker_idx, error))
+
+    tf.logging.info(
+        "[Worker %d] files %d, lines %d, tokens %d, batches %d, "
+        "tokenize %.1fs (%.0f tokens/s), total %.1fs",
+        worker_idx, stats["num_file"], stats["num_line"], stats["num_token"],
+        sum([info["num_batch"] for info in worker_infos.values()]),
+        stats["tokenize_time"],
+        stats["num_token"] / max(stats["tokenize_time"], 1e-6),
+        stats["total_time"])
+    _log_estimated_pass_speedup("Worker {}".format(worker_idx),
+                                stats["tokenize_time"],
+                                stats["total_time"] - stats["tokenize_time"],
+                                len(pass_ids))
+    for pass_id, info in worker_infos.items():
+      record_infos[pass_id]["filenames"] += info["filenames"]
+      record_infos[pass_id]["num_batch"] += info["num_batch"]
+
+  return record_infos
+
+
+def _manifest_name(split, bsz_per_host, seq_len, bi_data, mask_alpha,
+                   mask_beta, reuse_len, uncased, fixed_num_predict):
+  return format_filename(
+      prefix="manifest-{}".format(split),
+      bsz_per_host=bsz_per_host,
+      seq_len=seq_len,
+      bi_data=bi_data,
+      suffix="json",
+      mask_alpha=mask_alpha,
+      mask_beta=mask_beta,
+      reuse_len=reuse_len,
+      uncased=uncased,
+      fixed_num_predict=fixed_num_predict)
+
+
+def _dump_manifest(manifest, manifest_path):
+  tmp_path = manifest_path + ".tmp"
+  with tf.gfile.Open(tmp_path, "w") as fp:
+    json.dump(manifest, fp, indent=2, sort_keys=True)
+  tf.gfile.Rename(tmp_path, manifest_path, overwrite=True)
+
+
+def _create_data_incremental(tfrecord_dir, file_paths):
+  """Only process the input files that are new or changed since the last run.
+
+  The manifest in `tfrecord_dir` records, for every processed input file, its
+  size, mtime, content hash and the group of files it was processed with.
+  A group holds the record files and num_batch of each of its passes.
+  Changed or removed files invalidate (and delete the records of) their
+  whole group, and the unchanged files of such groups are processed again
+  together with the new ones. Existing groups only get the passes they miss.
+  """
+  manifest_path = os.path.join(tfrecord_dir, _manifest_name(
+      split=FLAGS.split,
+      bsz_per_host=FLAGS.bsz_per_host,
+      seq_len=FLAGS.seq_len,
+      bi_data=FLAGS.bi_data,
+      mask_alpha=FLAGS.mask_alpha,
+      mask_beta=FLAGS.mask_beta,
+      reuse_len=FLAGS.reuse_len,
+      uncased=FLAGS.uncased,
+      fixed_num_predict=FLAGS.num_predict))
+  if tf.gfile.Exists(manifest_path):
+    with tf.gfile.Open(manifest_path, "r") as fp:
+      manifest = json.load(fp)
+  else:
+    manifest = {"next_idx": 0, "files": {}, "groups": {}}
+  pass_ids = _get_pass_ids()
+
+  def _process(input_paths, cur_pass_ids):
+    idx = manifest["next_idx"]
+    if FLAGS.num_workers > 1:
+      manifest["next_idx"] += FLAGS.num_workers
+      record_infos = _create_data_parallel(idx, input_paths, cur_pass_ids)
+    else:
+      manifest["next_idx"] += 1
+      record_infos = _create_data(idx, input_paths, cur_pass_ids)
+    return idx, dict([(str(k), v) for k, v in record_infos.items()])
+
+  # (1) find new, changed and removed input files
+  file_stats, dirty_paths = {}, []
+  for path in file_paths:
+    stat = tf.gfile.Stat(path)
+    file_stat = {"size": stat.length, "mtime": stat.mtime_nsec}
+    entry = manifest["files"].get(path)
+    if (entry is not None and entry["size"] == file_stat["size"] and
+        entry["mtime"] == file_stat["mtime"]):
+      file_stat["hash"] = entry["hash"]
+    else:
+      file_stat["hash"] = _file_hash(path)
+      if entry is None or entry["hash"] != file_stat["hash"]:
+        dirty_paths.append(path)
+    file_stats[path] = file_stat
+  removed_paths = [path for path in manifest["files"]
+                   if path not in file_stats]
+  tf.logging.info("Manifest %s: %d new or changed, %d removed, %d unchanged "
+                  "input files", manifest_path, len(dirty_paths),
+                  len(removed_paths), len(file_paths) - len(dirty_paths))
+
+  # (2) invalidate the groups of changed and removed files
+  dirty_groups = set([manifest["files"][path]["group"]
+                      for path in dirty_paths + removed_paths
+                      if path in manifest["files"]])
+  for group_id in sorted(dirty_groups):
+    group = manifest["groups"].pop(group_id)
+    tf.logging.info("Invalidate group %s of %d files", group_id,
+                    len(group["input_paths"]))
+    for record_info in group["passes"].values():
+      for filename in record_info["filenames"]:
+        remove_record_file(filename)
+    for path in group["input_paths"]:
+      if path in file_stats and path not in dirty_paths:
+        dirty_paths.append(path)
+  for path in removed_paths:
+    del manifest["files"][path]
+  for path in file_stats:
+    if path in manifest["files"]:
+      manifest["files"][path].update(file_stats[path])
+
+  # (3) add the requested passes that existing groups miss
+  for group_id, group in sorted(manifest["groups"].items()):
+    missing_pass_ids = [pass_id for pass_id in pass_ids
+                        if str(pass_id) not in group["passes"]]
+    if missing_pass_ids:
+      _, record_infos = _process(group["input_paths"], missing_pass_ids)
+      group["passes"].update(record_infos)
+      _dump_manifest(manifest, manifest_path)
+
+  # (4) process the new and changed files as a new group
+  if dirty_paths:
+    idx, record_infos = _process(sorted(dirty_paths), pass_ids)
+    group_id = str(idx)
+    manifest["groups"][group_id] = {
+        "input_paths": sorted(dirty_paths),
+        "passes": record_infos,
+    }
+    for path in dirty_paths:
+      manifest["files"][path] = dict(file_stats[path], group=group_id)
+
+  _dump_manifest(manifest, manifest_path)
+
+
 def create_data(_):
   # Validate FLAGS
   assert FLAGS.bsz_per_host % FLAGS.num_core_per_host == 0
@@ -185,6 +773,9 @@ def create_data(_):
   if not tf.gfile.Exists(tfrecord_dir):
     tf.gfile.MakeDirs(tfrecord_dir)
 
+  if FLAGS.token_store_dir and not os.path.exists(FLAGS.token_store_dir):
+    os.makedirs(FLAGS.token_store_dir)
+
   # Create and dump corpus_info from task 0
   if FLAGS.task == 0:
     corpus_info = {
@@ -201,6 +792,7 @@ def create_data(_):
         "use_eod": FLAGS.use_eod,
         "sp_path": FLAGS.sp_path,
         "input_glob": FLAGS.input_glob,
+        "record_format": FLAGS.record_format,
     }
     corpus_info_path = os.path.join(FLAGS.save_dir, "corpus_info.json")
     with tf.gfile.Open(corpus_info_path, "w") as fp:
@@ -211,6 +803,11 @@ def create_data(_):
   tf.logging.info("Use glob: %s", FLAGS.input_glob)
   tf.logging.info("Find %d files: %s", len(file_paths), file_paths)
 
+  if FLAGS.incremental:
+    assert FLAGS.num_task == 1, "Incremental mode only supports one task."
+    _create_data_incremental(tfrecord_dir, file_paths)
+    return
+
   task_file_paths = file_paths[FLAGS.task::FLAGS.num_task]
   if not task_file_paths:
     tf.logging.info("Exit: task %d has no file to process.", FLAGS.task)
@@ -218,25 +815,30 @@ def create_data(_):
 
   tf.logging.info("Task %d process %d files: %s",
                   FLAGS.task, len(task_file_paths), task_file_paths)
-  record_info = _create_data(FLAGS.task, task_file_paths)
-
-  record_prefix = "record_info-{}-{}-{}".format(
-      FLAGS.split, FLAGS.task, FLAGS.pass_id)
-  record_name = format_filename(
-      prefix=record_prefix,
-      bsz_per_host=FLAGS.bsz_per_host,
-      seq_len=FLAGS.seq_len,
-      mask_alpha=FLAGS.mask_alpha,
-      mask_beta=FLAGS.mask_beta,
-      reuse_len=FLAGS.reuse_len,
-      bi_data=FLAGS.bi_data,
-      suffix="json",
-      uncased=FLAGS.uncased,
-      fixed_num_predict=FLAGS.num_predict)
-  record_info_path = os.path.join(tfrecord_dir, record_name)
-
-  with tf.gfile.Open(record_info_path, "w") as fp:
-    json.dump(record_info, fp)
+  if FLAGS.num_workers > 1:
+    record_infos = _create_data_parallel(
+        FLAGS.task * FLAGS.num_workers, task_file_paths, _get_pass_ids())
+  else:
+    record_infos = _create_data(FLAGS.task, task_file_paths, _get_pass_ids())
+
+  for pass_id, record_info in sorted(record_infos.items()):
+    record_prefix = "record_info-{}-{}-{}".format(
+        FLAGS.split, FLAGS.task, pass_id)
+    record_name = format_filename(
+        prefix=record_prefix,
+        bsz_per_host=FLAGS.bsz_per_host,
+        seq_len=FLAGS.seq_len,
+        mask_alpha=FLAGS.mask_alpha,
+        mask_beta=FLAGS.mask_beta,
+        reuse_len=FLAGS.reuse_len,
+        bi_data=FLAGS.bi_data,
+        suffix="json",
+        uncased=FLAGS.uncased,
+        fixed_num_predict=FLAGS.num_predict)
+    record_info_path = os.path.join(tfrecord_dir, record_name)
+
+    with tf.gfile.Open(record_info_path, "w") as fp:
+      json.dump(record_info, fp)
 
 
 def batchify(data, bsz_per_host, sent_ids=None):
@@ -319,10 +921,12 @@ def _split_a_and_b(data, sent_ids, begin_idx, tot_len, extend_target=False):
   return ret
 
 
+_SPECIAL_PIECES = frozenset('!"#$%&\"()*+,-./:;?@[\\]^_`{|}~')
+
+
 def _is_start_piece(piece):
-  special_pieces = set(list('!"#$%&\"()*+,-./:;?@[\\]^_`{|}~'))
   if (piece.startswith("▁") or piece.startswith("<")
-      or piece in special_pieces):
+      or piece in _SPECIAL_PIECES):
     return True
   else:
     return False
@@ -392,6 +996,150 @@ def _sample_mask(sp, seg, reverse=False, max_gram=5, goal_num_predict=None):
   return mask
 
 
+def build_start_piece_table(sp):
+  """Boolean table over the vocabulary: True if the piece starts a word."""
+  return np.array([_is_start_piece(sp.IdToPiece(i))
+                   for i in range(sp.GetPieceSize())], dtype=np.bool)
+
+
+def _sample_mask_batch(is_start_table, segs, reverse, mask_alpha, mask_beta,
+                       max_gram=5, goal_num_predict=None):
+  """Vectorized version of `_sample_mask` over a batch of segments.
+
+  Args:
+    is_start_table: bool array in shape [vocab_size], see
+      `build_start_piece_table`.
+    segs: int array in shape [bsz, seg_len].
+    reverse: bool array in shape [bsz]. Rows to sample in reversed order.
+    mask_alpha, mask_beta: about `mask_beta` tokens are chosen in a context
+      of `mask_alpha` tokens.
+    max_gram: the longest n-gram span.
+    goal_num_predict: number of tokens to predict per row, or None.
+
+  Returns:
+    bool array in shape [bsz, seg_len], distributed as `_sample_mask` per row.
+  """
+  bsz, seg_len = segs.shape
+  reverse = np.asarray(reverse, dtype=np.bool)
+
+  segs = np.where(reverse[:, None], segs[:, ::-1], segs)
+  is_start = is_start_table[segs]
+
+  # `next_start[b, p]`: first word start at or after `p` (`seg_len` if none)
+  pos = np.arange(seg_len, dtype=np.int64)
+  next_start = np.full([bsz, seg_len + 1], seg_len, dtype=np.int64)
+  next_start[:, :-1] = np.where(is_start, pos[None], seg_len)
+  next_start = np.minimum.accumulate(next_start[:, ::-1], axis=1)[:, ::-1]
+
+  # `start_pos[b, k]`: position of the k-th word start (`seg_len` if none),
+  # `start_rank[b, p]`: k such that `start_pos[b, k] == p` for word starts
+  num_start = is_start.sum(axis=1)
+  start_pos = np.full([bsz, seg_len + 1], seg_len, dtype=np.int64)
+  start_pos[:, :-1] = np.where(
+      pos[None] < num_start[:, None],
+      np.argsort(~is_start, axis=1, kind="mergesort"), seg_len)
+  start_rank = np.cumsum(is_start, axis=1) - 1
+
+  ngrams = np.arange(1, max_gram + 1, dtype=np.int64)
+  pvals = 1. / np.arange(1, max_gram + 1)
+  pvals /= pvals.sum(keepdims=True)
+
+  # spans are disjoint, so mark their boundaries and cumsum at the end
+  delta = np.zeros([bsz, seg_len + 1], dtype=np.int64)
+  num_predict = np.zeros([bsz], dtype=np.int64)
+  cur_len = np.zeros([bsz], dtype=np.int64)
+  rows = np.arange(bsz)
+
+  while rows.size > 0:
+    rows = rows[cur_len[rows] < seg_len]
+    if goal_num_predict is not None:
+      rows = rows[num_predict[rows] < goal_num_predict]
+    if rows.size == 0:
+      break
+
+    n = np.random.choice(ngrams, size=rows.size, p=pvals)
+    if goal_num_predict is not None:
+      n = np.minimum(n, goal_num_predict - num_predict[rows])
+    ctx_size = (n * mask_alpha) // mask_beta
+    l_ctx = np.random.randint(0, ctx_size)
+    r_ctx = ctx_size - l_ctx
+
+    # Find the start position of a complete token
+    beg = np.minimum(cur_len[rows] + l_ctx, seg_len)
+    beg = next_start[rows, beg]
+    keep = beg < seg_len
+    rows, beg, n, r_ctx = rows[keep], beg[keep], n[keep], r_ctx[keep]
+
+    # Find the end position of the n-gram (start pos of the n+1-th gram)
+    end_rank = np.minimum(start_rank[rows, beg] + n, seg_len)
+    end = start_pos[rows, end_rank]
+    keep = end < seg_len
+    rows, beg, end, r_ctx = rows[keep], beg[keep], end[keep], r_ctx[keep]
+
+    # Update
+    delta[rows, beg] += 1
+    delta[rows, end] -= 1
+    num_predict[rows] += end - beg
+
+    cur_len[rows] = end + r_ctx
+
+  mask = np.cumsum(delta[:, :-1], axis=1) > 0
+
+  if goal_num_predict is not None:
+    # uniformly pick the remaining positions among the unmasked ones
+    num_fill = np.maximum(goal_num_predict - num_predict, 0)
+    order = np.argsort(np.where(mask, 2., np.random.rand(bsz, seg_len)),
+                       axis=1)
+    fill = pos[None] < num_fill[:, None]
+    mask[np.nonzero(fill)[0], order[fill]] = True
+
+  mask = np.where(reverse[:, None], mask[:, ::-1], mask)
+
+  return mask
+
+
+def _compact_feature(cat_data, tgt, seg_id, is_masked, label):
+  """Features of the "compact" record format.
+
+  Compared with the "int64" format:
+    - `input` holds little-endian uint16 ids in a single bytes feature.
+    - `target` is `input` shifted by one (padded with [cls]), except for the
+      last tokens of segment A and B whose true next tokens are kept in
+      `target_patch`.
+    - `seg_id` is rebuilt from `seg_a_len`, the length of segment 0.
+    - `is_masked` is bit-packed into a bytes feature.
+  See `_decode_compact_example` for the inverse.
+  """
+  seq_len = cat_data.shape[0]
+  seg_a_len = seg_id.count(0)
+  patch_pos = [seg_a_len - 2, seq_len - 3]
+
+  shifted = np.concatenate([cat_data[1:], [CLS_ID]])
+  assert set(np.flatnonzero(shifted != tgt)) <= set(patch_pos)
+  assert cat_data.max() < 1 << 16
+
+  return {
+      "input": _bytes_feature([cat_data.astype("<u2").tobytes()]),
+      "target_patch": _int64_feature(tgt[patch_pos]),
+      "seg_a_len": _int64_feature([seg_a_len]),
+      "is_masked": _bytes_feature([np.packbits(is_masked).tobytes()]),
+      "label": _int64_feature([label]),
+  }
+
+
+def _record_feature(record_format, cat_data, tgt, seg_id, is_masked, label):
+  """Features of an example in `record_format`, "int64" or "compact"."""
+  if record_format == "compact":
+    return _compact_feature(cat_data, tgt, seg_id, is_masked, label)
+  return {
+      "input": _int64_feature(cat_data),
+      "is_masked": _int64_feature(is_masked),
+      "target": _int64_feature(tgt),
+      "seg_id": _int64_feature(seg_id),
+      "label": _int64_feature([label]),
+  }
+
+
 def create_tfrecords(save_dir, basename, data, bsz_per_host, seq_len,
                      bi_data, sp):
   data, sent_ids = data[0], data[1]
@@ -399,24 +1147,28 @@ def create_tfrecords(save_dir, basename, data, bsz_per_host, seq_len,
   num_core = FLAGS.num_core_per_host
   bsz_per_core = bsz_per_host // num_core
 
+  # Rows are views into `data` and `sent_ids` (which may be memory-mapped),
+  # laid out the same way as `batchify` followed by the bi_data reshaping.
   if bi_data:
     assert bsz_per_host % (2 * FLAGS.num_core_per_host) == 0
-    fwd_data, fwd_sent_ids = batchify(data, bsz_per_host // 2, sent_ids)
-
-    fwd_data = fwd_data.reshape(num_core, 1, bsz_per_core // 2, -1)
-    fwd_sent_ids = fwd_sent_ids.reshape(num_core, 1, bsz_per_core // 2, -1)
-
-    bwd_data = fwd_data[:, :, :, ::-1]
-    bwd_sent_ids = fwd_sent_ids[:, :, :, ::-1]
-
-    data = np.concatenate(
-        [fwd_data, bwd_data], 1).reshape(bsz_per_host, -1)
-    sent_ids = np.concatenate(
-        [fwd_sent_ids, bwd_sent_ids], 1).reshape(bsz_per_host, -1)
+    num_step = len(data) // (bsz_per_host // 2)
+    fwd_rows = [(data[r * num_step: (r + 1) * num_step],
+                 sent_ids[r * num_step: (r + 1) * num_step])
+                for r in range(bsz_per_host // 2)]
+
+    rows = []
+    for core in range(num_core):
+      core_rows = fwd_rows[core * (bsz_per_core // 2):
+                           (core + 1) * (bsz_per_core // 2)]
+      rows.extend(core_rows)
+      rows.extend([(row[::-1], row_sent[::-1]) for row, row_sent in core_rows])
   else:
-    data, sent_ids = batchify(data, bsz_per_host, sent_ids)
+    num_step = len(data) // bsz_per_host
+    rows = [(data[r * num_step: (r + 1) * num_step],
+             sent_ids[r * num_step: (r + 1) * num_step])
+            for r in range(bsz_per_host)]
 
-  tf.logging.info("Raw data shape %s.", data.shape)
+  tf.logging.info("Raw data shape %s.", (bsz_per_host, num_step))
 
   file_name = format_filename(
       prefix=basename,
@@ -431,7 +1183,10 @@ def create_tfrecords(save_dir, basename, data, bsz_per_host, seq_len,
       fixed_num_predict=FLAGS.num_predict
   )
   save_path = os.path.join(save_dir, file_name)
+  # the index of a previous file is stale until the new one is written
+  remove_record_file(save_path)
   record_writer = tf.python_io.TFRecordWriter(save_path)
+  num_records = 0
   tf.logging.info("Start writing %s.", save_path)
 
   num_batch = 0
@@ -440,24 +1195,35 @@ def create_tfrecords(save_dir, basename, data, bsz_per_host, seq_len,
   # [sep] x 2 + [cls]
   assert reuse_len < seq_len - 3
 
-  data_len = data.shape[1]
+  data_len = num_step
   sep_array = np.array([SEP_ID], dtype=np.int64)
   cls_array = np.array([CLS_ID], dtype=np.int64)
 
+  # (1) which rows are sampled backward (2) how many tokens each half predicts
+  reverse = np.array([bi_data and (idx // (bsz_per_core // 2)) % 2 == 1
+                      for idx in range(bsz_per_host)], dtype=np.bool)
+  if FLAGS.num_predict is None:
+    num_predict_0 = num_predict_1 = None
+  else:
+    num_predict_1 = FLAGS.num_predict // 2
+    num_predict_0 = FLAGS.num_predict - num_predict_1
+  is_start_table = build_start_piece_table(sp)
+
   i = 0
   while i + seq_len <= data_len:
     if num_batch % 500 == 0:
       tf.logging.info("Processing batch %d", num_batch)
 
     all_ok = True
-    features = []
+    batch = []
     for idx in range(bsz_per_host):
-      inp = data[idx, i: i + reuse_len]
-      tgt = data[idx, i + 1: i + reuse_len + 1]
+      row, row_sent = rows[idx]
+      inp = row[i: i + reuse_len]
+      tgt = row[i + 1: i + reuse_len + 1]
 
       results = _split_a_and_b(
-          data[idx],
-          sent_ids[idx],
+          row,
+          row_sent,
           begin_idx=i + reuse_len,
           tot_len=seq_len - reuse_len - 3,
           extend_target=True)
@@ -469,62 +1235,145 @@ def create_tfrecords(save_dir, basename, data, bsz_per_host, seq_len,
       # unpack the results
       (a_data, b_data, label, _, a_target, b_target) = tuple(results)
 
-      # sample ngram spans to predict
-      reverse = bi_data and (idx // (bsz_per_core // 2)) % 2 == 1
-      if FLAGS.num_predict is None:
-        num_predict_0 = num_predict_1 = None
-      else:
-        num_predict_1 = FLAGS.num_predict // 2
-        num_predict_0 = FLAGS.num_predict - num_predict_1
-      mask_0 = _sample_mask(sp, inp, reverse=reverse,
-                            goal_num_predict=num_predict_0)
-      mask_1 = _sample_mask(sp, np.concatenate([a_data, sep_array, b_data,
-                                                sep_array, cls_array]),
-                            reverse=reverse, goal_num_predict=num_predict_1)
-
       # concatenate data
       cat_data = np.concatenate([inp, a_data, sep_array, b_data,
                                  sep_array, cls_array])
       seg_id = ([0] * (reuse_len + a_data.shape[0]) + [0] +
                 [1] * b_data.shape[0] + [1] + [2])
       assert cat_data.shape[0] == seq_len
-      assert mask_0.shape[0] == seq_len // 2
-      assert mask_1.shape[0] == seq_len // 2
 
       # the last two CLS's are not used, just for padding purposes
       tgt = np.concatenate([tgt, a_target, b_target, cls_array, cls_array])
       assert tgt.shape[0] == seq_len
 
-      is_masked = np.concatenate([mask_0, mask_1], 0)
-      if FLAGS.num_predict is not None:
-        assert np.sum(is_masked) == FLAGS.num_predict
-
-      feature = {
-          "input": _int64_feature(cat_data),
-          "is_masked": _int64_feature(is_masked),
-          "target": _int64_feature(tgt),
-          "seg_id": _int64_feature(seg_id),
-          "label": _int64_feature([label]),
-      }
-      features.append(feature)
-
-    if all_ok:
-      assert len(features) == bsz_per_host
-      for feature in features:
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
-        record_writer.write(example.SerializeToString())
-      num_batch += 1
-    else:
+      batch.append((cat_data, tgt, seg_id, label))
+
+    if not all_ok:
       break
 
+    # sample ngram spans to predict for the whole batch at once
+    cat_data = np.stack([example[0] for example in batch])
+    mask_0 = _sample_mask_batch(
+        is_start_table, cat_data[:, :reuse_len], reverse,
+        mask_alpha=FLAGS.mask_alpha, mask_beta=FLAGS.mask_beta,
+        goal_num_predict=num_predict_0)
+    mask_1 = _sample_mask_batch(
+        is_start_table, cat_data[:, reuse_len:], reverse,
+        mask_alpha=FLAGS.mask_alpha, mask_beta=FLAGS.mask_beta,
+        goal_num_predict=num_predict_1)
+    assert mask_0.shape[1] == seq_len // 2
+    assert mask_1.shape[1] == seq_len // 2
+    is_masked = np.concatenate([mask_0, mask_1], 1)
+    if FLAGS.num_predict is not None:
+      assert np.all(np.sum(is_masked, 1) == FLAGS.num_predict)
+
+    assert len(batch) == bsz_per_host
+    for (cat_data, tgt, seg_id, label), row_masked in zip(batch, is_masked):
+      feature = _record_feature(FLAGS.record_format, cat_data, tgt, seg_id,
+                                row_masked, label)
+      example = tf.train.Example(features=tf.train.Features(feature=feature))
+      record = example.SerializeToString()
+      record_writer.write(record)
+      num_records += 1
+    num_batch += 1
+
     i += reuse_len
 
   record_writer.close()
+  write_record_index(save_path, num_records)
   tf.logging.info("Done writing %s. Num of batches: %d", save_path, num_batch)
 
   return save_path, num_batch
 
 
+################
+# Record index #
+################
+def write_record_index(path, num_records):
+  """Write the sidecar index of the tfrecord file `path`, which holds its
+  number of records so hosts can be sharded without reading the files."""
+  index = {"num_records": num_records}
+  with tf.gfile.Open(path + ".index", "w") as fp:
+    json.dump(index, fp)
+
+
+def load_record_index(path):
+  """Load the sidecar index of `path`, or return None if there is none."""
+  index_path = path + ".index"
+  if not tf.gfile.Exists(index_path):
+    return None
+  with tf.gfile.Open(index_path, "r") as fp:
+    return json.load(fp)
+
+
+def remove_record_file(path):
+  """Remove the tfrecord file `path` together with its sidecar index."""
+  for file_path in [path, path + ".index"]:
+    if tf.gfile.Exists(file_path):
+      tf.gfile.Remove(file_path)
+
+
+def shard_records(file_names, num_hosts, host_id, unit=1):
+  """Assign an equal share of the records of `file_names` to `host_id`.
+
+  The records of all files are split into consecutive units of `unit`
+  records (e.g. a batch), and the hosts get numbers of units that differ by
+  at most one. Trailing records that do not fill a unit are dropped.
+
+  Returns:
+    A list of (path, skip, take) slices of the files, or None if some file
+    has no sidecar index.
+  """
+  num_records = []
+  for path in file_names:
+    index = load_record_index(path)
+    if index is None:
+      tf.logging.info("No record index for %s, shard by files.", path)
+      return None
+    num_records.append(index["num_records"])
+
+  num_units = sum(num_records) // unit
+  units_per_host, remainder = divmod(num_units, num_hosts)
+  start = (host_id * units_per_host + min(host_id, remainder)) * unit
+  end = start + (units_per_host + int(host_id < remainder)) * unit
+
+  file_slices = []
+  file_start = 0
+  for path, file_num_records in zip(file_names, num_records):
+    file_end = file_start + file_num_records
+    slice_start, slice_end = max(start, file_start), min(end, file_end)
+    if slice_start < slice_end:
+      file_slices.append((path, slice_start - file_start,
+                          slice_end - slice_start))
+    file_start = file_end
+
+  tf.logging.info("Host %d handles records [%d, %d) in %d files",
+                  host_id, start, end, len(file_slices))
+
+  return file_slices
+
+
+def file_slices_dataset(file_slices):
+  """Dataset of the (path, skip, take) `file_slices`, one slice per element.
+
+  `take` = -1 means all the remaining records.
+  """
+  paths, skips, takes = zip(*file_slices)
+  return tf.data.Dataset.from_tensor_slices(
+      (list(paths),
+       tf.constant(skips, dtype=tf.int64),
+       tf.constant(takes, dtype=tf.int64)))
+
+
+def read_file_slice(path, skip, take):
+  """The records of a file slice, see `file_slices_dataset`.
+
+  TFRecordDataset cannot seek, so the `skip` leading records are still read
+  (but not parsed).
+  """
+  return tf.data.TFRecordDataset(path).skip(skip).take(take)
+
+
 ################
 # get_input_fn #
 ################
@@ -542,41 +1391,195 @@ def _convert_example(example, use_bfloat16):
     example[key] = val
 
 
-def parse_files_to_dataset(parser, file_names, split, num_batch, num_hosts,
-                           host_id, num_core_per_host, bsz_per_core):
-  # list of file pathes
-  num_files = len(file_names)
-  num_files_per_host = num_files // num_hosts
-  my_start_file_id = host_id * num_files_per_host
-  my_end_file_id = (host_id + 1) * num_files_per_host
-  if host_id == num_hosts - 1:
-    my_end_file_id = num_files
-  file_paths = file_names[my_start_file_id: my_end_file_id]
-  tf.logging.info("Host %d handles %d files", host_id, len(file_paths))
+class RecordCache(object):
+  """In-memory cache of the raw records of tfrecord file slices, bounded in
+  bytes.
 
-  assert split == "train"
-  dataset = tf.data.Dataset.from_tensor_slices(file_paths)
+  The slices are read in the same order in every epoch, so an LRU would
+  evict each slice before it is read again as soon as they do not all fit.
+  Instead, slices are admitted while they fit and then kept, and the other
+  slices are streamed from their files in every epoch. `num_bytes` is the
+  memory held by the cached records, Python object overhead included.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.num_bytes = 0
+    self.num_hit = 0
+    self.num_miss = 0
+    self._slices = {}
+    self._too_large = set()
+
+  def read(self, path, skip, take):
+    """Yield the raw records of the slice (`path`, `skip`, `take`)."""
+    key = (path, skip, take)
+    if key in self._slices:
+      self.num_hit += 1
+      for record in self._slices[key]:
+        yield record
+      return
+
+    self.num_miss += 1
+    records = None if key in self._too_large else []
+    records_bytes = 0
+    for i, record in enumerate(tf.python_io.tf_record_iterator(path)):
+      if i < skip:
+        continue
+      if take >= 0 and i >= skip + take:
+        break
+      if records is not None:
+        records_bytes += sys.getsizeof(record)
+        if (self.num_bytes + records_bytes + sys.getsizeof(records) >
+            self.max_bytes):
+          # stream this slice in every epoch
+          records = None
+          self._too_large.add(key)
+        else:
+          records.append(record)
+      yield record
 
-  # file-level shuffle
-  if len(file_paths) > 1:
-    dataset = dataset.shuffle(len(file_paths))
+    if records is not None:
+      self._slices[key] = records
+      self.num_bytes += records_bytes + sys.getsizeof(records)
 
-  # Note: we cannot perform sample-level shuffle here because this will violate
-  # the consecutive requirement of data stream.
-  dataset = tf.data.TFRecordDataset(dataset)
+  def log_stats(self, host_id):
+    tf.logging.info("Host %d record cache: %d slices cached, %d streamed, "
+                    "%.1f / %.1f MB resident, %d hits, %d misses", host_id,
+                    len(self._slices), len(self._too_large),
+                    self.num_bytes / 2 ** 20, self.max_bytes / 2 ** 20,
+                    self.num_hit, self.num_miss)
 
-  # (zihang): since we are doing online preprocessing, the parsed result of
-  # the same input at each time will be different. Thus, cache processed data
-  # is not helpful. It will use a lot of memory and lead to contrainer OOM.
-  # So, change to cache non-parsed raw data instead.
-  dataset = dataset.cache().map(parser).repeat()
-  dataset = dataset.batch(bsz_per_core, drop_remainder=True)
-  dataset = dataset.prefetch(num_core_per_host * bsz_per_core)
+
+def _cache_records(dataset, file_slices, host_id, record_cache,
+                   record_cache_dir):
+  """Cache the raw records of `dataset` (the records of `file_slices`).
+
+  Args:
+    record_cache: str, one of
+      "memory": cache all records in memory (unbounded).
+      "none": re-read the files in every epoch.
+      "disk": cache all records in a file of this host under
+        `record_cache_dir`.
+  """
+  if record_cache == "memory":
+    return dataset.cache()
+  elif record_cache == "none":
+    return dataset
+  elif record_cache == "disk":
+    assert record_cache_dir, "`record_cache_dir` is required for disk cache."
+    if not tf.gfile.Exists(record_cache_dir):
+      tf.gfile.MakeDirs(record_cache_dir)
+    # tf.data reuses an existing cache file, so key it by the file slices
+    files_hash = hashlib.md5(json.dumps(file_slices).encode("utf-8"))
+    cache_path = os.path.join(
+        record_cache_dir,
+        "records-host{}-{}".format(host_id, files_hash.hexdigest()))
+    tf.logging.info("Host %d caches records in %s", host_id, cache_path)
+    return dataset.cache(cache_path)
+  else:
+    raise ValueError("Unsupported record cache: {}".format(record_cache))
+
+
+def _bounded_records_dataset(file_slices, host_id, record_cache_mb):
+  """The records of `file_slices`, read through a `RecordCache` keeping at
+  most `record_cache_mb` MB in memory.
+
+  The files are read in a py_func (`from_generator`), so this cannot run in
+  the input pipeline of TPU hosts. The slices are read in the same order in
+  every epoch, as with the other caches.
+  """
+  assert record_cache_mb, "`record_cache_mb` is required for bounded cache."
+  cache = RecordCache(record_cache_mb * 2 ** 20)
+
+  def record_generator():
+    for path, skip, take in file_slices:
+      for record in cache.read(path, skip, take):
+        yield record
+    cache.log_stats(host_id)
+
+  return tf.data.Dataset.from_generator(record_generator, tf.string,
+                                        tf.TensorShape([]))
+
+
+def parse_files_to_dataset(parser, file_names, split, num_batch, num_hosts,
+                           host_id, num_core_per_host, bsz_per_core,
+                           batched_parser=None, num_parallel_calls=None,
+                           prefetch_to_device=None, record_cache="memory",
+                           record_cache_dir=None, record_cache_mb=None):
+  """Create the pretraining dataset of `host_id`.
+
+  By default, records are parsed one at a time by `parser` before batching.
+  If `num_parallel_calls` is not None, consecutive records are batched first
+  and then parsed by `batched_parser` with `num_parallel_calls` parallel
+  calls, prefetching whole batches (optionally onto `prefetch_to_device`).
+  The raw records are cached according to `record_cache`, see
+  `_cache_records`, or read through a bounded in-memory cache with
+  `record_cache` = "bounded", see `_bounded_records_dataset`.
+  """
+  # slices of files: an equal number of whole batches per host if the
+  # record files have sidecar indices, or else whole files
+  file_slices = None
+  if num_hosts > 1:
+    file_slices = shard_records(file_names, num_hosts, host_id,
+                                unit=bsz_per_core * num_core_per_host)
+
+  if file_slices is None:
+    num_files = len(file_names)
+    num_files_per_host = num_files // num_hosts
+    my_start_file_id = host_id * num_files_per_host
+    my_end_file_id = (host_id + 1) * num_files_per_host
+    if host_id == num_hosts - 1:
+      my_end_file_id = num_files
+    file_paths = file_names[my_start_file_id: my_end_file_id]
+    tf.logging.info("Host %d handles %d files", host_id, len(file_paths))
+    file_slices = [(path, 0, -1) for path in file_paths]
+
+  assert split == "train"
+  if record_cache == "bounded":
+    # file-level shuffle, once: the cached datasets below also replay the
+    # file order of their first epoch
+    file_slices = list(file_slices)
+    random.shuffle(file_slices)
+    dataset = _bounded_records_dataset(file_slices, host_id,
+                                       record_cache_mb)
+  else:
+    dataset = file_slices_dataset(file_slices)
+
+    # file-level shuffle
+    if len(file_slices) > 1:
+      dataset = dataset.shuffle(len(file_slices))
+
+    # Note: we cannot perform sample-level shuffle here because this will
+    # violate the consecutive requirement of data stream.
+    dataset = dataset.flat_map(read_file_slice)
+
+    # (zihang): since we are doing online preprocessing, the parsed result of
+    # the same input at each time will be different. Thus, cache processed
+    # data is not helpful. It will use a lot of memory and lead to contrainer
+    # OOM. So, change to cache non-parsed raw data instead.
+    dataset = _cache_records(dataset, file_slices, host_id, record_cache,
+                             record_cache_dir)
+  if num_parallel_calls is None:
+    dataset = dataset.map(parser).repeat()
+    dataset = dataset.batch(bsz_per_core, drop_remainder=True)
+    dataset = dataset.prefetch(num_core_per_host * bsz_per_core)
+  else:
+    # Batching raw records before the (order-preserving) parallel map yields
+    # the same consecutive examples per batch as map-then-batch.
+    dataset = dataset.repeat()
+    dataset = dataset.batch(bsz_per_core, drop_remainder=True)
+    dataset = dataset.map(batched_parser,
+                          num_parallel_calls=num_parallel_calls)
+    dataset = dataset.prefetch(num_core_per_host)
+    if prefetch_to_device:
+      dataset = dataset.apply(
+          tf.data.experimental.prefetch_to_device(prefetch_to_device))
 
   return dataset
 
 
-def _local_perm(inputs, targets, is_masked, perm_size, seq_len):
+def _local_perm(inputs, targets, is_masked, perm_size, seq_len,
+                compact_masks=False):
   """
   Sample a permutation of the factorization order, and create an
   attention mask accordingly.
@@ -589,6 +1592,8 @@ def _local_perm(inputs, targets, is_masked, perm_size, seq_len):
     perm_size: the length of longest permutation. Could be set to be reuse_len.
       Should not be larger than reuse_len or there will be data leaks.
     seq_len: int, sequence length.
+    compact_masks: bool, return the permutation ranks in shape [seq_len]
+      instead of `perm_mask`, see `modeling._create_perm_mask`.
   """
 
   # Generate permutation indices
@@ -620,15 +1625,19 @@ def _local_perm(inputs, targets, is_masked, perm_size, seq_len):
   target_mask = tf.cast(target_tokens, tf.float32)
 
   # Create `perm_mask`
-  # `target_tokens` cannot see themselves
-  self_rev_index = tf.where(target_tokens, rev_index, rev_index + 1)
+  if compact_masks:
+    # built from `rev_index` and `target_mask` inside the model
+    perm_mask = rev_index
+  else:
+    # `target_tokens` cannot see themselves
+    self_rev_index = tf.where(target_tokens, rev_index, rev_index + 1)
 
-  # 1: cannot attend if i <= j and j is not non-masked (masked_or_func_tokens)
-  # 0: can attend if i > j or j is non-masked
-  perm_mask = tf.logical_and(
-      self_rev_index[:, None] <= rev_index[None, :],
-      masked_or_func_tokens)
-  perm_mask = tf.cast(perm_mask, tf.float32)
+    # 1: cannot attend if i <= j and j is not non-masked (masked_or_func_tokens)
+    # 0: can attend if i > j or j is non-masked
+    perm_mask = tf.logical_and(
+        self_rev_index[:, None] <= rev_index[None, :],
+        masked_or_func_tokens)
+    perm_mask = tf.cast(perm_mask, tf.float32)
 
   # new target: [next token] for LM and [curr token] (self) for PLM
   new_targets = tf.concat([inputs[0: 1], targets[: -1]],
@@ -643,37 +1652,171 @@ def _local_perm(inputs, targets, is_masked, perm_size, seq_len):
   return perm_mask, new_targets, target_mask, inputs_k, inputs_q
 
 
-def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
-                num_batch, seq_len, reuse_len, perm_size, mask_alpha,
-                mask_beta, use_bfloat16=False, num_predict=None):
+def _decode_compact_example(example, seq_len, batch_size=None):
+  """Decode the features written by `_compact_feature`.
 
-  bsz_per_core = params["batch_size"]
-  if num_hosts > 1:
-    host_id = params["context"].current_host
+  Works on a single example, or on a batch of `batch_size` examples parsed
+  with `tf.parse_example`, in which case all shapes get a leading batch dim.
+
+  Returns:
+    inputs, target: int64 Tensors in shape [seq_len].
+    is_masked: bool Tensor in shape [seq_len].
+  `example` is updated in place with the int64 `seg_id`.
+  """
+  shape = [seq_len] if batch_size is None else [batch_size, seq_len]
+
+  inputs = tf.io.decode_raw(example.pop("input"), tf.uint16)
+  inputs = tf.reshape(tf.cast(inputs, tf.int64), shape)
+
+  pos = tf.range(seq_len, dtype=tf.int64)
+  seg_a_len = example.pop("seg_a_len")
+  target_patch = example.pop("target_patch")
+  cls_pad = tf.fill(shape[:-1] + [1], tf.constant(CLS_ID, dtype=tf.int64))
+  target = tf.concat([inputs[..., 1:], cls_pad], -1)
+  a_end = tf.cast(tf.equal(pos, seg_a_len - 2), tf.int64)
+  b_end = tf.cast(tf.equal(pos, seq_len - 3), tf.int64)
+  target = (target * (1 - a_end) * (1 - b_end) +
+            target_patch[..., 0:1] * a_end + target_patch[..., 1:2] * b_end)
+
+  example["seg_id"] = (tf.cast(pos >= seg_a_len, tf.int64) +
+                       tf.cast(pos >= seq_len - 1, tf.int64))
+
+  # `np.packbits` order: the first element is the most significant bit
+  packed = tf.io.decode_raw(example.pop("is_masked"), tf.uint8)
+  shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+  bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(packed[..., None],
+                                                       shifts), 1)
+  bits = tf.reshape(bits, shape[:-1] + [-1])[..., :seq_len]
+  is_masked = tf.reshape(tf.cast(bits, tf.bool), shape)
+
+  return inputs, target, is_masked
+
+
+def _local_perm_batch(inputs, targets, is_masked, perm_size, seq_len, bsz,
+                      compact_masks=False):
+  """Batched version of `_local_perm`.
+
+  Every example samples its own permutation. All inputs are in shape
+  [bsz, seq_len] and `perm_mask` is returned in shape [bsz, seq_len, seq_len],
+  or the permutation ranks in shape [bsz, seq_len] if `compact_masks`.
+  """
+
+  # Generate permutation indices: the same random permutation of the
+  # positions within each block of `perm_size`, as in `_local_perm`
+  perm = tf.nn.top_k(tf.random_uniform([bsz, perm_size]), k=perm_size).indices
+  index = (tf.range(seq_len // perm_size)[None, :, None] * perm_size +
+           perm[:, None, :])
+  index = tf.cast(tf.reshape(index, [bsz, seq_len]), tf.int64)
+
+  # `perm_mask` and `target_mask`
+  # non-functional tokens
+  non_func_tokens = tf.logical_not(tf.logical_or(
+      tf.equal(inputs, SEP_ID),
+      tf.equal(inputs, CLS_ID)))
+
+  non_mask_tokens = tf.logical_and(tf.logical_not(is_masked), non_func_tokens)
+  masked_or_func_tokens = tf.logical_not(non_mask_tokens)
+
+  smallest_index = -tf.ones([bsz, seq_len], dtype=tf.int64)
+  rev_index = tf.where(non_mask_tokens, smallest_index, index)
+
+  target_tokens = tf.logical_and(masked_or_func_tokens, non_func_tokens)
+  target_mask = tf.cast(target_tokens, tf.float32)
+
+  if compact_masks:
+    perm_mask = rev_index
   else:
-    host_id = 0
+    self_rev_index = tf.where(target_tokens, rev_index, rev_index + 1)
 
-    #### Function used to parse tfrecord
-  def parser(record):
-    """function used to parse tfrecord."""
+    perm_mask = tf.logical_and(
+        self_rev_index[:, :, None] <= rev_index[:, None, :],
+        masked_or_func_tokens[:, None, :])
+    perm_mask = tf.cast(perm_mask, tf.float32)
+
+  new_targets = tf.concat([inputs[:, 0: 1], targets[:, : -1]],
+                          axis=1)
 
-    record_spec = {
-        "input": tf.FixedLenFeature([seq_len], tf.int64),
-        "target": tf.FixedLenFeature([seq_len], tf.int64),
-        "seg_id": tf.FixedLenFeature([seq_len], tf.int64),
+  # construct inputs_k
+  inputs_k = inputs
+
+  # construct inputs_q
+  inputs_q = target_mask
+
+  return perm_mask, new_targets, target_mask, inputs_k, inputs_q
+
+
+def _get_record_spec(seq_len, record_format):
+  if record_format == "compact":
+    return {
+        "input": tf.FixedLenFeature([], tf.string),
+        "target_patch": tf.FixedLenFeature([2], tf.int64),
+        "seg_a_len": tf.FixedLenFeature([1], tf.int64),
         "label": tf.FixedLenFeature([1], tf.int64),
-        "is_masked": tf.FixedLenFeature([seq_len], tf.int64),
+        "is_masked": tf.FixedLenFeature([], tf.string),
     }
+  return {
+      "input": tf.FixedLenFeature([seq_len], tf.int64),
+      "target": tf.FixedLenFeature([seq_len], tf.int64),
+      "seg_id": tf.FixedLenFeature([seq_len], tf.int64),
+      "label": tf.FixedLenFeature([1], tf.int64),
+      "is_masked": tf.FixedLenFeature([seq_len], tf.int64),
+  }
+
 
-    # retrieve serialized example
+def _parse_records(records, seq_len, record_format, batch_size=None):
+  """Parse a serialized record, or a batch of `batch_size` records, of
+  `record_format` into the same Tensors for both formats.
+
+  Returns:
+    example: dict of the remaining features (`seg_id`, `label`).
+    inputs, target: int64 Tensors in shape [seq_len].
+    is_masked: bool Tensor in shape [seq_len].
+  All shapes get a leading batch dim if `batch_size` is not None.
+  """
+  record_spec = _get_record_spec(seq_len, record_format)
+
+  # retrieve serialized examples
+  if batch_size is None:
     example = tf.parse_single_example(
-        serialized=record,
+        serialized=records,
+        features=record_spec)
+  else:
+    example = tf.parse_example(
+        serialized=records,
         features=record_spec)
 
+  if record_format == "compact":
+    inputs, target, is_masked = _decode_compact_example(
+        example, seq_len, batch_size)
+  else:
     inputs = example.pop("input")
     target = example.pop("target")
     is_masked = tf.cast(example.pop("is_masked"), tf.bool)
 
+  return example, inputs, target, is_masked
+
+
+def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
+                num_batch, seq_len, reuse_len, perm_size, mask_alpha,
+                mask_beta, use_bfloat16=False, num_predict=None,
+                record_format="int64", num_parallel_calls=None,
+                prefetch_to_device=None, compact_masks=False,
+                record_cache="memory", record_cache_dir=None,
+                record_cache_mb=None):
+
+  bsz_per_core = params["batch_size"]
+  if num_hosts > 1:
+    host_id = params["context"].current_host
+  else:
+    host_id = 0
+
+    #### Function used to parse tfrecord
+  def parser(record):
+    """function used to parse tfrecord."""
+
+    example, inputs, target, is_masked = _parse_records(
+        record, seq_len, record_format)
+
     non_reuse_len = seq_len - reuse_len
     assert perm_size <= reuse_len and perm_size <= non_reuse_len
 
@@ -682,20 +1825,25 @@ def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
         target[:reuse_len],
         is_masked[:reuse_len],
         perm_size,
-        reuse_len)
+        reuse_len,
+        compact_masks)
 
     perm_mask_1, target_1, target_mask_1, input_k_1, input_q_1 = _local_perm(
         inputs[reuse_len:],
         target[reuse_len:],
         is_masked[reuse_len:],
         perm_size,
-        non_reuse_len)
+        non_reuse_len,
+        compact_masks)
 
-    perm_mask_0 = tf.concat([perm_mask_0, tf.ones([reuse_len, non_reuse_len])],
-                            axis=1)
-    perm_mask_1 = tf.concat([tf.zeros([non_reuse_len, reuse_len]), perm_mask_1],
-                            axis=1)
-    perm_mask = tf.concat([perm_mask_0, perm_mask_1], axis=0)
+    if compact_masks:
+      perm_rank = tf.concat([perm_mask_0, perm_mask_1], axis=0)
+    else:
+      perm_mask_0 = tf.concat(
+          [perm_mask_0, tf.ones([reuse_len, non_reuse_len])], axis=1)
+      perm_mask_1 = tf.concat(
+          [tf.zeros([non_reuse_len, reuse_len]), perm_mask_1], axis=1)
+      perm_mask = tf.concat([perm_mask_0, perm_mask_1], axis=0)
     target = tf.concat([target_0, target_1], axis=0)
     target_mask = tf.concat([target_mask_0, target_mask_1], axis=0)
     input_k = tf.concat([input_k_0, input_k_1], axis=0)
@@ -711,11 +1859,16 @@ def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
       pad_len = num_predict - actual_num_predict
 
       ##### target_mapping
-      target_mapping = tf.one_hot(indices, seq_len, dtype=tf.float32)
-      paddings = tf.zeros([pad_len, seq_len], dtype=target_mapping.dtype)
-      target_mapping = tf.concat([target_mapping, paddings], axis=0)
-      example["target_mapping"] = tf.reshape(target_mapping,
-                                             [num_predict, seq_len])
+      if compact_masks:
+        paddings = tf.fill([pad_len], tf.constant(seq_len, dtype=tf.int64))
+        target_index = tf.concat([indices, paddings], axis=0)
+        example["target_index"] = tf.reshape(target_index, [num_predict])
+      else:
+        target_mapping = tf.one_hot(indices, seq_len, dtype=tf.float32)
+        paddings = tf.zeros([pad_len, seq_len], dtype=target_mapping.dtype)
+        target_mapping = tf.concat([target_mapping, paddings], axis=0)
+        example["target_mapping"] = tf.reshape(target_mapping,
+                                               [num_predict, seq_len])
 
       ##### target
       target = tf.boolean_mask(target, bool_target_mask)
@@ -734,7 +1887,10 @@ def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
       example["target_mask"] = tf.reshape(target_mask, [seq_len])
 
     # reshape back to fixed shape
-    example["perm_mask"] = tf.reshape(perm_mask, [seq_len, seq_len])
+    if compact_masks:
+      example["perm_rank"] = tf.reshape(perm_rank, [seq_len])
+    else:
+      example["perm_mask"] = tf.reshape(perm_mask, [seq_len, seq_len])
     example["input_k"] = tf.reshape(input_k, [seq_len])
     example["input_q"] = tf.reshape(input_q, [seq_len])
 
@@ -745,6 +1901,97 @@ def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
 
     return example
 
+  def batched_parser(records):
+    """function used to parse a batch of `bsz_per_core` tfrecords."""
+
+    example, inputs, target, is_masked = _parse_records(
+        records, seq_len, record_format, bsz_per_core)
+
+    non_reuse_len = seq_len - reuse_len
+    assert perm_size <= reuse_len and perm_size <= non_reuse_len
+
+    perm_mask_0, target_0, target_mask_0, input_k_0, input_q_0 = (
+        _local_perm_batch(
+            inputs[:, :reuse_len],
+            target[:, :reuse_len],
+            is_masked[:, :reuse_len],
+            perm_size,
+            reuse_len,
+            bsz_per_core,
+            compact_masks))
+
+    perm_mask_1, target_1, target_mask_1, input_k_1, input_q_1 = (
+        _local_perm_batch(
+            inputs[:, reuse_len:],
+            target[:, reuse_len:],
+            is_masked[:, reuse_len:],
+            perm_size,
+            non_reuse_len,
+            bsz_per_core,
+            compact_masks))
+
+    if compact_masks:
+      perm_rank = tf.concat([perm_mask_0, perm_mask_1], axis=1)
+    else:
+      perm_mask_0 = tf.concat(
+          [perm_mask_0, tf.ones([bsz_per_core, reuse_len, non_reuse_len])],
+          axis=2)
+      perm_mask_1 = tf.concat(
+          [tf.zeros([bsz_per_core, non_reuse_len, reuse_len]), perm_mask_1],
+          axis=2)
+      perm_mask = tf.concat([perm_mask_0, perm_mask_1], axis=1)
+    target = tf.concat([target_0, target_1], axis=1)
+    target_mask = tf.concat([target_mask_0, target_mask_1], axis=1)
+    input_k = tf.concat([input_k_0, input_k_1], axis=1)
+    input_q = tf.concat([input_q_0, input_q_1], axis=1)
+
+    if num_predict is not None:
+      # the first `num_predict` target positions of each example, padded
+      # with out-of-range positions whose one-hot rows are all zeros
+      indices = tf.range(seq_len, dtype=tf.int64)[None, :]
+      non_target = 1 - tf.cast(target_mask, tf.int64)
+      indices = -tf.nn.top_k(-(indices + seq_len * non_target),
+                             k=num_predict).values
+      is_target = indices < seq_len
+
+      ##### target_mapping
+      if compact_masks:
+        example["target_index"] = tf.reshape(
+            tf.minimum(indices, seq_len), [bsz_per_core, num_predict])
+      else:
+        target_mapping = tf.one_hot(indices, seq_len, dtype=tf.float32)
+        example["target_mapping"] = tf.reshape(
+            target_mapping, [bsz_per_core, num_predict, seq_len])
+
+      ##### target
+      target = tf.batch_gather(target, tf.minimum(indices, seq_len - 1))
+      target = target * tf.cast(is_target, target.dtype)
+      example["target"] = tf.reshape(target, [bsz_per_core, num_predict])
+
+      ##### target mask
+      example["target_mask"] = tf.reshape(
+          tf.cast(is_target, tf.float32), [bsz_per_core, num_predict])
+    else:
+      example["target"] = tf.reshape(target, [bsz_per_core, seq_len])
+      example["target_mask"] = tf.reshape(target_mask,
+                                          [bsz_per_core, seq_len])
+
+    # reshape back to fixed shape
+    if compact_masks:
+      example["perm_rank"] = tf.reshape(perm_rank, [bsz_per_core, seq_len])
+    else:
+      example["perm_mask"] = tf.reshape(perm_mask,
+                                        [bsz_per_core, seq_len, seq_len])
+    example["input_k"] = tf.reshape(input_k, [bsz_per_core, seq_len])
+    example["input_q"] = tf.reshape(input_q, [bsz_per_core, seq_len])
+
+    _convert_example(example, use_bfloat16)
+
+    for k, v in example.items():
+      tf.logging.info("%s: %s", k, v)
+
+    return example
+
   # Get dataset
   dataset = parse_files_to_dataset(
       parser=parser,
@@ -754,7 +2001,13 @@ def get_dataset(params, num_hosts, num_core_per_host, split, file_names,
       num_hosts=num_hosts,
       host_id=host_id,
       num_core_per_host=num_core_per_host,
-      bsz_per_core=bsz_per_core)
+      bsz_per_core=bsz_per_core,
+      batched_parser=batched_parser,
+      num_parallel_calls=num_parallel_calls,
+      prefetch_to_device=prefetch_to_device,
+      record_cache=record_cache,
+      record_cache_dir=record_cache_dir,
+      record_cache_mb=record_cache_mb)
 
   return dataset
 
@@ -774,7 +2027,14 @@ def get_input_fn(
     uncased=False,
     num_passes=None,
     use_bfloat16=False,
-    num_predict=None):
+    num_predict=None,
+    record_format="int64",
+    num_parallel_calls=None,
+    prefetch_to_device=None,
+    compact_masks=False,
+    record_cache="memory",
+    record_cache_dir=None,
+    record_cache_mb=None):
 
   # Merge all record infos into a single one
   record_glob_base = format_filename(
@@ -789,40 +2049,66 @@ def get_input_fn(
       uncased=uncased,
       fixed_num_predict=num_predict)
 
+  manifest_name = _manifest_name(
+      split=split,
+      bsz_per_host=bsz_per_host,
+      seq_len=seq_len,
+      bi_data=bi_data,
+      mask_alpha=mask_alpha,
+      mask_beta=mask_beta,
+      reuse_len=reuse_len,
+      uncased=uncased,
+      fixed_num_predict=num_predict)
+
   record_info = {"num_batch": 0, "filenames": []}
 
   tfrecord_dirs = tfrecord_dir.split(",")
   tf.logging.info("Use the following tfrecord dirs: %s", tfrecord_dirs)
 
   for idx, record_dir in enumerate(tfrecord_dirs):
-    record_glob = os.path.join(record_dir, record_glob_base)
-    tf.logging.info("[%d] Record glob: %s", idx, record_glob)
-
-    record_paths = sorted(tf.gfile.Glob(record_glob))
-    tf.logging.info("[%d] Num of record info path: %d",
-                    idx, len(record_paths))
-
     cur_record_info = {"num_batch": 0, "filenames": []}
 
-    for record_info_path in record_paths:
-      if num_passes is not None:
-        record_info_name = os.path.basename(record_info_path)
-        fields = record_info_name.split(".")[0].split("-")
-        pass_id = int(fields[-1])
-        if len(fields) == 5 and pass_id >= num_passes:
-          tf.logging.info("Skip pass %d: %s", pass_id, record_info_name)
-          continue
-
-      with tf.gfile.Open(record_info_path, "r") as fp:
-        info = json.load(fp)
-        if num_passes is not None:
-          eff_num_passes = min(num_passes, len(info["filenames"]))
-          ratio = eff_num_passes / len(info["filenames"])
-          cur_record_info["num_batch"] += int(info["num_batch"] * ratio)
-          cur_record_info["filenames"] += info["filenames"][:eff_num_passes]
-        else:
+    manifest_path = os.path.join(record_dir, manifest_name)
+    if tf.gfile.Exists(manifest_path):
+      # incremental mode: all record files are listed in the manifest
+      tf.logging.info("[%d] Use manifest: %s", idx, manifest_path)
+      with tf.gfile.Open(manifest_path, "r") as fp:
+        manifest = json.load(fp)
+      for _, group in sorted(manifest["groups"].items(),
+                             key=lambda x: int(x[0])):
+        for pass_id, info in sorted(group["passes"].items(),
+                                    key=lambda x: int(x[0])):
+          if num_passes is not None and int(pass_id) >= num_passes:
+            continue
           cur_record_info["num_batch"] += info["num_batch"]
           cur_record_info["filenames"] += info["filenames"]
+    else:
+      record_glob = os.path.join(record_dir, record_glob_base)
+      tf.logging.info("[%d] Record glob: %s", idx, record_glob)
+
+      record_paths = sorted(tf.gfile.Glob(record_glob))
+      tf.logging.info("[%d] Num of record info path: %d",
+                      idx, len(record_paths))
+
+      for record_info_path in record_paths:
+        if num_passes is not None:
+          record_info_name = os.path.basename(record_info_path)
+          fields = record_info_name.split(".")[0].split("-")
+          pass_id = int(fields[-1])
+          if len(fields) == 5 and pass_id >= num_passes:
+            tf.logging.info("Skip pass %d: %s", pass_id, record_info_name)
+            continue
+
+        with tf.gfile.Open(record_info_path, "r") as fp:
+          info = json.load(fp)
+          if num_passes is not None:
+            eff_num_passes = min(num_passes, len(info["filenames"]))
+            ratio = eff_num_passes / len(info["filenames"])
+            cur_record_info["num_batch"] += int(info["num_batch"] * ratio)
+            cur_record_info["filenames"] += info["filenames"][:eff_num_passes]
+          else:
+            cur_record_info["num_batch"] += info["num_batch"]
+            cur_record_info["filenames"] += info["filenames"]
 
     # overwrite directory for `cur_record_info`
     new_filenames = []
@@ -865,7 +2151,14 @@ def get_input_fn(
         mask_alpha=mask_alpha,
         mask_beta=mask_beta,
         use_bfloat16=use_bfloat16,
-        num_predict=num_predict)
+        num_predict=num_predict,
+        record_format=record_format,
+        num_parallel_calls=num_parallel_calls,
+        prefetch_to_device=prefetch_to_device,
+        compact_masks=compact_masks,
+        record_cache=record_cache,
+        record_cache_dir=record_cache_dir,
+        record_cache_mb=record_cache_mb)
 
     return dataset
 
@@ -896,6 +2189,10 @@ if __name__ == "__main__":
                     help="Whether the input is raw text or encoded ids.")
   flags.DEFINE_integer("num_predict", default=85,
                        help="Num of tokens to predict.")
+  flags.DEFINE_enum("record_format", "int64", ["int64", "compact"],
+                    help="Layout of the tfrecords. `compact` stores uint16 "
+                    "ids as bytes, derives the target from the input and "
+                    "bit-packs the masks.")
 
   flags.DEFINE_string("input_glob", "data/example/*.txt",
                       help="Input file glob.")
@@ -907,9 +2204,23 @@ if __name__ == "__main__":
 
   flags.DEFINE_integer("pass_id", 0, help="ID of the current pass."
                        "Different passes sample different negative segment.")
+  flags.DEFINE_integer("num_passes", 1, help="Number of passes to create, "
+                       "with IDs starting from `pass_id`. The input is only "
+                       "tokenized once for all of them.")
   flags.DEFINE_integer("num_task", 1, help="Number of total tasks.")
   flags.DEFINE_integer("task", 0, help="The Task ID. This value is used when "
                        "using multiple workers to identify each worker.")
+  flags.DEFINE_string("token_store_dir", "", help="Local scratch dir. If set, "
+                      "tokenized shards are streamed into memory-mapped token "
+                      "stores there instead of being kept in memory. The "
+                      "stores are cached by input content, sentence piece "
+                      "model and tokenization flags across passes and runs.")
+  flags.DEFINE_bool("incremental", False, help="Keep a manifest of processed "
+                    "input files in the tfrecord dir and only process new or "
+                    "changed files. Requires `num_task` to be 1.")
+  flags.DEFINE_integer("num_workers", 1, help="Number of local processes used "
+                       "by this task. Input files are dynamically assigned to "
+                       "idle workers and the record infos are merged.")
 
   tf.logging.set_verbosity(tf.logging.INFO)
   tf.app.run(create_data)
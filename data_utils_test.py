@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import data_utils
+
+
+class _Vocab(object):
+  """Stands for a SentencePieceProcessor: every third piece starts a word."""
+
+  def __init__(self, size):
+    self.pieces = [("▁w{}" if i % 3 == 0 else "w{}").format(i)
+                   for i in range(size)]
+
+  def IdToPiece(self, i):
+    return self.pieces[i]
+
+  def GetPieceSize(self):
+    return len(self.pieces)
+
+
+_MaskFlags = collections.namedtuple("_MaskFlags", ["mask_alpha", "mask_beta"])
+
+
+class SampleMaskTest(tf.test.TestCase):
+
+  num_samples = 2000
+
+  def setUp(self):
+    super(SampleMaskTest, self).setUp()
+    self._flags = getattr(data_utils, "FLAGS", None)
+    data_utils.FLAGS = _MaskFlags(mask_alpha=6, mask_beta=1)
+
+    self.sp = _Vocab(60)
+    self.is_start_table = data_utils.build_start_piece_table(self.sp)
+    self.seg = np.random.RandomState(0).randint(
+        0, self.sp.GetPieceSize(), size=96)
+
+  def tearDown(self):
+    data_utils.FLAGS = self._flags
+    super(SampleMaskTest, self).tearDown()
+
+  def _sample(self, reverse, goal_num_predict):
+    np.random.seed(1)
+    masks = [data_utils._sample_mask(self.sp, self.seg, reverse=reverse,
+                                     goal_num_predict=goal_num_predict)
+             for _ in range(self.num_samples)]
+
+    np.random.seed(2)
+    segs = np.tile(self.seg[None], [self.num_samples, 1])
+    batch_masks = data_utils._sample_mask_batch(
+        self.is_start_table, segs, [reverse] * self.num_samples,
+        mask_alpha=6, mask_beta=1, goal_num_predict=goal_num_predict)
+
+    return np.array(masks), batch_masks
+
+  def _assert_same_distribution(self, masks, batch_masks):
+    # the number of masked tokens per row
+    counts = masks.sum(axis=1)
+    batch_counts = batch_masks.sum(axis=1)
+    std_err = np.sqrt((counts.var() + batch_counts.var()) / self.num_samples)
+    self.assertLessEqual(abs(counts.mean() - batch_counts.mean()),
+                         5 * std_err + 1e-6)
+
+    # the probability of each position to be masked
+    p = masks.mean(axis=0)
+    batch_p = batch_masks.mean(axis=0)
+    pooled = (p + batch_p) / 2
+    std_err = np.sqrt(2 * pooled * (1 - pooled) / self.num_samples)
+    self.assertTrue(np.all(np.abs(p - batch_p) <= 5 * std_err + 1e-6))
+
+  def test_span_masks(self):
+    for reverse in [False, True]:
+      masks, batch_masks = self._sample(reverse, None)
+      self.assertEqual(masks.shape, batch_masks.shape)
+      self._assert_same_distribution(masks, batch_masks)
+
+  def test_goal_num_predict(self):
+    for reverse in [False, True]:
+      masks, batch_masks = self._sample(reverse, 15)
+      # the last span can overshoot the goal, as in `_sample_mask`
+      self.assertTrue(np.all(masks.sum(axis=1) >= 15))
+      self.assertTrue(np.all(batch_masks.sum(axis=1) >= 15))
+      self._assert_same_distribution(masks, batch_masks)
+
+  def test_span_starts(self):
+    # spans begin at word starts, as in `_sample_mask`
+    _, batch_masks = self._sample(False, None)
+    span_begins = batch_masks & ~np.pad(batch_masks[:, :-1], [[0, 0], [1, 0]],
+                                        "constant")
+    self.assertTrue(np.all(self.is_start_table[self.seg][
+        np.nonzero(span_begins)[1]]))
+
+
+class ShardRecordsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(ShardRecordsTest, self).setUp()
+    # data_utils is written against the TF 1.x API
+    self._tf = data_utils.tf
+    data_utils.tf = tf.compat.v1
+
+  def tearDown(self):
+    data_utils.tf = self._tf
+    super(ShardRecordsTest, self).tearDown()
+
+  def _write_indices(self, num_records):
+    file_names = []
+    for i, file_num_records in enumerate(num_records):
+      path = os.path.join(self.get_temp_dir(), "{}.tfrecords".format(i))
+      data_utils.write_record_index(path, file_num_records)
+      file_names.append(path)
+    return file_names
+
+  def test_hosts_get_equal_shares(self):
+    rng = np.random.RandomState(0)
+    for num_files, num_hosts, unit in [(1, 4, 8), (3, 2, 4), (7, 8, 16),
+                                       (12, 5, 3), (5, 3, 1)]:
+      num_records = rng.randint(0, 200, size=num_files).tolist()
+      file_names = self._write_indices(num_records)
+      file_starts = dict(zip(file_names, np.cumsum([0] + num_records[:-1])))
+
+      host_records = []
+      for host_id in range(num_hosts):
+        file_slices = data_utils.shard_records(file_names, num_hosts,
+                                               host_id, unit=unit)
+        records = []
+        for path, skip, take in file_slices:
+          self.assertGreater(take, 0)
+          self.assertLessEqual(
+              skip + take, num_records[file_names.index(path)])
+          records.extend(range(file_starts[path] + skip,
+                               file_starts[path] + skip + take))
+        host_records.append(records)
+
+      # whole units, differing by at most one unit (batch) between hosts
+      counts = [len(records) for records in host_records]
+      self.assertTrue(all(count % unit == 0 for count in counts))
+      self.assertLessEqual(max(counts) - min(counts), unit)
+
+      # consecutive, disjoint slices covering all the whole units
+      all_records = sum(host_records, [])
+      num_kept = sum(num_records) // unit * unit
+      self.assertEqual(all_records, list(range(num_kept)))
+
+  def test_missing_index(self):
+    file_names = self._write_indices([10, 20])
+    file_names.append(os.path.join(self.get_temp_dir(), "no_index.tfrecords"))
+    self.assertIsNone(data_utils.shard_records(file_names, 2, 0))
+
+
+class RecordCacheTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(RecordCacheTest, self).setUp()
+    # data_utils is written against the TF 1.x API
+    self._tf = data_utils.tf
+    data_utils.tf = tf.compat.v1
+
+  def tearDown(self):
+    data_utils.tf = self._tf
+    super(RecordCacheTest, self).tearDown()
+
+  def _write_file(self, name, num_records, record_size=1000):
+    path = os.path.join(self.get_temp_dir(), name)
+    records = [(name + str(i)).encode("utf-8").ljust(record_size, b".")
+               for i in range(num_records)]
+    with tf.io.TFRecordWriter(path) as writer:
+      for record in records:
+        writer.write(record)
+    return path, records
+
+  def _read_epochs(self, cache, file_slices, num_epochs=3):
+    for _ in range(num_epochs):
+      records = []
+      for path, skip, take in file_slices:
+        records.extend(cache.read(path, skip, take))
+      yield records
+
+  def test_file_larger_than_budget(self):
+    small_path, small_records = self._write_file("small", 10)
+    large_path, large_records = self._write_file("large", 100)
+    cache = data_utils.RecordCache(max_bytes=30 * 1000)
+
+    file_slices = [(large_path, 0, -1), (small_path, 2, 5)]
+    for records in self._read_epochs(cache, file_slices):
+      self.assertEqual(records, large_records + small_records[2:7])
+      self.assertLessEqual(cache.num_bytes, cache.max_bytes)
+
+    # the small slice is cached, the large file is streamed in every epoch
+    self.assertEqual(cache.num_hit, 2)
+    self.assertEqual(cache.num_miss, 4)
+
+  def test_cyclic_reads_over_budget(self):
+    files = [self._write_file(name, 10) for name in ["a", "b", "c"]]
+    # two of the three files fit
+    cache = data_utils.RecordCache(max_bytes=25 * 1100)
+
+    file_slices = [(path, 0, -1) for path, _ in files]
+    for records in self._read_epochs(cache, file_slices):
+      self.assertEqual(records, sum([records for _, records in files], []))
+      self.assertLessEqual(cache.num_bytes, cache.max_bytes)
+
+    self.assertEqual(cache.num_hit, 4)
+    self.assertEqual(cache.num_miss, 5)
+
+
+if __name__ == "__main__":
+  tf.test.main()
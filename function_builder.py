@@ -57,13 +57,21 @@ def two_stream_loss(FLAGS, features, labels, mems, is_training):
   seg_id = tf.transpose(features["seg_id"], [1, 0])
 
   inp_mask = None
-  perm_mask = tf.transpose(features["perm_mask"], [1, 2, 0])
+  perm_mask, perm_rank = None, None
+  if "perm_rank" in features:
+    # compact masks: the dense masks are built inside the model
+    perm_rank = tf.transpose(features["perm_rank"], [1, 0])
+  else:
+    perm_mask = tf.transpose(features["perm_mask"], [1, 2, 0])
 
+  target_mapping, target_index = None, None
   if FLAGS.num_predict is not None:
-    # [num_predict x tgt_len x bsz]
-    target_mapping = tf.transpose(features["target_mapping"], [1, 2, 0])
-  else:
-    target_mapping = None
+    if "target_index" in features:
+      # [num_predict x bsz]
+      target_index = tf.transpose(features["target_index"], [1, 0])
+    else:
+      # [num_predict x tgt_len x bsz]
+      target_mapping = tf.transpose(features["target_mapping"], [1, 2, 0])
 
   # target for LM loss
   tgt = tf.transpose(features["target"], [1, 0])
@@ -87,7 +95,9 @@ def two_stream_loss(FLAGS, features, labels, mems, is_training):
       mems=mems,
       perm_mask=perm_mask,
       target_mapping=target_mapping,
-      inp_q=inp_q)
+      inp_q=inp_q,
+      perm_rank=perm_rank,
+      target_index=target_index)
 
   output = xlnet_model.get_sequence_output()
   new_mems = {mem_name: xlnet_model.get_new_memory()}
@@ -132,14 +142,32 @@ def get_loss(FLAGS, features, labels, mems, is_training):
 
 def get_classification_loss(
     FLAGS, features, n_class, is_training):
-  """Loss for downstream classification tasks."""
+  """Loss for downstream classification tasks.
 
-  bsz_per_core = tf.shape(features["input_ids"])[0]
+  The sequence length of `features` can vary from batch to batch, e.g. with
+  length-bucketed batches, as long as the inputs are left-padded.
+
+  Features with `pack_ids` hold several examples per sequence (see
+  `classifier_utils.pack_features`): a block-diagonal `perm_mask` keeps the
+  examples from attending to each other, each example is pooled at its own
+  `cls_index`, and the loss is averaged over the real examples.
+  """
+
+  is_packed = "pack_ids" in features
 
   inp = tf.transpose(features["input_ids"], [1, 0])
   seg_id = tf.transpose(features["segment_ids"], [1, 0])
   inp_mask = tf.transpose(features["input_mask"], [1, 0])
-  label = tf.reshape(features["label_ids"], [bsz_per_core])
+  label = tf.reshape(features["label_ids"], [-1])
+
+  perm_mask = None
+  if is_packed:
+    if FLAGS.summary_type != "last":
+      raise ValueError("Packed sequences only support summary_type `last`.")
+    pack_ids = tf.transpose(features["pack_ids"], [1, 0])
+    # 1 where i and j belong to different examples, [len, len, bsz]
+    perm_mask = tf.cast(tf.not_equal(pack_ids[:, None], pack_ids[None, :]),
+                        inp_mask.dtype)
 
   xlnet_config = xlnet.XLNetConfig(json_path=FLAGS.model_config_path)
   run_config = xlnet.create_run_config(is_training, True, FLAGS)
@@ -149,9 +177,15 @@ def get_classification_loss(
       run_config=run_config,
       input_ids=inp,
       seg_ids=seg_id,
-      input_mask=inp_mask)
+      input_mask=inp_mask,
+      perm_mask=perm_mask)
 
-  summary = xlnet_model.get_pooled_out(FLAGS.summary_type, FLAGS.use_summ_proj)
+  if is_packed:
+    summary = xlnet_model.get_pooled_out_at(features["cls_index"],
+                                            FLAGS.use_summ_proj)
+  else:
+    summary = xlnet_model.get_pooled_out(FLAGS.summary_type,
+                                         FLAGS.use_summ_proj)
 
   with tf.variable_scope("model", reuse=tf.AUTO_REUSE):
 
@@ -168,7 +202,13 @@ def get_classification_loss(
         scope=cls_scope,
         return_logits=True)
 
-    total_loss = tf.reduce_mean(per_example_loss)
+    if is_packed:
+      is_real = tf.cast(tf.reshape(features["is_real_example"], [-1]),
+                        per_example_loss.dtype)
+      total_loss = (tf.reduce_sum(per_example_loss * is_real) /
+                    tf.maximum(tf.reduce_sum(is_real), 1.))
+    else:
+      total_loss = tf.reduce_mean(per_example_loss)
 
     return total_loss, per_example_loss, logits
 
@@ -355,8 +395,45 @@ def get_qa_outputs(FLAGS, features, is_training):
   return return_dict
 
 
+def _encode_race_context(features, xlnet_config, run_config):
+  """Encode the article of each question once, for all of its 4 options.
+
+  Returns:
+    mems: list of n_layer float Tensors in shape [context_len, bsz * 4,
+      d_model], the input of each layer on the article, tiled to the options.
+    mem_mask: float32 Tensor in shape [context_len, bsz * 4].
+  """
+  bsz_per_core = tf.shape(features["context_ids"])[0]
+  context_ids = tf.transpose(features["context_ids"], [1, 0])
+  context_mask = tf.transpose(features["context_mask"], [1, 0])
+
+  context_model = xlnet.XLNetModel(
+      xlnet_config=xlnet_config,
+      run_config=run_config,
+      input_ids=context_ids,
+      seg_ids=tf.zeros_like(context_ids),
+      input_mask=context_mask)
+  # `hidden_states[i]` is the input of layer i in shape [bsz, len, d_model]
+  hidden_states, _ = context_model.get_hidden_states_out()
+
+  mems = []
+  for hidden in hidden_states[:xlnet_config.n_layer]:
+    hidden = tf.tile(hidden[:, None], [1, 4, 1, 1])
+    hidden = tf.reshape(hidden, [bsz_per_core * 4, -1, xlnet_config.d_model])
+    mems.append(tf.transpose(hidden, [1, 0, 2]))
+
+  mem_mask = tf.tile(context_mask[:, :, None], [1, 1, 4])
+  mem_mask = tf.reshape(mem_mask, [-1, bsz_per_core * 4])
+
+  return mems, mem_mask
+
+
 def get_race_loss(FLAGS, features, is_training):
-  """Loss for downstream multi-choice QA tasks such as RACE."""
+  """Loss for downstream multi-choice QA tasks such as RACE.
+
+  With `FLAGS.shared_context`, the article is encoded once per question and
+  used as the memory of the 4 shorter question-option sequences.
+  """
 
   bsz_per_core = tf.shape(features["input_ids"])[0]
 
@@ -374,12 +451,18 @@ def get_race_loss(FLAGS, features, is_training):
   xlnet_config = xlnet.XLNetConfig(json_path=FLAGS.model_config_path)
   run_config = xlnet.create_run_config(is_training, True, FLAGS)
 
+  mems, mem_mask = None, None
+  if FLAGS.shared_context:
+    mems, mem_mask = _encode_race_context(features, xlnet_config, run_config)
+
   xlnet_model = xlnet.XLNetModel(
       xlnet_config=xlnet_config,
       run_config=run_config,
       input_ids=inp,
       seg_ids=seg_id,
-      input_mask=inp_mask)
+      input_mask=inp_mask,
+      mems=mems,
+      mem_mask=mem_mask)
   summary = xlnet_model.get_pooled_out(FLAGS.summary_type, FLAGS.use_summ_proj)
 
   with tf.variable_scope("logits"):
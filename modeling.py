@@ -333,6 +333,33 @@ def _create_mask(qlen, mlen, dtype=tf.float32, same_length=False):
   return ret
 
 
+def _create_perm_mask(perm_rank, inp_q, reuse_len=None, dtype=tf.float32):
+  """create `perm_mask` [len, len, bsz] from permutation ranks [len, bsz].
+
+  A rank of -1 marks a non-masked token that every position can attend to.
+  Target tokens (`inp_q` = 1) cannot attend to themselves. The first
+  `reuse_len` positions and the rest are permuted separately: the reused
+  part cannot attend to the rest, while the rest can attend to all of the
+  reused part.
+  """
+  qlen = tf.shape(perm_rank)[0]
+  rank = tf.cast(perm_rank, tf.int32)
+  self_rank = rank + 1 - tf.cast(inp_q, tf.int32)
+
+  perm_mask = tf.logical_and(self_rank[:, None] <= rank[None, :],
+                             rank[None, :] >= 0)
+
+  if reuse_len is not None and reuse_len > 0:
+    is_reuse = tf.range(qlen) < reuse_len
+    same_part = tf.equal(is_reuse[:, None], is_reuse[None, :])
+    reuse_to_rest = tf.logical_and(is_reuse[:, None],
+                                   tf.logical_not(is_reuse[None, :]))
+    perm_mask = tf.logical_or(tf.logical_and(perm_mask, same_part[:, :, None]),
+                              reuse_to_rest[:, :, None])
+
+  return tf.cast(perm_mask, dtype=dtype)
+
+
 def _cache_mem(curr_out, prev_mem, mem_len, reuse_len=None):
   """cache hidden states into memory."""
   if mem_len is None or mem_len == 0:
@@ -535,7 +562,8 @@ def transformer_xl(inp_k, n_token, n_layer, d_model, n_head,
                 use_tpu=True, input_mask=None,
                 perm_mask=None, seg_id=None, reuse_len=None,
                 ff_activation='relu', target_mapping=None,
-                use_bfloat16=False, scope='transformer', **kwargs):
+                use_bfloat16=False, scope='transformer', perm_rank=None,
+                target_index=None, mem_mask=None, **kwargs):
   """
     Defines a Transformer-XL computation graph with additional
     support for XLNet.
@@ -549,6 +577,9 @@ def transformer_xl(inp_k, n_token, n_layer, d_model, n_head,
     mems: a list of float32 Tensors in shape [mem_len, bsz, d_model], memory
       from previous batches. The length of the list equals n_layer.
       If None, no memory is used.
+    mem_mask: float32 Tensor in shape [mem_len, bsz], the mask of `mems`.
+      0 for real tokens and 1 for padding. If None, all of `mems` can be
+      attended to.
     perm_mask: float32 Tensor in shape [len, len, bsz].
       If perm_mask[i, j, k] = 0, i attend to j in batch k;
       if perm_mask[i, j, k] = 1, i does not attend to j in batch k.
@@ -562,6 +593,14 @@ def transformer_xl(inp_k, n_token, n_layer, d_model, n_head,
       1 for tokens with losses and 0 for tokens without losses.
       Only used during pretraining for two-stream attention.
       Set to None during finetuning.
+    perm_rank: int32 Tensor in shape [len, bsz], the compact form of
+      `perm_mask`: the rank of each position in the factorization order,
+      -1 for tokens that can be attended to by all positions. The first
+      `reuse_len` positions and the rest are ranked separately.
+      If not None, `perm_mask` is built from it in the graph.
+    target_index: int32 Tensor in shape [num_predict, bsz], the compact form
+      of `target_mapping`: the position of each predict, `len` for padding.
+      If not None, `target_mapping` is built from it in the graph.
 
     n_layer: int, the number of layers.
     d_model: int, the hidden size.
@@ -627,6 +666,12 @@ def transformer_xl(inp_k, n_token, n_layer, d_model, n_head,
     else:
       raise ValueError('Unsupported attention type: {}'.format(attn_type))
 
+    # dense masks from their compact forms
+    if perm_rank is not None:
+      perm_mask = _create_perm_mask(perm_rank, inp_q, reuse_len, tf_float)
+    if target_index is not None:
+      target_mapping = tf.one_hot(target_index, qlen, axis=1, dtype=tf_float)
+
     # data mask: input mask & perm mask
     if input_mask is not None and perm_mask is not None:
       data_mask = input_mask[None] + perm_mask
@@ -637,10 +682,17 @@ def transformer_xl(inp_k, n_token, n_layer, d_model, n_head,
     else:
       data_mask = None
 
+    if data_mask is None and mem_mask is not None:
+      data_mask = tf.zeros([1, qlen, bsz], dtype=tf_float)
+
     if data_mask is not None:
-      # all mems can be attended to
-      mems_mask = tf.zeros([tf.shape(data_mask)[0], mlen, bsz],
-                           dtype=tf_float)
+      if mem_mask is not None:
+        mems_mask = tf.tile(tf.cast(mem_mask, tf_float)[None],
+                            [tf.shape(data_mask)[0], 1, 1])
+      else:
+        # all mems can be attended to
+        mems_mask = tf.zeros([tf.shape(data_mask)[0], mlen, bsz],
+                             dtype=tf_float)
       data_mask = tf.concat([mems_mask, data_mask], 1)
       if attn_mask is None:
         attn_mask = data_mask[:, :, :, None]
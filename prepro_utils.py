@@ -3,9 +3,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import hashlib
+import os
+import sqlite3
+import time
 import unicodedata
 import six
 from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from absl import flags
+import numpy as np
 
 
 SPIECE_UNDERLINE = '▁'
@@ -46,7 +55,58 @@ def print_(*args):
   print(*new_args)
 
 
+class _AccentStripTable(dict):
+  """Translation table from a character to its NFKD form without combining
+  characters, filled lazily as characters are looked up."""
+
+  def __missing__(self, ordinal):
+    char = six.unichr(ordinal)
+    stripped = ''.join([c for c in unicodedata.normalize('NFKD', char)
+                        if not unicodedata.combining(c)])
+    # `None` deletes the character in `translate`
+    self[ordinal] = stripped if stripped else None
+    return self[ordinal]
+
+
+# per-character normalization cache shared by all calls of `strip_accents`
+accent_strip_table = _AccentStripTable()
+
+
+def _is_ascii(text):
+  try:
+    text.encode('ascii')
+  except UnicodeError:
+    return False
+  return True
+
+
+def strip_accents(text):
+  """Same as NFKD normalization followed by removing combining characters.
+
+  Combining characters are all removed, so the canonical reordering of NFKD
+  does not matter and each character can be normalized on its own. ASCII
+  text is returned as is.
+  """
+  if _is_ascii(text):
+    return text
+  return text.translate(accent_strip_table)
+
+
+# single characters are preprocessed one at a time when aligning tokens
+_char_cache = {}
+
+
 def preprocess_text(inputs, lower=False, remove_space=True, keep_accents=False):
+  if len(inputs) == 1:
+    key = (inputs, lower, remove_space, keep_accents)
+    if key not in _char_cache:
+      _char_cache[key] = _preprocess_text(inputs, lower, remove_space,
+                                          keep_accents)
+    return _char_cache[key]
+  return _preprocess_text(inputs, lower, remove_space, keep_accents)
+
+
+def _preprocess_text(inputs, lower, remove_space, keep_accents):
   if remove_space:
     outputs = ' '.join(inputs.strip().split())
   else:
@@ -57,14 +117,30 @@ def preprocess_text(inputs, lower=False, remove_space=True, keep_accents=False):
     outputs = outputs.decode('utf-8')
 
   if not keep_accents:
-    outputs = unicodedata.normalize('NFKD', outputs)
-    outputs = ''.join([c for c in outputs if not unicodedata.combining(c)])
+    outputs = strip_accents(outputs)
   if lower:
     outputs = outputs.lower()
 
   return outputs
 
 
+def _is_digit_comma(piece):
+  return len(piece) > 1 and piece[-1] == ',' and piece[-2].isdigit()
+
+
+def _split_digit_comma(sp_model, piece):
+  """Split a piece like '▁2000,' into the pieces of '2000' and ','."""
+  cur_pieces = sp_model.EncodeAsPieces(
+      piece[:-1].replace(SPIECE_UNDERLINE, ''))
+  if piece[0] != SPIECE_UNDERLINE and cur_pieces[0][0] == SPIECE_UNDERLINE:
+    if len(cur_pieces[0]) == 1:
+      cur_pieces = cur_pieces[1:]
+    else:
+      cur_pieces[0] = cur_pieces[0][1:]
+  cur_pieces.append(piece[-1])
+  return cur_pieces
+
+
 def encode_pieces(sp_model, text, return_unicode=True, sample=False):
   # return_unicode is used only for py2
 
@@ -78,16 +154,8 @@ def encode_pieces(sp_model, text, return_unicode=True, sample=False):
     pieces = sp_model.SampleEncodeAsPieces(text, 64, 0.1)
   new_pieces = []
   for piece in pieces:
-    if len(piece) > 1 and piece[-1] == ',' and piece[-2].isdigit():
-      cur_pieces = sp_model.EncodeAsPieces(
-          piece[:-1].replace(SPIECE_UNDERLINE, ''))
-      if piece[0] != SPIECE_UNDERLINE and cur_pieces[0][0] == SPIECE_UNDERLINE:
-        if len(cur_pieces[0]) == 1:
-          cur_pieces = cur_pieces[1:]
-        else:
-          cur_pieces[0] = cur_pieces[0][1:]
-      cur_pieces.append(piece[-1])
-      new_pieces.extend(cur_pieces)
+    if _is_digit_comma(piece):
+      new_pieces.extend(_split_digit_comma(sp_model, piece))
     else:
       new_pieces.append(piece)
 
@@ -109,6 +177,297 @@ def encode_ids(sp_model, text, sample=False):
   return ids
 
 
+class BatchTokenizer(object):
+  """Tokenizes lists of texts into ids with a pool of threads.
+
+  The ids of each text are the same as
+  `encode_ids(sp_model, preprocess_text(text, ...))`, but the texts are
+  encoded directly into ids, chunk by chunk, and only the ids of pieces
+  like '▁2000,' are re-encoded through pieces as in `encode_pieces`.
+  """
+
+  def __init__(self, sp_model, lower=False, remove_space=True,
+               keep_accents=False, num_threads=None, chunk_size=256):
+    self.sp_model = sp_model
+    self.prepro_func = partial(preprocess_text, lower=lower,
+                               remove_space=remove_space,
+                               keep_accents=keep_accents)
+    self.num_threads = num_threads
+    self.chunk_size = chunk_size
+
+    # ids of the digit-comma pieces, mapped to the ids they are split into
+    self._split_ids = {}
+    for idx in range(sp_model.GetPieceSize()):
+      piece = sp_model.IdToPiece(idx)
+      if _is_digit_comma(piece):
+        self._split_ids[idx] = [
+            sp_model.PieceToId(cur_piece)
+            for cur_piece in _split_digit_comma(sp_model, piece)]
+
+    # sentencepiece >= 0.1.91 encodes a list of texts in one call
+    self._batch_api = hasattr(sp_model, 'encode')
+    self._pool = None
+
+  def _encode_chunk(self, texts):
+    texts = [self.prepro_func(text) for text in texts]
+    if six.PY2:
+      texts = [text.encode('utf-8') if isinstance(text, unicode) else text
+               for text in texts]
+
+    if self._batch_api:
+      all_ids = self.sp_model.encode(texts, out_type=int)
+    else:
+      all_ids = [self.sp_model.EncodeAsIds(text) for text in texts]
+
+    for i, ids in enumerate(all_ids):
+      if any(idx in self._split_ids for idx in ids):
+        new_ids = []
+        for idx in ids:
+          new_ids.extend(self._split_ids.get(idx, [idx]))
+        all_ids[i] = new_ids
+
+    return all_ids
+
+  def encode_ids(self, texts):
+    """Tokenize `texts` into ragged ids.
+
+    Returns:
+      ids: int32 array, the ids of all texts concatenated.
+      offsets: int64 array of len(texts) + 1, the ids of the i-th text are
+        ids[offsets[i]:offsets[i + 1]].
+    """
+    chunks = [texts[i:i + self.chunk_size]
+              for i in range(0, len(texts), self.chunk_size)]
+    if self.num_threads != 1 and len(chunks) > 1:
+      if self._pool is None:
+        self._pool = ThreadPool(self.num_threads)
+      chunk_ids = self._pool.map(self._encode_chunk, chunks)
+    else:
+      chunk_ids = [self._encode_chunk(chunk) for chunk in chunks]
+
+    all_ids = [ids for chunk in chunk_ids for ids in chunk]
+    offsets = np.zeros(len(all_ids) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in all_ids], out=offsets[1:])
+    ids = np.fromiter((idx for cur_ids in all_ids for idx in cur_ids),
+                      dtype=np.int32, count=offsets[-1])
+
+    return ids, offsets
+
+
+def token_cache_namespace(sp_model_file, uncased):
+  """Namespace of `TokenCache` entries for a tokenization setup."""
+  md5 = hashlib.md5()
+  with open(sp_model_file, 'rb') as fp:
+    md5.update(fp.read())
+  return '{}-{}'.format(md5.hexdigest(), uncased)
+
+
+class TokenCache(object):
+  """Content-addressed on-disk cache of tokenized texts, stored in SQLite.
+
+  Entries are keyed by the md5 of the text, the kind of output ("ids" or
+  "pieces") and `namespace`, which identifies the tokenization setup (see
+  `token_cache_namespace`).
+
+  Lookups only read the database. New entries and the access times of hits
+  are buffered and written every `commit_every` lookups in a short
+  transaction, so several processes can share the cache (the database is in
+  WAL mode). The total size of the values is kept in the `meta` table by
+  every write, and if `max_mb` is set, the least recently used entries
+  beyond it are evicted.
+  """
+
+  def __init__(self, path, namespace, max_mb=None, commit_every=1000):
+    self.path = path
+    self.namespace = namespace
+    self.max_bytes = max_mb * 2 ** 20 if max_mb else None
+    self.commit_every = commit_every
+    self.num_hit = 0
+    self.num_miss = 0
+
+    # transactions are explicit, see `flush`
+    self._conn = sqlite3.connect(path, timeout=600, isolation_level=None)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                       '(key BLOB PRIMARY KEY, value BLOB, atime INTEGER)')
+    self._conn.execute('CREATE INDEX IF NOT EXISTS tokens_atime '
+                       'ON tokens (atime)')
+    self._conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                       '(name TEXT PRIMARY KEY, value INTEGER)')
+    if self._num_bytes() is None:
+      # a cache written before the total was kept
+      self._conn.execute('BEGIN IMMEDIATE')
+      with self._conn:
+        self._conn.execute(
+            'INSERT OR IGNORE INTO meta SELECT ?, '
+            'COALESCE(SUM(LENGTH(value)), 0) FROM tokens', ('num_bytes',))
+    self._inserts = {}
+    self._touches = {}
+    atexit.register(self.close)
+
+  def _key(self, kind, text):
+    if isinstance(text, six.text_type):
+      text = text.encode('utf-8')
+    key = hashlib.md5(
+        '{}\x00{}\x00'.format(self.namespace, kind).encode('utf-8') + text)
+    return sqlite3.Binary(key.digest())
+
+  def get(self, kind, text):
+    """The cached `kind` outputs of `text`, or None if they are not cached."""
+    key = self._key(kind, text)
+    _, from_bytes = _TOKEN_CODECS[kind]
+    if key in self._inserts:
+      self.num_hit += 1
+      return from_bytes(bytes(self._inserts[key]))
+
+    row = self._conn.execute('SELECT value FROM tokens WHERE key = ?',
+                             (key,)).fetchone()
+    if row is None:
+      return None
+    self.num_hit += 1
+    self._touch(key)
+    return from_bytes(bytes(row[0]))
+
+  def put(self, kind, text, outputs):
+    """Add the `kind` outputs of `text`, which were not cached."""
+    to_bytes, _ = _TOKEN_CODECS[kind]
+    self.num_miss += 1
+    self._inserts[self._key(kind, text)] = sqlite3.Binary(to_bytes(outputs))
+    self._maybe_flush()
+
+  def _touch(self, key):
+    self._touches[key] = _now_us()
+    self._maybe_flush()
+
+  def _maybe_flush(self):
+    if len(self._inserts) + len(self._touches) >= self.commit_every:
+      self.flush()
+
+  def _lookup(self, kind, text, encode_fn):
+    outputs = self.get(kind, text)
+    if outputs is None:
+      outputs = encode_fn(text)
+      self.put(kind, text, outputs)
+    return outputs
+
+  def cached_ids(self, encode_fn):
+    """Wrap `encode_fn`, a function from a text to a list of ids."""
+    return partial(self._lookup, 'ids', encode_fn=encode_fn)
+
+  def cached_pieces(self, encode_fn):
+    """Wrap `encode_fn`, a function from a text to a list of pieces."""
+    return partial(self._lookup, 'pieces', encode_fn=encode_fn)
+
+  def _num_bytes(self):
+    row = self._conn.execute('SELECT value FROM meta WHERE name = ?',
+                             ('num_bytes',)).fetchone()
+    return None if row is None else row[0]
+
+  def _add_bytes(self, num_bytes):
+    self._conn.execute('UPDATE meta SET value = value + ? WHERE name = ?',
+                       (num_bytes, 'num_bytes'))
+
+  def _evict(self):
+    """Evict the least recently used entries beyond `max_bytes`. Only the
+    evicted rows are read, in the order of the atime index."""
+    total = self._num_bytes()
+    if total <= self.max_bytes:
+      return
+    evicted = []
+    for key, size in self._conn.execute(
+        'SELECT key, LENGTH(value) FROM tokens ORDER BY atime'):
+      if total <= self.max_bytes:
+        break
+      evicted.append((key,))
+      total -= size
+    self._conn.executemany('DELETE FROM tokens WHERE key = ?', evicted)
+    self._add_bytes(total - self._num_bytes())
+
+  def flush(self):
+    """Write the buffered entries and access times in one transaction."""
+    if not self._inserts and not self._touches:
+      return
+    atime = _now_us()
+    self._conn.execute('BEGIN IMMEDIATE')
+    with self._conn:  # commits, or rolls back on errors
+      # another process may have added the same entries since they were
+      # looked up, only count the new ones
+      num_bytes = 0
+      for key, value in self._inserts.items():
+        cursor = self._conn.execute(
+            'INSERT OR IGNORE INTO tokens VALUES (?, ?, ?)',
+            (key, value, atime))
+        num_bytes += len(value) * cursor.rowcount
+      self._add_bytes(num_bytes)
+      self._conn.executemany(
+          'UPDATE tokens SET atime = ? WHERE key = ?',
+          [(key_atime, key) for key, key_atime in self._touches.items()])
+      if self.max_bytes is not None:
+        self._evict()
+    self._inserts = {}
+    self._touches = {}
+
+  def close(self):
+    if self._conn is None:
+      return
+    self.flush()
+    self._conn.close()
+    self._conn = None
+
+
+def _ids_to_bytes(ids):
+  return np.asarray(ids, dtype=np.int32).tobytes()
+
+
+def _ids_from_bytes(value):
+  return np.frombuffer(value, dtype=np.int32).tolist()
+
+
+def _pieces_to_bytes(pieces):
+  return u'\x00'.join(pieces).encode('utf-8')
+
+
+def _pieces_from_bytes(value):
+  return value.decode('utf-8').split(u'\x00') if value else []
+
+
+# (to_bytes, from_bytes) of each kind of cached outputs
+_TOKEN_CODECS = {
+    'ids': (_ids_to_bytes, _ids_from_bytes),
+    'pieces': (_pieces_to_bytes, _pieces_from_bytes),
+}
+
+
+def _now_us():
+  """Access time of the cache entries, comparable across processes."""
+  return int(time.time() * 1e6)
+
+
+def open_token_cache(cache_dir, sp_model_file, uncased, max_mb=None):
+  """Open the `TokenCache` shared by all runs using `cache_dir`."""
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  return TokenCache(os.path.join(cache_dir, 'token_cache.sqlite'),
+                    token_cache_namespace(sp_model_file, uncased), max_mb)
+
+
+def define_token_cache_flags():
+  """Define the flags of `token_cache_from_flags`."""
+  flags.DEFINE_string('token_cache_dir', default=None,
+                      help='Local dir of the tokenization cache shared across '
+                      'runs. None for no cache.')
+  flags.DEFINE_integer('token_cache_mb', default=None,
+                       help='Size limit in MB of the tokenization cache.')
+
+
+def token_cache_from_flags(FLAGS):
+  """The `TokenCache` of `FLAGS.token_cache_dir`, or None for no cache."""
+  if not FLAGS.token_cache_dir:
+    return None
+  return open_token_cache(FLAGS.token_cache_dir, FLAGS.spiece_model_file,
+                          FLAGS.uncased, FLAGS.token_cache_mb)
+
+
 if __name__ == '__main__':
   import sentencepiece as spm
 
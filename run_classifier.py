@@ -8,6 +8,7 @@ import os
 import sys
 import csv
 import collections
+import itertools
 import numpy as np
 import time
 import math
@@ -26,7 +27,11 @@ import model_utils
 import function_builder
 from classifier_utils import PaddingInputExample
 from classifier_utils import convert_single_example
+from classifier_utils import bucket_by_length, parse_length_buckets
+from classifier_utils import pack_features, SEG_ID_PAD
+from classifier_utils import classification_metric_fn, regression_metric_fn
 from prepro_utils import preprocess_text, encode_ids
+from prepro_utils import define_token_cache_flags, token_cache_from_flags
 
 
 # Model
@@ -64,6 +69,7 @@ flags.DEFINE_string("output_dir", default="",
       help="Output dir for TF records.")
 flags.DEFINE_string("spiece_model_file", default="",
       help="Sentence Piece model path.")
+define_token_cache_flags()
 flags.DEFINE_string("model_dir", default="",
       help="Directory for saving the finetuned model.")
 flags.DEFINE_string("data_dir", default="",
@@ -126,12 +132,30 @@ flags.DEFINE_bool("eval_all_ckpt", default=False,
       help="Eval all ckpts. If False, only evaluate the last one.")
 flags.DEFINE_string("predict_ckpt", default=None,
       help="Ckpt path for do_predict. If None, use the last one.")
+flags.DEFINE_bool("eval_watch", default=False,
+      help="After the existing ckpts, keep evaluating the new ckpts written "
+      "to model_dir until the one of train_steps. Not supported on TPUs.")
+flags.DEFINE_integer("eval_watch_secs", default=60,
+      help="Seconds between two polls of model_dir with eval_watch.")
+flags.DEFINE_integer("eval_watch_timeout", default=3600,
+      help="Stop eval_watch after this many seconds without a new ckpt.")
 
 # task specific
 flags.DEFINE_string("task_name", default=None, help="Task name")
 flags.DEFINE_integer("max_seq_length", default=128, help="Max sequence length")
 flags.DEFINE_integer("shuffle_buffer", default=2048,
       help="Buffer size used for shuffle.")
+flags.DEFINE_string("length_buckets", default=None,
+      help="Comma separated sequence lengths, e.g. `32,64`. If set, training "
+      "and eval batches group examples of similar lengths and are only "
+      "padded to their bucket length. Not supported on TPUs.")
+flags.DEFINE_integer("bucket_tokens", default=None,
+      help="Number of tokens per batch with `length_buckets`. "
+      "Defaults to batch size * max_seq_length.")
+flags.DEFINE_integer("pack_examples", default=0,
+      help="If > 1, pack up to this many short examples into each training "
+      "and eval sequence, with attention masked between them. Only for "
+      "classification with summary_type `last`.")
 flags.DEFINE_integer("num_passes", default=1,
       help="Num passes for processing training data. "
       "This is use to batch data without loss for TPUs.")
@@ -449,9 +473,93 @@ def file_based_convert_examples_to_features(
   writer.close()
 
 
+def file_based_convert_examples_to_packed_features(
+    examples, label_list, max_seq_length, tokenize_fn, output_file,
+    max_pack, num_passes=1, batch_size=None):
+  """Convert a set of `InputExample`s to a TFRecord file of packed sequences,
+  see `classifier_utils.pack_features`.
+
+  If `batch_size` is set, empty packs are appended so the number of packs is
+  a multiple of it. Returns the number of packs in the file.
+  """
+
+  # do not create duplicated records
+  if tf.gfile.Exists(output_file) and not FLAGS.overwrite_data:
+    tf.logging.info("Do not overwrite tfrecord {} exists.".format(output_file))
+    return sum(1 for _ in tf.python_io.tf_record_iterator(output_file))
+
+  tf.logging.info("Create new tfrecord {}.".format(output_file))
+
+  if num_passes > 1:
+    examples *= num_passes
+
+  input_features = []
+  for (ex_index, example) in enumerate(examples):
+    if ex_index % 10000 == 0:
+      tf.logging.info("Converting example {} of {}".format(ex_index,
+                                                           len(examples)))
+    input_features.append(convert_single_example(
+        ex_index, example, label_list, max_seq_length, tokenize_fn))
+
+  packs = pack_features(input_features, max_seq_length, max_pack)
+  tf.logging.info("Packed {} examples into {} sequences.".format(
+      len(input_features), len(packs)))
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  def create_float_feature(values):
+    f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
+    return f
+
+  writer = tf.python_io.TFRecordWriter(output_file)
+  num_packs = len(packs)
+  if batch_size:
+    num_packs += -num_packs % batch_size
+
+  for pack_index in range(num_packs):
+    if pack_index < len(packs):
+      pack = packs[pack_index]
+      features = collections.OrderedDict()
+      features["input_ids"] = create_int_feature(pack.input_ids)
+      features["input_mask"] = create_float_feature(pack.input_mask)
+      features["segment_ids"] = create_int_feature(pack.segment_ids)
+      features["pack_ids"] = create_int_feature(pack.pack_ids)
+      features["cls_index"] = create_int_feature(pack.cls_index)
+      features["label_ids"] = create_int_feature(pack.label_ids)
+      features["is_real_example"] = create_int_feature(pack.is_real_example)
+    else:
+      features = collections.OrderedDict()
+      features["input_ids"] = create_int_feature([0] * max_seq_length)
+      features["input_mask"] = create_float_feature([1] * max_seq_length)
+      features["segment_ids"] = create_int_feature(
+          [SEG_ID_PAD] * max_seq_length)
+      features["pack_ids"] = create_int_feature([-1] * max_seq_length)
+      features["cls_index"] = create_int_feature(
+          [max_seq_length - 1] * max_pack)
+      features["label_ids"] = create_int_feature([0] * max_pack)
+      features["is_real_example"] = create_int_feature([0] * max_pack)
+
+    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+    writer.write(tf_example.SerializeToString())
+  writer.close()
+
+  return num_packs
+
+
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                                drop_remainder, length_buckets=None,
+                                max_pack=1):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  With `length_buckets`, batches are bucketed by sequence length, see
+  `classifier_utils.bucket_by_length`. This changes the order of the
+  examples and the batch size, so it should not be used for prediction.
+
+  With `max_pack` > 1, `input_file` holds packed sequences written by
+  `file_based_convert_examples_to_packed_features`.
+  """
 
 
   name_to_features = {
@@ -463,6 +571,12 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
   }
   if FLAGS.is_regression:
     name_to_features["label_ids"] = tf.FixedLenFeature([], tf.float32)
+  if max_pack > 1:
+    name_to_features["pack_ids"] = tf.FixedLenFeature([seq_length], tf.int64)
+    name_to_features["cls_index"] = tf.FixedLenFeature([max_pack], tf.int64)
+    name_to_features["label_ids"] = tf.FixedLenFeature([max_pack], tf.int64)
+    name_to_features["is_real_example"] = tf.FixedLenFeature(
+        [max_pack], tf.int64)
 
   tf.logging.info("Input tfrecord file {}".format(input_file))
 
@@ -505,6 +619,15 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
     #   d = d.shuffle(buffer_size=FLAGS.shuffle_buffer)
       d = d.repeat()
 
+    if length_buckets:
+      bucket_tokens = FLAGS.bucket_tokens or batch_size * seq_length
+      d = d.map(lambda record: _decode_record(record, name_to_features))
+      # partial eval batches are kept, the Estimator does not need fixed
+      # batch sizes off TPUs
+      d = bucket_by_length(d, length_buckets, bucket_tokens,
+                           drop_remainder=is_training)
+      return d.prefetch(1)
+
     d = d.apply(
         tf.contrib.data.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -541,28 +664,9 @@ def get_model_fn(n_class):
     if mode == tf.estimator.ModeKeys.EVAL:
       assert FLAGS.num_hosts == 1
 
-      def metric_fn(per_example_loss, label_ids, logits, is_real_example):
-        predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
-        eval_input_dict = {
-            'labels': label_ids,
-            'predictions': predictions,
-            'weights': is_real_example
-        }
-        accuracy = tf.metrics.accuracy(**eval_input_dict)
-
-        loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
-        return {
-            'eval_accuracy': accuracy,
-            'eval_loss': loss}
-
-      def regression_metric_fn(
-          per_example_loss, label_ids, logits, is_real_example):
-        loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
-        pearsonr = tf.contrib.metrics.streaming_pearson_correlation(
-            logits, label_ids, weights=is_real_example)
-        return {'eval_loss': loss, 'eval_pearsonr': pearsonr}
-
-      is_real_example = tf.cast(features["is_real_example"], dtype=tf.float32)
+      # packed sequences have one weight per example slot
+      is_real_example = tf.reshape(
+          tf.cast(features["is_real_example"], dtype=tf.float32), [-1])
 
       #### Constucting evaluation TPUEstimatorSpec with new cache.
       label_ids = tf.reshape(features['label_ids'], [-1])
@@ -570,7 +674,7 @@ def get_model_fn(n_class):
       if FLAGS.is_regression:
         metric_fn = regression_metric_fn
       else:
-        metric_fn = metric_fn
+        metric_fn = classification_metric_fn
       metric_args = [per_example_loss, label_ids, logits, is_real_example]
 
       if FLAGS.use_tpu:
@@ -644,6 +748,103 @@ def get_model_fn(n_class):
   return model_fn
 
 
+def list_checkpoints(model_dir):
+  """Returns the sorted [global_step, path] of all the ckpts in model_dir."""
+  steps_and_files = []
+  filenames = tf.gfile.ListDirectory(model_dir)
+
+  for filename in filenames:
+    if filename.endswith(".index"):
+      ckpt_name = filename[:-6]
+      cur_filename = join(model_dir, ckpt_name)
+      global_step = int(cur_filename.split("-")[-1])
+      steps_and_files.append([global_step, cur_filename])
+
+  return sorted(steps_and_files, key=lambda x: x[0])
+
+
+def watch_checkpoints(model_dir, evaluated, last_step):
+  """Yields the [global_step, path] of new ckpts in model_dir as they are
+  written, until `last_step` or `FLAGS.eval_watch_timeout`."""
+  evaluated = set(evaluated)
+  last_time = time.time()
+  while time.time() - last_time < FLAGS.eval_watch_timeout:
+    new_ckpts = [x for x in list_checkpoints(model_dir)
+                 if x[1] not in evaluated]
+    for global_step, filename in new_ckpts:
+      evaluated.add(filename)
+      yield global_step, filename
+      if global_step >= last_step:
+        return
+    if new_ckpts:
+      last_time = time.time()
+    else:
+      time.sleep(FLAGS.eval_watch_secs)
+
+  tf.logging.info("No new ckpt in {} for {} secs, stop watching.".format(
+      model_dir, FLAGS.eval_watch_timeout))
+
+
+def evaluate_checkpoints(model_fn, input_fn, steps_and_files):
+  """Evaluates a sequence of ckpts with a single graph, the alternative to
+  one `Estimator.evaluate` per ckpt off TPUs.
+
+  The graph and the eval metrics are built once, on placeholders. The eval
+  batches are read from `input_fn` once into memory, and each ckpt only
+  costs a `Saver.restore` and a pass over the batches in memory. Ckpts
+  removed (e.g. by `keep_checkpoint_max`) before they are restored are
+  skipped.
+
+  Yields the global_step, path and results of each ckpt in
+  `steps_and_files`, with the results keyed as the ones of
+  `Estimator.evaluate`.
+  """
+  with tf.Graph().as_default():
+    global_step_var = tf.train.get_or_create_global_step()
+
+    dataset = input_fn({"batch_size": FLAGS.eval_batch_size})
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    features = {name: tf.placeholder(dtype, dataset.output_shapes[name])
+                for name, dtype in dataset.output_types.items()}
+
+    eval_spec = model_fn(features, None, tf.estimator.ModeKeys.EVAL, {})
+    metric_ops = dict(eval_spec.eval_metric_ops)
+    metric_ops["loss"] = tf.metrics.mean(eval_spec.loss)
+
+    value_ops = {key: op[0] for key, op in metric_ops.items()}
+    update_ops = [op[1] for op in metric_ops.values()]
+    reset_op = tf.local_variables_initializer()
+    saver = tf.train.Saver()
+
+    with tf.Session() as sess:
+      batches = []
+      while True:
+        try:
+          batches.append(sess.run(next_batch))
+        except tf.errors.OutOfRangeError:
+          break
+      tf.logging.info("Loaded {} eval batches.".format(len(batches)))
+
+      for global_step, filename in steps_and_files:
+        try:
+          saver.restore(sess, filename)
+        except (tf.errors.NotFoundError, ValueError):
+          if tf.train.checkpoint_exists(filename):
+            raise
+          tf.logging.info("{} was removed before eval, skip it.".format(
+              filename))
+          continue
+
+        sess.run(reset_op)
+        for batch in batches:
+          sess.run(update_ops, feed_dict={features[name]: batch[name]
+                                          for name in features})
+
+        ret = sess.run(value_ops)
+        ret["global_step"] = sess.run(global_step_var)
+        yield global_step, filename, ret
+
+
 def main(_):
   if FLAGS.server_ip and FLAGS.server_port:
       # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -695,6 +896,9 @@ def main(_):
   def tokenize_fn(text):
     text = preprocess_text(text, lower=FLAGS.uncased)
     return encode_ids(sp, text)
+  token_cache = token_cache_from_flags(FLAGS)
+  if token_cache is not None:
+    tokenize_fn = token_cache.cached_ids(tokenize_fn)
 
   run_config = model_utils.configure_tpu(FLAGS)
 
@@ -702,6 +906,25 @@ def main(_):
 
   spm_basename = os.path.basename(FLAGS.spiece_model_file)
 
+  length_buckets = None
+  if FLAGS.length_buckets:
+    if FLAGS.use_tpu:
+      raise ValueError("`length_buckets` is not supported on TPUs.")
+    length_buckets = parse_length_buckets(FLAGS.length_buckets,
+                                          FLAGS.max_seq_length)
+
+  if FLAGS.eval_watch and FLAGS.use_tpu:
+    raise ValueError("`eval_watch` is not supported on TPUs.")
+
+  max_pack = max(FLAGS.pack_examples, 1)
+  if max_pack > 1:
+    if FLAGS.is_regression or FLAGS.summary_type != "last":
+      raise ValueError("`pack_examples` only supports classification with "
+                       "summary_type `last`.")
+    if length_buckets:
+      raise ValueError("`pack_examples` and `length_buckets` cannot be used "
+                       "together.")
+
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
   if FLAGS.use_tpu:
@@ -726,15 +949,23 @@ def main(_):
     train_examples = processor.get_train_examples(FLAGS.data_dir)
     tf.logging.info("Num of train samples: {}".format(len(train_examples)))
 
-    file_based_convert_examples_to_features(
-        train_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
-        train_file, FLAGS.num_passes)
+    if max_pack > 1:
+      train_file += ".pack-{}".format(max_pack)
+      file_based_convert_examples_to_packed_features(
+          train_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
+          train_file, max_pack, FLAGS.num_passes)
+    else:
+      file_based_convert_examples_to_features(
+          train_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
+          train_file, FLAGS.num_passes)
 
     train_input_fn = file_based_input_fn_builder(
         input_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        length_buckets=length_buckets,
+        max_pack=max_pack)
 
     estimator.train(input_fn=train_input_fn, max_steps=FLAGS.train_steps)
 
@@ -753,51 +984,75 @@ def main(_):
     # later on. These do NOT count towards the metric (all tf.metrics
     # support a per-instance weight, and these get a weight of 0.0).
     #
-    # Modified in XL: We also adopt the same mechanism for GPUs.
-    while len(eval_examples) % FLAGS.eval_batch_size != 0:
-      eval_examples.append(PaddingInputExample())
-
+    # Other backends run the last partial batch as is instead of spending
+    # forward passes on fake examples.
     eval_file_base = "{}.len-{}.{}.eval.tf_record".format(
         spm_basename, FLAGS.max_seq_length, FLAGS.eval_split)
     eval_file = os.path.join(FLAGS.output_dir, eval_file_base)
+    if not FLAGS.use_tpu:
+      # keep TPUs from reading a record file without the padding
+      eval_file += ".nopad"
+
+    if max_pack > 1:
+      # packed sequences are padded with empty packs instead
+      eval_file += ".pack-{}".format(max_pack)
+      num_packs = file_based_convert_examples_to_packed_features(
+          eval_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
+          eval_file, max_pack,
+          batch_size=FLAGS.eval_batch_size if FLAGS.use_tpu else None)
+      eval_steps = int(math.ceil(num_packs / FLAGS.eval_batch_size))
+    else:
+      if FLAGS.use_tpu:
+        while len(eval_examples) % FLAGS.eval_batch_size != 0:
+          eval_examples.append(PaddingInputExample())
 
-    file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
-        eval_file)
+      file_based_convert_examples_to_features(
+          eval_examples, label_list, FLAGS.max_seq_length, tokenize_fn,
+          eval_file)
 
-    assert len(eval_examples) % FLAGS.eval_batch_size == 0
-    eval_steps = int(len(eval_examples) // FLAGS.eval_batch_size)
+      eval_steps = int(math.ceil(len(eval_examples) / FLAGS.eval_batch_size))
 
     eval_input_fn = file_based_input_fn_builder(
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=True)
+        drop_remainder=FLAGS.use_tpu,
+        length_buckets=length_buckets,
+        max_pack=max_pack)
+    if length_buckets:
+      # buckets yield a varying number of batches, run through the data
+      eval_steps = None
 
     # Filter out all checkpoints in the directory
-    steps_and_files = []
-    filenames = tf.gfile.ListDirectory(FLAGS.model_dir)
-
-    for filename in filenames:
-      if filename.endswith(".index"):
-        ckpt_name = filename[:-6]
-        cur_filename = join(FLAGS.model_dir, ckpt_name)
-        global_step = int(cur_filename.split("-")[-1])
-        tf.logging.info("Add {} to eval list.".format(cur_filename))
-        steps_and_files.append([global_step, cur_filename])
-    steps_and_files = sorted(steps_and_files, key=lambda x: x[0])
+    all_steps_and_files = list_checkpoints(FLAGS.model_dir)
+    for _, filename in all_steps_and_files:
+      tf.logging.info("Add {} to eval list.".format(filename))
 
     # Decide whether to evaluate all ckpts
+    steps_and_files = all_steps_and_files
     if not FLAGS.eval_all_ckpt:
       steps_and_files = steps_and_files[-1:]
 
-    eval_results = []
-    for global_step, filename in sorted(steps_and_files, key=lambda x: x[0]):
-      ret = estimator.evaluate(
+    if FLAGS.use_tpu:
+      eval_rets = ((global_step, filename, estimator.evaluate(
           input_fn=eval_input_fn,
           steps=eval_steps,
-          checkpoint_path=filename)
+          checkpoint_path=filename))
+                   for global_step, filename in steps_and_files)
+    else:
+      # restore each ckpt into a single eval graph
+      last_step = all_steps_and_files[-1][0] if all_steps_and_files else -1
+      if FLAGS.eval_watch and last_step < FLAGS.train_steps:
+        steps_and_files = itertools.chain(
+            steps_and_files,
+            watch_checkpoints(FLAGS.model_dir,
+                              [x[1] for x in all_steps_and_files],
+                              FLAGS.train_steps))
+      eval_rets = evaluate_checkpoints(model_fn, eval_input_fn,
+                                       steps_and_files)
 
+    eval_results = []
+    for global_step, filename, ret in eval_rets:
       ret["step"] = global_step
       ret["path"] = filename
 
@@ -833,21 +1088,28 @@ def main(_):
         is_training=False,
         drop_remainder=False)
 
-    predict_results = []
+    # logits are streamed to a JSON Lines file, one list per example
+    predict_json_path = os.path.join(predict_dir, "{}.logits.jsonl".format(
+        task_name))
+
     with tf.gfile.Open(os.path.join(predict_dir, "{}.tsv".format(
-        task_name)), "w") as fout:
+        task_name)), "w") as fout, tf.gfile.Open(
+            predict_json_path, "w") as fp:
       fout.write("index\tprediction\n")
 
       for pred_cnt, result in enumerate(estimator.predict(
           input_fn=pred_input_fn,
           yield_single_examples=True,
           checkpoint_path=FLAGS.predict_ckpt)):
+        # fake examples only pad the eval examples on TPUs
+        if not result["is_real"]:
+          break
         if pred_cnt % 1000 == 0:
           tf.logging.info("Predicting submission for example: {}".format(
               pred_cnt))
 
         logits = [float(x) for x in result["logits"].flat]
-        predict_results.append(logits)
+        fp.write(json.dumps(logits) + "\n")
 
         if len(logits) == 1:
           label_out = logits[0]
@@ -864,12 +1126,6 @@ def main(_):
 
         fout.write("{}\t{}\n".format(pred_cnt, label_out))
 
-    predict_json_path = os.path.join(predict_dir, "{}.logits.json".format(
-        task_name))
-
-    with tf.gfile.Open(predict_json_path, "w") as fp:
-      json.dump(predict_results, fp, indent=4)
-
 
 if __name__ == "__main__":
   tf.app.run()
@@ -27,6 +27,7 @@ import function_builder
 from classifier_utils import PaddingInputExample
 from classifier_utils import convert_single_example
 from prepro_utils import preprocess_text, encode_ids
+from prepro_utils import define_token_cache_flags, token_cache_from_flags
 from gpu_utils import assign_to_gpu, average_grads_and_vars
 
 # GPU config
@@ -74,6 +75,7 @@ flags.DEFINE_string("output_dir", default="",
       help="Output dir for TF records.")
 flags.DEFINE_string("spiece_model_file", default="",
       help="Sentence Piece model path.")
+define_token_cache_flags()
 flags.DEFINE_string("model_dir", default="",
       help="Directory for saving the finetuned model.")
 flags.DEFINE_string("data_dir", default="",
@@ -642,6 +644,9 @@ def main(_):
   def tokenize_fn(text):
     text = preprocess_text(text, lower=FLAGS.uncased)
     return encode_ids(sp, text)
+  token_cache = token_cache_from_flags(FLAGS)
+  if token_cache is not None:
+    tokenize_fn = token_cache.cached_ids(tokenize_fn)
 
   # run_config = model_utils.configure_tpu(FLAGS)
 
@@ -29,6 +29,7 @@ import function_builder
 from classifier_utils import PaddingInputExample
 from classifier_utils import convert_single_example
 from prepro_utils import preprocess_text, encode_ids
+from prepro_utils import define_token_cache_flags, token_cache_from_flags
 
 # Model
 flags.DEFINE_string("model_config_path", default=None,
@@ -65,6 +66,7 @@ flags.DEFINE_string("output_dir", default="",
       help="Output dir for TF records.")
 flags.DEFINE_string("spiece_model_file", default="",
       help="Sentence Piece model path.")
+define_token_cache_flags()
 flags.DEFINE_string("model_dir", default="",
       help="Directory for saving the finetuned model.")
 flags.DEFINE_string("data_dir", default="",
@@ -128,6 +130,11 @@ flags.DEFINE_bool("high_only", default=False,
       help="Evaluate on high school only.")
 flags.DEFINE_bool("middle_only", default=False,
       help="Evaluate on middle school only.")
+flags.DEFINE_bool("shared_context", default=False,
+      help="Encode the article once per question and use it as the memory "
+      "of the 4 question-option sequences, instead of encoding 4 full "
+      "sequences. Uses a different record format and changes the model, "
+      "so train and evaluate with the same setting.")
 
 FLAGS = flags.FLAGS
 
@@ -165,7 +172,7 @@ class InputFeatures(object):
     self.is_real_example = is_real_example
 
 
-def convert_single_example(example, tokenize_fn):
+def convert_single_example(example, tokenize_fn, tokenize_context=None):
   """Converts a single `InputExample` into a single `InputFeatures`."""
 
   if isinstance(example, PaddingInputExample):
@@ -177,7 +184,7 @@ def convert_single_example(example, tokenize_fn):
         is_real_example=False)
 
   input_ids, input_mask, all_seg_ids = [], [], []
-  tokens_context = tokenize_fn(example.context)
+  tokens_context = (tokenize_context or tokenize_fn)(example.context)
   for i in range(len(example.qa_list)):
     tokens_qa = tokenize_fn(example.qa_list[i])
     if len(tokens_qa) > FLAGS.max_qa_length:
@@ -229,6 +236,60 @@ def convert_single_example(example, tokenize_fn):
   return feature
 
 
+def get_context_len():
+  """Length of the article in the `shared_context` records."""
+  return FLAGS.max_seq_length - FLAGS.max_qa_length - 3
+
+
+def convert_single_example_shared(example, tokenize_fn, tokenize_context):
+  """Converts a single `InputExample` into the `shared_context` features: the
+  article once, left-padded to `get_context_len()`, and the 4 sequences of
+  `[SEP] question-option [SEP] [CLS]`, each left-padded to
+  `max_qa_length + 3`."""
+  context_len = get_context_len()
+  qa_len = FLAGS.max_qa_length + 3
+
+  if isinstance(example, PaddingInputExample):
+    feature = InputFeatures(
+        input_ids=[0] * qa_len * 4,
+        input_mask=[1] * qa_len * 4,
+        segment_ids=[0] * qa_len * 4,
+        label_id=0,
+        is_real_example=False)
+    feature.context_ids = [0] * context_len
+    feature.context_mask = [1] * context_len
+    return feature
+
+  tokens_context = tokenize_context(example.context)[:context_len]
+  delta_len = context_len - len(tokens_context)
+  context_ids = [0] * delta_len + tokens_context
+  context_mask = [1] * delta_len + [0] * len(tokens_context)
+
+  input_ids, input_mask, all_seg_ids = [], [], []
+  for qa in example.qa_list:
+    tokens_qa = tokenize_fn(qa)
+    if len(tokens_qa) > FLAGS.max_qa_length:
+      tokens_qa = tokens_qa[- FLAGS.max_qa_length:]
+
+    tokens = [SEP_ID] + tokens_qa + [SEP_ID, CLS_ID]
+    segment_ids = ([SEG_ID_A] + [SEG_ID_B] * len(tokens_qa) +
+                   [SEG_ID_B, SEG_ID_CLS])
+
+    delta_len = qa_len - len(tokens)
+    input_ids.extend([0] * delta_len + tokens)
+    input_mask.extend([1] * delta_len + [0] * len(tokens))
+    all_seg_ids.extend([SEG_ID_PAD] * delta_len + segment_ids)
+
+  feature = InputFeatures(
+      input_ids=input_ids,
+      input_mask=input_mask,
+      segment_ids=all_seg_ids,
+      label_id=example.label)
+  feature.context_ids = context_ids
+  feature.context_mask = context_mask
+  return feature
+
+
 class InputExample(object):
   def __init__(self, context, qa_list, label, level):
     self.context = context
@@ -282,11 +343,24 @@ def file_based_convert_examples_to_features(examples, tokenize_fn, output_file):
   tf.logging.info("Start writing tfrecord %s.", output_file)
   writer = tf.python_io.TFRecordWriter(output_file)
 
+  # an article is shared by all of its questions, so tokenize it only once;
+  # each call returns a fresh list as the conversion extends it in place
+  context_tokens = {}
+  def tokenize_context(context):
+    if context not in context_tokens:
+      context_tokens[context] = np.array(tokenize_fn(context), dtype=np.int32)
+    return context_tokens[context].tolist()
+
   for ex_index, example in enumerate(examples):
     if ex_index % 10000 == 0:
       tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
 
-    feature = convert_single_example(example, tokenize_fn)
+    if FLAGS.shared_context:
+      feature = convert_single_example_shared(example, tokenize_fn,
+                                              tokenize_context)
+    else:
+      feature = convert_single_example(example, tokenize_fn,
+                                       tokenize_context)
 
     def create_int_feature(values):
       f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
@@ -303,6 +377,9 @@ def file_based_convert_examples_to_features(examples, tokenize_fn, output_file):
     features["label_ids"] = create_int_feature([feature.label_id])
     features["is_real_example"] = create_int_feature(
         [int(feature.is_real_example)])
+    if FLAGS.shared_context:
+      features["context_ids"] = create_int_feature(feature.context_ids)
+      features["context_mask"] = create_float_feature(feature.context_mask)
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
     writer.write(tf_example.SerializeToString())
@@ -313,6 +390,10 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
                                 drop_remainder):
   """Creates an `input_fn` closure to be passed to TPUEstimator."""
 
+  context_len = get_context_len()
+  if FLAGS.shared_context:
+    seq_length = FLAGS.max_qa_length + 3
+
   name_to_features = {
       "input_ids": tf.FixedLenFeature([seq_length * 4], tf.int64),
       "input_mask": tf.FixedLenFeature([seq_length * 4], tf.float32),
@@ -320,6 +401,11 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
       "label_ids": tf.FixedLenFeature([], tf.int64),
       "is_real_example": tf.FixedLenFeature([], tf.int64),
   }
+  if FLAGS.shared_context:
+    name_to_features["context_ids"] = tf.FixedLenFeature(
+        [context_len], tf.int64)
+    name_to_features["context_mask"] = tf.FixedLenFeature(
+        [context_len], tf.float32)
 
   tf.logging.info("Input tfrecord file {}".format(input_file))
 
@@ -461,6 +547,9 @@ def main(_):
   def tokenize_fn(text):
     text = preprocess_text(text, lower=FLAGS.uncased)
     return encode_ids(sp, text)
+  token_cache = token_cache_from_flags(FLAGS)
+  if token_cache is not None:
+    tokenize_fn = token_cache.cached_ids(tokenize_fn)
 
   # TPU Configuration
   run_config = model_utils.configure_tpu(FLAGS)
@@ -468,6 +557,8 @@ def main(_):
   model_fn = get_model_fn()
 
   spm_basename = os.path.basename(FLAGS.spiece_model_file)
+  if FLAGS.shared_context:
+    spm_basename += ".shared-qlen-{}".format(FLAGS.max_qa_length)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
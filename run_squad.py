@@ -7,27 +7,24 @@ from absl import flags
 import absl.logging as _logging  # pylint: disable=unused-import
 
 import collections
+import multiprocessing
 import os
 import time
 import math
 import json
 import six
 import random
-import gc
 
 import numpy as np
 
-if six.PY2:
-  import cPickle as pickle
-else:
-  import pickle
-
 import tensorflow as tf
 import sentencepiece as spm
 from prepro_utils import preprocess_text, encode_ids, encode_pieces, printable_text
+from prepro_utils import define_token_cache_flags, token_cache_from_flags
 import function_builder
 import model_utils
 import squad_utils
+import data_utils
 from data_utils import SEP_ID, CLS_ID, VOCAB_SIZE
 
 SPIECE_UNDERLINE = u'▁'
@@ -44,6 +41,9 @@ flags.DEFINE_integer("num_proc", default=1,
       help="Number of preprocessing processes.")
 flags.DEFINE_integer("proc_id", default=0,
       help="Process id for preprocessing.")
+flags.DEFINE_integer("num_workers", default=1,
+      help="Number of local processes converting examples into features, "
+      "for both train and eval. The output does not depend on it.")
 
 # Model
 flags.DEFINE_string("model_config_path", default=None,
@@ -83,6 +83,7 @@ flags.DEFINE_string("predict_dir", default="",
                     help="Dir for predictions.")
 flags.DEFINE_string("spiece_model_file", default="",
                     help="Sentence Piece model path.")
+define_token_cache_flags()
 flags.DEFINE_string("model_dir", default="",
                     help="Directory for saving the finetuned model.")
 flags.DEFINE_string("train_file", default="",
@@ -309,15 +310,190 @@ def _convert_index(index, pos, M=None, is_start=True):
       return index[front]
 
 
+def _banded_lcs(norm_chars, tok_cat_text, max_dist):
+  """Longest common subsequence of the paragraph and the piece characters,
+  only over the band of cells (i, j) with i - max_dist <= j < i + max_dist.
+
+  The band is stored row by row, with band index k = j - i + max_dist. Each
+  row is computed at once with a running max, since
+  f[i, j] = max(f[i - 1, j], f[i - 1, j - 1] + match(i, j), f[i, j - 1]).
+
+  Returns:
+    score: f[N - 1, M - 1], the length of the subsequence.
+    g: int8 array in shape [N, 2 * max_dist], the backpointers: 2 for a
+      match, 1 for a step along j, 0 for a step along i, -1 for none.
+  """
+  N, M = len(norm_chars), len(tok_cat_text)
+  width = 2 * max_dist
+
+  cols = np.arange(N)[:, None] - max_dist + np.arange(width)[None, :]
+  valid = np.logical_and(cols >= 0, cols < M)
+
+  # a paragraph character only matches if it normalizes to a single char
+  char_ids = {}
+  tok_ids = np.array([char_ids.setdefault(c, len(char_ids))
+                      for c in tok_cat_text], dtype=np.int64)
+  norm_ids = np.array([char_ids.get(c, -1) for c in norm_chars],
+                      dtype=np.int64)
+  match = np.logical_and(
+      valid, norm_ids[:, None] == tok_ids[np.clip(cols, 0, M - 1)])
+
+  # row 0 is the row before the paragraph, the last column is out of band
+  f = np.zeros((N + 1, width + 1), dtype=np.int32)
+  for i in range(N):
+    prev = f[i]
+    cur = np.maximum(prev[1:], np.where(match[i], prev[:-1] + 1, 0))
+    np.maximum.accumulate(cur, out=cur)
+    f[i + 1, :width] = cur * valid[i]
+
+  cur = f[1:, :width]
+  up = f[:-1, 1:]
+  diag = f[:-1, :width]
+  left = np.concatenate([np.zeros([N, 1], dtype=np.int32), cur[:, :-1]], 1)
+
+  is_match = np.logical_and(match, diag + 1 > np.maximum(up, left))
+  is_left = np.logical_and(np.logical_not(is_match), left > up)
+  g = np.where(is_match, 2, np.where(is_left, 1, 0)).astype(np.int8)
+  g[0][np.logical_not(np.logical_or(is_match[0], is_left[0]))] = -1
+  g[np.logical_not(valid)] = -1
+
+  score = f[N, M - N + max_dist]
+
+  return score, g
+
+
+def _align_paragraph(norm_chars, tok_cat_text):
+  """Align the (normalized) paragraph characters to the piece characters.
+
+  Returns:
+    orig_to_chartok_index, chartok_to_orig_index: the aligned position of
+      each character in the other text, None if not aligned.
+    score: the number of aligned characters.
+  """
+  N, M = len(norm_chars), len(tok_cat_text)
+  orig_to_chartok_index = [None] * N
+  chartok_to_orig_index = [None] * M
+  if N == 0 or M == 0:
+    return orig_to_chartok_index, chartok_to_orig_index, 0
+
+  # exact match: the alignment is the diagonal
+  if N == M and all(c == t for c, t in zip(norm_chars, tok_cat_text)):
+    return list(range(N)), list(range(M)), N
+
+  # note(zhiliny):
+  # unlike standard LCS, this is specifically optimized for the setting
+  # because the mismatch between sentence pieces and original text will
+  # be small
+  max_dist = abs(N - M) + 5
+  for _ in range(2):
+    score, g = _banded_lcs(norm_chars, tok_cat_text, max_dist)
+    if score > 0.8 * N: break
+    max_dist *= 2
+
+  # the band of the last `_banded_lcs` call
+  max_dist = g.shape[1] // 2
+  i, j = N - 1, M - 1
+  while i >= 0 and j >= 0:
+    k = j - i + max_dist
+    if k < 0 or k >= 2 * max_dist or g[i, k] < 0: break
+    if g[i, k] == 2:
+      orig_to_chartok_index[i] = j
+      chartok_to_orig_index[j] = i
+      i, j = i - 1, j - 1
+    elif g[i, k] == 1:
+      j = j - 1
+    else:
+      i = i - 1
+
+  return orig_to_chartok_index, chartok_to_orig_index, score
+
+
+_ParagraphFeatures = collections.namedtuple(  # pylint: disable=invalid-name
+    "ParagraphFeatures",
+    ["all_doc_tokens", "chartok_to_tok_index", "orig_to_chartok_index",
+     "tok_start_to_orig_index", "tok_end_to_orig_index"])
+
+
+def _convert_paragraph(paragraph_text, para_tokens, sp_model):
+  """Tokenization and alignment of a paragraph, shared by its questions.
+
+  The indices are kept in int32 arrays, with -1 for None in
+  `orig_to_chartok_index`. Returns None if the alignment fails.
+  """
+  chartok_to_tok_index = []
+  tok_start_to_chartok_index = []
+  tok_end_to_chartok_index = []
+  char_cnt = 0
+  for i, token in enumerate(para_tokens):
+    chartok_to_tok_index.extend([i] * len(token))
+    tok_start_to_chartok_index.append(char_cnt)
+    char_cnt += len(token)
+    tok_end_to_chartok_index.append(char_cnt - 1)
+
+  tok_cat_text = ''.join(para_tokens).replace(SPIECE_UNDERLINE, ' ')
+  N = len(paragraph_text)
+
+  norm_chars = [preprocess_text(c, lower=FLAGS.uncased, remove_space=False)
+                for c in paragraph_text]
+  orig_to_chartok_index, chartok_to_orig_index, score = _align_paragraph(
+      norm_chars, tok_cat_text)
+
+  if all(v is None for v in orig_to_chartok_index) or score < 0.8 * N:
+    return None
+
+  tok_start_to_orig_index = []
+  tok_end_to_orig_index = []
+  for i in range(len(para_tokens)):
+    start_chartok_pos = tok_start_to_chartok_index[i]
+    end_chartok_pos = tok_end_to_chartok_index[i]
+    start_orig_pos = _convert_index(chartok_to_orig_index, start_chartok_pos,
+                                    N, is_start=True)
+    end_orig_pos = _convert_index(chartok_to_orig_index, end_chartok_pos,
+                                  N, is_start=False)
+
+    tok_start_to_orig_index.append(start_orig_pos)
+    tok_end_to_orig_index.append(end_orig_pos)
+
+  def _piece_to_id(x):
+    if six.PY2 and isinstance(x, unicode):
+      x = x.encode('utf-8')
+    return sp_model.PieceToId(x)
+
+  all_doc_tokens = list(map(_piece_to_id, para_tokens))
+
+  return _ParagraphFeatures(
+      all_doc_tokens=np.array(all_doc_tokens, dtype=np.int32),
+      chartok_to_tok_index=np.array(chartok_to_tok_index, dtype=np.int32),
+      orig_to_chartok_index=np.array(
+          [-1 if v is None else v for v in orig_to_chartok_index],
+          dtype=np.int32),
+      tok_start_to_orig_index=np.array(tok_start_to_orig_index,
+                                       dtype=np.int32),
+      tok_end_to_orig_index=np.array(tok_end_to_orig_index, dtype=np.int32))
+
+
 def convert_examples_to_features(examples, sp_model, max_seq_length,
                                  doc_stride, max_query_length, is_training,
-                                 output_fn):
+                                 output_fn, token_cache=None):
   """Loads a data file into a list of `InputBatch`s."""
 
+  def encode_query(text):
+    return encode_ids(sp_model, preprocess_text(text, lower=FLAGS.uncased))
+
+  def encode_paragraph(text):
+    return encode_pieces(sp_model, preprocess_text(text, lower=FLAGS.uncased))
+
+  if token_cache is not None:
+    encode_query = token_cache.cached_ids(encode_query)
+    encode_paragraph = token_cache.cached_pieces(encode_paragraph)
+
   cnt_pos, cnt_neg = 0, 0
   unique_id = 1000000000
-  max_N, max_M = 1024, 1024
-  f = np.zeros((max_N, max_M), dtype=np.float32)
+
+  # paragraphs are converted once and kept until their last question
+  num_questions = collections.Counter(
+      example.paragraph_text for example in examples)
+  paragraph_cache = {}
 
   for (example_index, example) in enumerate(examples):
 
@@ -325,106 +501,27 @@ def convert_examples_to_features(examples, sp_model, max_seq_length,
       tf.logging.info('Converting {}/{} pos {} neg {}'.format(
           example_index, len(examples), cnt_pos, cnt_neg))
 
-    query_tokens = encode_ids(
-        sp_model,
-        preprocess_text(example.question_text, lower=FLAGS.uncased))
+    query_tokens = encode_query(example.question_text)
 
     if len(query_tokens) > max_query_length:
       query_tokens = query_tokens[0:max_query_length]
 
     paragraph_text = example.paragraph_text
-    para_tokens = encode_pieces(
-        sp_model,
-        preprocess_text(example.paragraph_text, lower=FLAGS.uncased))
-
-    chartok_to_tok_index = []
-    tok_start_to_chartok_index = []
-    tok_end_to_chartok_index = []
-    char_cnt = 0
-    for i, token in enumerate(para_tokens):
-      chartok_to_tok_index.extend([i] * len(token))
-      tok_start_to_chartok_index.append(char_cnt)
-      char_cnt += len(token)
-      tok_end_to_chartok_index.append(char_cnt - 1)
-
-    tok_cat_text = ''.join(para_tokens).replace(SPIECE_UNDERLINE, ' ')
-    N, M = len(paragraph_text), len(tok_cat_text)
-
-    if N > max_N or M > max_M:
-      max_N = max(N, max_N)
-      max_M = max(M, max_M)
-      f = np.zeros((max_N, max_M), dtype=np.float32)
-      gc.collect()
-
-    g = {}
-
-    def _lcs_match(max_dist):
-      f.fill(0)
-      g.clear()
-
-      ### longest common sub sequence
-      # f[i, j] = max(f[i - 1, j], f[i, j - 1], f[i - 1, j - 1] + match(i, j))
-      for i in range(N):
-
-        # note(zhiliny):
-        # unlike standard LCS, this is specifically optimized for the setting
-        # because the mismatch between sentence pieces and original text will
-        # be small
-        for j in range(i - max_dist, i + max_dist):
-          if j >= M or j < 0: continue
-
-          if i > 0:
-            g[(i, j)] = 0
-            f[i, j] = f[i - 1, j]
-
-          if j > 0 and f[i, j - 1] > f[i, j]:
-            g[(i, j)] = 1
-            f[i, j] = f[i, j - 1]
-
-          f_prev = f[i - 1, j - 1] if i > 0 and j > 0 else 0
-          if (preprocess_text(paragraph_text[i], lower=FLAGS.uncased,
-              remove_space=False)
-              == tok_cat_text[j]
-              and f_prev + 1 > f[i, j]):
-            g[(i, j)] = 2
-            f[i, j] = f_prev + 1
-
-    max_dist = abs(N - M) + 5
-    for _ in range(2):
-      _lcs_match(max_dist)
-      if f[N - 1, M - 1] > 0.8 * N: break
-      max_dist *= 2
-
-    orig_to_chartok_index = [None] * N
-    chartok_to_orig_index = [None] * M
-    i, j = N - 1, M - 1
-    while i >= 0 and j >= 0:
-      if (i, j) not in g: break
-      if g[(i, j)] == 2:
-        orig_to_chartok_index[i] = j
-        chartok_to_orig_index[j] = i
-        i, j = i - 1, j - 1
-      elif g[(i, j)] == 1:
-        j = j - 1
-      else:
-        i = i - 1
-
-    if all(v is None for v in orig_to_chartok_index) or f[N - 1, M - 1] < 0.8 * N:
+    if paragraph_text not in paragraph_cache:
+      paragraph_cache[paragraph_text] = _convert_paragraph(
+          paragraph_text, encode_paragraph(paragraph_text), sp_model)
+    paragraph = paragraph_cache[paragraph_text]
+    num_questions[paragraph_text] -= 1
+    if num_questions[paragraph_text] == 0:
+      del paragraph_cache[paragraph_text]
+
+    if paragraph is None:
       print('MISMATCH DETECTED!')
       continue
 
-    tok_start_to_orig_index = []
-    tok_end_to_orig_index = []
-    for i in range(len(para_tokens)):
-      start_chartok_pos = tok_start_to_chartok_index[i]
-      end_chartok_pos = tok_end_to_chartok_index[i]
-      start_orig_pos = _convert_index(chartok_to_orig_index, start_chartok_pos,
-                                      N, is_start=True)
-      end_orig_pos = _convert_index(chartok_to_orig_index, end_chartok_pos,
-                                    N, is_start=False)
-
-      tok_start_to_orig_index.append(start_orig_pos)
-      tok_end_to_orig_index.append(end_orig_pos)
+    all_doc_tokens = paragraph.all_doc_tokens.tolist()
+    tok_start_to_orig_index = paragraph.tok_start_to_orig_index.tolist()
+    tok_end_to_orig_index = paragraph.tok_end_to_orig_index.tolist()
 
     if not is_training:
       tok_start_position = tok_end_position = None
@@ -437,22 +534,20 @@ def convert_examples_to_features(examples, sp_model, max_seq_length,
       start_position = example.start_position
       end_position = start_position + len(example.orig_answer_text) - 1
 
+      orig_to_chartok_index = [
+          None if v < 0 else v
+          for v in paragraph.orig_to_chartok_index.tolist()]
+      chartok_to_tok_index = paragraph.chartok_to_tok_index
+
       start_chartok_pos = _convert_index(orig_to_chartok_index, start_position,
                                          is_start=True)
-      tok_start_position = chartok_to_tok_index[start_chartok_pos]
+      tok_start_position = int(chartok_to_tok_index[start_chartok_pos])
 
       end_chartok_pos = _convert_index(orig_to_chartok_index, end_position,
                                        is_start=False)
-      tok_end_position = chartok_to_tok_index[end_chartok_pos]
+      tok_end_position = int(chartok_to_tok_index[end_chartok_pos])
       assert tok_start_position <= tok_end_position
 
-    def _piece_to_id(x):
-      if six.PY2 and isinstance(x, unicode):
-        x = x.encode('utf-8')
-      return sp_model.PieceToId(x)
-
-    all_doc_tokens = list(map(_piece_to_id, para_tokens))
-
     # The -3 accounts for [CLS], [SEP] and [SEP]
     max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
 
@@ -669,6 +764,171 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
   return cur_span_index == best_span_index
 
 
+def _split_by_paragraph(examples, num_chunks):
+  """Split `examples` into about `num_chunks` consecutive chunks, without
+  splitting runs of questions on the same paragraph."""
+  chunk_size = max(1, (len(examples) + num_chunks - 1) // num_chunks)
+  chunks = []
+  start = 0
+  while start < len(examples):
+    end = min(start + chunk_size, len(examples))
+    while (end < len(examples) and
+           examples[end].paragraph_text == examples[end - 1].paragraph_text):
+      end += 1
+    chunks.append((start, examples[start:end]))
+    start = end
+  return chunks
+
+
+class _ChunkTokenCache(object):
+  """Token cache of a chunk converted by a worker of
+  `convert_examples_to_features_parallel`.
+
+  It holds the entries that the parent process found in its `TokenCache`
+  and collects the new ones, which the parent then adds to it. Workers
+  never open the SQLite cache themselves.
+  """
+
+  def __init__(self, entries):
+    self.entries = entries
+    self.new_entries = {}
+
+  def _cached(self, kind, encode_fn):
+    def lookup(text):
+      key = (kind, text)
+      if key not in self.entries:
+        self.entries[key] = self.new_entries[key] = encode_fn(text)
+      return self.entries[key]
+    return lookup
+
+  def cached_ids(self, encode_fn):
+    return self._cached("ids", encode_fn)
+
+  def cached_pieces(self, encode_fn):
+    return self._cached("pieces", encode_fn)
+
+
+def _cached_chunk_entries(examples, token_cache):
+  """The entries of `token_cache` needed to convert `examples`."""
+  entries = {}
+  for example in examples:
+    for key in [("ids", example.question_text),
+                ("pieces", example.paragraph_text)]:
+      if key not in entries:
+        outputs = token_cache.get(*key)
+        if outputs is not None:
+          entries[key] = outputs
+  return entries
+
+
+_worker_sp_model = None
+
+
+def _init_convert_worker():
+  global _worker_sp_model
+  # progress is logged by the parent process
+  tf.logging.set_verbosity(tf.logging.WARN)
+  _worker_sp_model = spm.SentencePieceProcessor()
+  _worker_sp_model.Load(FLAGS.spiece_model_file)
+
+
+def _convert_chunk(args):
+  start, examples, max_seq_length, doc_stride, max_query_length, \
+      is_training, cache_entries = args
+  chunk_cache = None
+  if cache_entries is not None:
+    chunk_cache = _ChunkTokenCache(cache_entries)
+  features = []
+  convert_examples_to_features(
+      examples=examples,
+      sp_model=_worker_sp_model,
+      max_seq_length=max_seq_length,
+      doc_stride=doc_stride,
+      max_query_length=max_query_length,
+      is_training=is_training,
+      output_fn=features.append,
+      token_cache=chunk_cache)
+  new_entries = chunk_cache.new_entries if chunk_cache is not None else {}
+  return start, len(examples), features, new_entries
+
+
+def convert_examples_to_features_parallel(examples, max_seq_length,
+                                          doc_stride, max_query_length,
+                                          is_training, output_fn,
+                                          num_workers, token_cache=None):
+  """`convert_examples_to_features` with a pool of `num_workers` processes.
+
+  Chunks of examples are converted by the workers and merged in order, with
+  `example_index` and `unique_id` renumbered as in a serial run, so the
+  output is the same as that of `convert_examples_to_features`.
+
+  `token_cache` is only used by this process: the cached tokenizations of
+  each chunk are sent along with it, and the new ones are added when the
+  chunk is merged.
+  """
+  pool = multiprocessing.Pool(num_workers, initializer=_init_convert_worker)
+
+  chunks = _split_by_paragraph(examples, num_workers * 16)
+  tasks = []
+  for start, chunk in chunks:
+    cache_entries = None
+    if token_cache is not None:
+      cache_entries = _cached_chunk_entries(chunk, token_cache)
+    tasks.append((start, chunk, max_seq_length, doc_stride, max_query_length,
+                  is_training, cache_entries))
+
+  unique_id = 1000000000
+  num_done, start_time = 0, time.time()
+  for i, (start, num_examples, features, new_entries) in enumerate(
+      pool.imap(_convert_chunk, tasks)):
+    for feature in features:
+      if feature.example_index is not None:
+        feature.example_index += start
+      feature.unique_id = unique_id
+      unique_id += 1
+      output_fn(feature)
+
+    if token_cache is not None:
+      for (kind, text), outputs in new_entries.items():
+        token_cache.put(kind, text, outputs)
+      token_cache.flush()
+
+    num_done += num_examples
+    if (i + 1) % num_workers != 0 and i + 1 != len(tasks):
+      continue
+    tf.logging.info("Converted {}/{} examples into {} features with {} "
+                    "workers, {:.1f} examples/sec".format(
+                        num_done, len(examples), unique_id - 1000000000,
+                        num_workers,
+                        num_done / max(time.time() - start_time, 1e-6)))
+  pool.close()
+  pool.join()
+
+
+def _convert_examples(examples, sp_model, is_training, output_fn):
+  """Convert `examples` with the preprocessing flags."""
+  if FLAGS.num_workers > 1:
+    convert_examples_to_features_parallel(
+        examples=examples,
+        max_seq_length=FLAGS.max_seq_length,
+        doc_stride=FLAGS.doc_stride,
+        max_query_length=FLAGS.max_query_length,
+        is_training=is_training,
+        output_fn=output_fn,
+        num_workers=FLAGS.num_workers,
+        token_cache=token_cache_from_flags(FLAGS))
+  else:
+    convert_examples_to_features(
+        examples=examples,
+        sp_model=sp_model,
+        max_seq_length=FLAGS.max_seq_length,
+        doc_stride=FLAGS.doc_stride,
+        max_query_length=FLAGS.max_query_length,
+        is_training=is_training,
+        output_fn=output_fn,
+        token_cache=token_cache_from_flags(FLAGS))
+
+
 class FeatureWriter(object):
   """Writes InputFeature to TF example file."""
 
@@ -709,24 +969,320 @@ class FeatureWriter(object):
       features["is_impossible"] = create_float_feature([impossible])
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-    self._writer.write(tf_example.SerializeToString())
+    record = tf_example.SerializeToString()
+    self._writer.write(record)
 
   def close(self):
     self._writer.close()
+    data_utils.write_record_index(self.filename, self.num_features)
+
+
+class EvalFeatureWriter(object):
+  """Writes eval InputFeatures into the columnar store of `EvalFeatureStore`.
+
+  The store is a directory of `.npy` files: one row per feature for the
+  fixed-size fields, the per-token fields of all features concatenated and
+  indexed by `tok_offsets`, and `token_is_max_context` as a packed bitmap
+  over the same tokens.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.num_features = 0
+    self._columns = collections.defaultdict(list)
+
+  def process_feature(self, feature):
+    """Append an InputFeature to the columns."""
+    self.num_features += 1
+    columns = self._columns
+    for name in _EVAL_SCALAR_COLUMNS:
+      columns[name].append(getattr(feature, name))
+    for name in _EVAL_SEQ_COLUMNS:
+      columns[name].append(np.array(getattr(feature, name), dtype=np.int32))
+    for name in _EVAL_TOKEN_COLUMNS:
+      columns[name].append(np.array(getattr(feature, name), dtype=np.int32))
+    max_context = np.zeros(len(feature.tok_start_to_orig_index),
+                           dtype=np.bool_)
+    for index, is_max_context in six.iteritems(feature.token_is_max_context):
+      max_context[index] = is_max_context
+    columns["token_is_max_context"].append(max_context)
+
+  def stack_columns(self):
+    """Returns the features added so far as a dict of arrays."""
+    columns = self._columns
+    tok_lens = [len(x) for x in columns["tok_start_to_orig_index"]]
+    arrays = {
+        "tok_offsets": np.cumsum([0] + tok_lens, dtype=np.int64),
+        "token_is_max_context": np.packbits(
+            np.concatenate(columns["token_is_max_context"] or [[]])
+            .astype(np.bool_)),
+    }
+    for name in _EVAL_SCALAR_COLUMNS:
+      arrays[name] = np.array(columns[name], dtype=np.int64)
+    for name in _EVAL_SEQ_COLUMNS:
+      arrays[name] = np.stack(columns[name]) if columns[name] else (
+          np.zeros([0, 0], dtype=np.int32))
+    for name in _EVAL_TOKEN_COLUMNS:
+      arrays[name] = np.concatenate(columns[name] or [[]]).astype(np.int32)
+    return arrays
+
+  def close(self):
+    arrays = self.stack_columns()
+    if not tf.gfile.Exists(self.path):
+      tf.gfile.MakeDirs(self.path)
+    for name, array in arrays.items():
+      with tf.gfile.Open(os.path.join(self.path, name + ".npy"), "wb") as fout:
+        np.save(fout, array)
+    # written last, marks the store as complete
+    with tf.gfile.Open(os.path.join(self.path, "meta.json"), "w") as fout:
+      json.dump({"num_features": self.num_features}, fout)
+    self._columns = None
+
+
+_EVAL_SCALAR_COLUMNS = ["unique_id", "example_index", "doc_span_index",
+                        "paragraph_len", "cls_index"]
+_EVAL_SEQ_COLUMNS = ["input_ids", "input_mask", "p_mask", "segment_ids"]
+_EVAL_TOKEN_COLUMNS = ["tok_start_to_orig_index", "tok_end_to_orig_index"]
+
+
+class _MaxContextBits(object):
+  """`token_is_max_context` of one feature, read from the packed bitmap."""
+
+  def __init__(self, bits, offset, length):
+    self._bits = bits
+    self._offset = offset
+    self._length = length
+
+  def get(self, index, default=None):
+    if index < 0 or index >= self._length:
+      return default
+    pos = self._offset + index
+    return bool((self._bits[pos >> 3] >> (7 - (pos & 7))) & 1)
+
+
+class EvalFeature(object):
+  """A read-only view of one feature of an `EvalFeatureStore`, with the
+  attributes of InputFeatures used for prediction."""
+
+  def __init__(self, store, index):
+    self._store = store
+    self._index = index
+
+  def __getattr__(self, name):
+    store, index = self._store, self._index
+    if name in _EVAL_SCALAR_COLUMNS:
+      return int(store.columns[name][index])
+    if name in _EVAL_SEQ_COLUMNS:
+      return store.columns[name][index]
+    start, end = store.columns["tok_offsets"][index:index + 2]
+    if name in _EVAL_TOKEN_COLUMNS:
+      return store.columns[name][start:end]
+    if name == "token_is_max_context":
+      return _MaxContextBits(store.columns[name], int(start),
+                             int(end - start))
+    raise AttributeError(name)
+
+
+class EvalFeatureStore(object):
+  """Eval features written by `EvalFeatureWriter`.
+
+  Local stores are memory-mapped, so features are only read from disk when
+  accessed.
+  """
+
+  def __init__(self, path, columns=None):
+    self.path = path
+    if columns is None:
+      columns = {}
+      for name in (_EVAL_SCALAR_COLUMNS + _EVAL_SEQ_COLUMNS +
+                   _EVAL_TOKEN_COLUMNS +
+                   ["tok_offsets", "token_is_max_context"]):
+        columns[name] = self._load(os.path.join(path, name + ".npy"))
+    self.columns = columns
+    self.num_features = len(columns["unique_id"])
+
+    example_index = self.columns["example_index"]
+    self._order = np.argsort(example_index, kind="mergesort")
+    self._sorted_example_index = example_index[self._order]
+
+  @classmethod
+  def from_features(cls, features):
+    """An in-memory store of a list of InputFeatures."""
+    writer = EvalFeatureWriter(None)
+    for feature in features:
+      writer.process_feature(feature)
+    return cls(None, columns=writer.stack_columns())
+
+  @staticmethod
+  def exists(path):
+    return tf.gfile.Exists(os.path.join(path, "meta.json"))
+
+  @staticmethod
+  def _load(path):
+    if "://" in path:
+      # remote file systems can not be memory-mapped
+      with tf.gfile.Open(path, "rb") as fin:
+        return np.load(six.BytesIO(fin.read()))
+    return np.load(path, mmap_mode="r")
+
+  def __len__(self):
+    return self.num_features
+
+  def __getitem__(self, index):
+    if index < 0 or index >= self.num_features:
+      raise IndexError(index)
+    return EvalFeature(self, index)
+
+  def __iter__(self):
+    for index in range(self.num_features):
+      yield EvalFeature(self, index)
+
+  def example_features(self, example_index):
+    """The features of `example_index` in the order they were written."""
+    start, end = np.searchsorted(self._sorted_example_index,
+                                 [example_index, example_index + 1])
+    return [EvalFeature(self, int(index))
+            for index in self._order[start:end]]
+
+  def group_by_example(self, num_examples):
+    """Returns `rows, offsets` such that the features of the i-th example
+    are `rows[offsets[i]:offsets[i + 1]]`, in the order they were written."""
+    offsets = np.searchsorted(self._sorted_example_index,
+                              np.arange(num_examples + 1))
+    return self._order[:offsets[-1]], offsets
+
+  def is_max_context(self, rows, token_index):
+    """Vectorized `token_is_max_context.get(token_index, False)` of the
+    features `rows`, broadcasting `rows` against `token_index`."""
+    paragraph_len = self.columns["paragraph_len"][rows]
+    in_range = (token_index >= 0) & (token_index < paragraph_len)
+    pos = self.columns["tok_offsets"][rows] + np.where(in_range, token_index, 0)
+    bits = self.columns["token_is_max_context"]
+    if len(bits) == 0:
+      return np.zeros(np.shape(pos), dtype=np.bool_)
+    pos = np.minimum(pos, len(bits) * 8 - 1)
+    flags = (bits[pos >> 3] >> (7 - (pos & 7))) & 1
+    return in_range & (flags == 1)
 
 
 RawResult = collections.namedtuple("RawResult",
     ["unique_id", "start_top_log_probs", "start_top_index",
     "end_top_log_probs", "end_top_index", "cls_logits"])
 
-_PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-    "PrelimPrediction",
-    ["feature_index", "start_index", "end_index",
-    "start_log_prob", "end_log_prob"])
-
 _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
     "NbestPrediction", ["text", "start_log_prob", "end_log_prob"])
 
+def _decode_nbest(examples, features, rows, offsets, results, n_best_size,
+                  max_answer_length):
+  """Decode the n-best non-null answers of `examples` at once.
+
+  Args:
+    examples: list of SquadExample.
+    features: EvalFeatureStore.
+    rows: int array, the features of the i-th example are the store rows
+      `rows[offsets[i]:offsets[i + 1]]`.
+    offsets: int array of length len(examples) + 1.
+    results: list of RawResult, aligned with `rows`.
+    n_best_size: int, maximum number of answers per example.
+    max_answer_length: int, maximum number of tokens of an answer.
+
+  Returns:
+    list of `(nbest, score_null)` per example, with `nbest` the list of
+    _NbestPrediction sorted by score, empty if no span is valid.
+  """
+  start_n_top, end_n_top = FLAGS.start_n_top, FLAGS.end_n_top
+  num_cands = start_n_top * end_n_top
+  shape = [len(rows), start_n_top, end_n_top]
+
+  start_log_prob = np.array(
+      [result.start_top_log_probs[:start_n_top] for result in results],
+      dtype=np.float64).reshape(shape[:2] + [1])
+  start_index = np.array(
+      [result.start_top_index[:start_n_top] for result in results],
+      dtype=np.int64).reshape(shape[:2] + [1])
+  end_log_prob = np.array(
+      [result.end_top_log_probs[:num_cands] for result in results],
+      dtype=np.float64).reshape(shape)
+  end_index = np.array(
+      [result.end_top_index[:num_cands] for result in results],
+      dtype=np.int64).reshape(shape)
+
+  # We could hypothetically create invalid predictions, e.g., predict
+  # that the start of the span is in the question. We throw out all
+  # invalid predictions.
+  paragraph_len = features.columns["paragraph_len"][rows][:, None, None]
+  valid = ((start_index < paragraph_len - 1) &
+           (end_index < paragraph_len - 1) &
+           features.is_max_context(rows[:, None, None], start_index) &
+           (end_index >= start_index) &
+           (end_index - start_index + 1 <= max_answer_length))
+
+  # Candidates are numbered (feature, start, end) in row-major order, so
+  # ties in score keep the order of the former per-candidate loops.
+  start_log_prob = np.broadcast_to(start_log_prob, shape).ravel()
+  start_index = np.broadcast_to(start_index, shape).ravel()
+  end_log_prob = end_log_prob.ravel()
+  end_index = end_index.ravel()
+  score = start_log_prob + end_log_prob
+  cands = np.flatnonzero(valid.ravel())
+  bounds = np.searchsorted(cands, np.asarray(offsets) * num_cands)
+
+  tok_offsets = features.columns["tok_offsets"]
+  tok_start_to_orig_index = features.columns["tok_start_to_orig_index"]
+  tok_end_to_orig_index = features.columns["tok_end_to_orig_index"]
+
+  outputs = []
+  for (i, example) in enumerate(examples):
+    # keep track of the minimum score of null start+end of position 0
+    score_null = 1000000  # large and positive
+    for result in results[offsets[i]:offsets[i + 1]]:
+      # if we could have irrelevant answers, get the min score of irrelevant
+      score_null = min(score_null, result.cls_logits)
+
+    example_cands = cands[bounds[i]:bounds[i + 1]]
+    top_cands = example_cands
+    if len(top_cands) > n_best_size:
+      # keep the candidates tied with or above the n_best_size-th score, and
+      # only fall back to all of them if duplicates leave the n-best short
+      kth = len(top_cands) - n_best_size
+      kth_score = np.partition(score[top_cands], kth)[kth]
+      top_cands = top_cands[score[top_cands] >= kth_score]
+
+    while True:
+      sorted_cands = top_cands[np.lexsort((top_cands, -score[top_cands]))]
+      seen_predictions = {}
+      nbest = []
+      for cand in sorted_cands.tolist():
+        if len(nbest) >= n_best_size:
+          break
+        tok_offset = tok_offsets[rows[cand // num_cands]]
+        start_orig_pos = tok_start_to_orig_index[
+            tok_offset + start_index[cand]]
+        end_orig_pos = tok_end_to_orig_index[tok_offset + end_index[cand]]
+
+        paragraph_text = example.paragraph_text
+        final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
+
+        if final_text in seen_predictions:
+          continue
+
+        seen_predictions[final_text] = True
+
+        nbest.append(
+            _NbestPrediction(
+                text=final_text,
+                start_log_prob=float(start_log_prob[cand]),
+                end_log_prob=float(end_log_prob[cand])))
+
+      if len(nbest) >= n_best_size or len(top_cands) == len(example_cands):
+        break
+      top_cands = example_cands
+
+    outputs.append((nbest, score_null))
+
+  return outputs
+
+
 def write_predictions(all_examples, all_features, all_results, n_best_size,
                       max_answer_length, output_prediction_file,
                       output_nbest_file,
@@ -735,140 +1291,77 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
   tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
   # tf.logging.info("Writing nbest to: %s" % (output_nbest_file))
 
-  example_index_to_features = collections.defaultdict(list)
-  for feature in all_features:
-    example_index_to_features[feature.example_index].append(feature)
+  if not isinstance(all_features, EvalFeatureStore):
+    all_features = EvalFeatureStore.from_features(all_features)
+  rows, offsets = all_features.group_by_example(len(all_examples))
 
   unique_id_to_result = {}
   for result in all_results:
     unique_id_to_result[result.unique_id] = result
+  results = [unique_id_to_result[unique_id] for unique_id in
+             all_features.columns["unique_id"][rows].tolist()]
 
   all_predictions = collections.OrderedDict()
   all_nbest_json = collections.OrderedDict()
   scores_diff_json = collections.OrderedDict()
 
-  for (example_index, example) in enumerate(all_examples):
-    features = example_index_to_features[example_index]
-
-    prelim_predictions = []
-    # keep track of the minimum score of null start+end of position 0
-    score_null = 1000000  # large and positive
-
-    for (feature_index, feature) in enumerate(features):
-      result = unique_id_to_result[feature.unique_id]
-
-      cur_null_score = result.cls_logits
-
-      # if we could have irrelevant answers, get the min score of irrelevant
-      score_null = min(score_null, cur_null_score)
-
-      for i in range(FLAGS.start_n_top):
-        for j in range(FLAGS.end_n_top):
-          start_log_prob = result.start_top_log_probs[i]
-          start_index = result.start_top_index[i]
-
-          j_index = i * FLAGS.end_n_top + j
-
-          end_log_prob = result.end_top_log_probs[j_index]
-          end_index = result.end_top_index[j_index]
-
-          # We could hypothetically create invalid predictions, e.g., predict
-          # that the start of the span is in the question. We throw out all
-          # invalid predictions.
-          if start_index >= feature.paragraph_len - 1:
-            continue
-          if end_index >= feature.paragraph_len - 1:
-            continue
-
-          if not feature.token_is_max_context.get(start_index, False):
-            continue
-          if end_index < start_index:
-            continue
-          length = end_index - start_index + 1
-          if length > max_answer_length:
-            continue
-
-          prelim_predictions.append(
-              _PrelimPrediction(
-                  feature_index=feature_index,
-                  start_index=start_index,
-                  end_index=end_index,
-                  start_log_prob=start_log_prob,
-                  end_log_prob=end_log_prob))
-
-    prelim_predictions = sorted(
-        prelim_predictions,
-        key=lambda x: (x.start_log_prob + x.end_log_prob),
-        reverse=True)
-
-    seen_predictions = {}
-    nbest = []
-    for pred in prelim_predictions:
-      if len(nbest) >= n_best_size:
-        break
-      feature = features[pred.feature_index]
-
-      tok_start_to_orig_index = feature.tok_start_to_orig_index
-      tok_end_to_orig_index = feature.tok_end_to_orig_index
-      start_orig_pos = tok_start_to_orig_index[pred.start_index]
-      end_orig_pos = tok_end_to_orig_index[pred.end_index]
-
-      paragraph_text = example.paragraph_text
-      final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
-
-      if final_text in seen_predictions:
-        continue
-
-      seen_predictions[final_text] = True
-
-      nbest.append(
-          _NbestPrediction(
-              text=final_text,
-              start_log_prob=pred.start_log_prob,
-              end_log_prob=pred.end_log_prob))
-
-    # In very rare edge cases we could have no valid predictions. So we
-    # just create a nonce prediction in this case to avoid failure.
-    if not nbest:
-      nbest.append(
-          _NbestPrediction(text="", start_log_prob=-1e6,
-          end_log_prob=-1e6))
-
-    total_scores = []
-    best_non_null_entry = None
-    for entry in nbest:
-      total_scores.append(entry.start_log_prob + entry.end_log_prob)
-      if not best_non_null_entry:
-        best_non_null_entry = entry
-
-    probs = _compute_softmax(total_scores)
-
-    nbest_json = []
-    for (i, entry) in enumerate(nbest):
-      output = collections.OrderedDict()
-      output["text"] = entry.text
-      output["probability"] = probs[i]
-      output["start_log_prob"] = entry.start_log_prob
-      output["end_log_prob"] = entry.end_log_prob
-      nbest_json.append(output)
-
-    assert len(nbest_json) >= 1
-    assert best_non_null_entry is not None
+  decoded = _decode_nbest(all_examples, all_features, rows, offsets, results,
+                          n_best_size, max_answer_length)
+  for (example, (nbest, score_null)) in zip(all_examples, decoded):
+    nbest_json = _nbest_to_json(nbest)
 
     score_diff = score_null
     scores_diff_json[example.qas_id] = score_diff
     # note(zhiliny): always predict best_non_null_entry
     # and the evaluation script will search for the best threshold
-    all_predictions[example.qas_id] = best_non_null_entry.text
+    all_predictions[example.qas_id] = nbest_json[0]["text"]
 
     all_nbest_json[example.qas_id] = nbest_json
 
-  with tf.gfile.GFile(output_prediction_file, "w") as writer:
-    writer.write(json.dumps(all_predictions, indent=4) + "\n")
-
   with tf.gfile.GFile(output_nbest_file, "w") as writer:
     writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
 
+  return _evaluate_predictions(all_predictions, scores_diff_json,
+                               output_prediction_file,
+                               output_null_log_odds_file, orig_data)
+
+
+def _nbest_to_json(nbest):
+  """The n-best list of an example as written to the n-best file, the best
+  non-null entry first."""
+  # In very rare edge cases we could have no valid predictions. So we
+  # just create a nonce prediction in this case to avoid failure.
+  if not nbest:
+    nbest.append(
+        _NbestPrediction(text="", start_log_prob=-1e6,
+        end_log_prob=-1e6))
+
+  total_scores = []
+  for entry in nbest:
+    total_scores.append(entry.start_log_prob + entry.end_log_prob)
+
+  probs = _compute_softmax(total_scores)
+
+  nbest_json = []
+  for (i, entry) in enumerate(nbest):
+    output = collections.OrderedDict()
+    output["text"] = entry.text
+    output["probability"] = probs[i]
+    output["start_log_prob"] = entry.start_log_prob
+    output["end_log_prob"] = entry.end_log_prob
+    nbest_json.append(output)
+
+  assert len(nbest_json) >= 1
+  return nbest_json
+
+
+def _evaluate_predictions(all_predictions, scores_diff_json,
+                          output_prediction_file, output_null_log_odds_file,
+                          orig_data):
+  """Write the predictions and null log-odds, and evaluate them."""
+  with tf.gfile.GFile(output_prediction_file, "w") as writer:
+    writer.write(json.dumps(all_predictions, indent=4) + "\n")
+
   with tf.gfile.GFile(output_null_log_odds_file, "w") as writer:
     writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
@@ -884,6 +1377,99 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
   return out_eval
 
 
+class PredictionStream(object):
+  """Decodes RawResults as they are predicted.
+
+  The results of an example are held until all of its features have
+  arrived. Finished examples are decoded in groups of `flush_every` and
+  their n-best lists are appended to a JSON Lines file, one
+  `{"id": ..., "nbest": [...]}` object per line. Only the examples in
+  flight and the best answer of each example are kept in memory.
+  """
+
+  def __init__(self, examples, features, n_best_size, max_answer_length,
+               output_nbest_file, flush_every=256):
+    self.examples = examples
+    self.features = features
+    self.n_best_size = n_best_size
+    self.max_answer_length = max_answer_length
+    self.flush_every = flush_every
+
+    self._rows, self._offsets = features.group_by_example(len(examples))
+    self._num_missing = np.diff(self._offsets)
+    self._example_of_pos = np.repeat(np.arange(len(examples)),
+                                     self._num_missing)
+    self._pos_of_unique_id = dict(zip(
+        features.columns["unique_id"][self._rows].tolist(),
+        range(len(self._rows))))
+
+    self._results = {}
+    # examples without any feature are finished from the start
+    self._finished = np.flatnonzero(self._num_missing == 0).tolist()
+    self._predictions = {}
+    self._scores_diff = {}
+    self._writer = tf.gfile.GFile(output_nbest_file, "w")
+
+  def add(self, result):
+    """Add the RawResult of one feature."""
+    pos = self._pos_of_unique_id.pop(result.unique_id)
+    example_index = self._example_of_pos[pos]
+    self._results[pos] = result
+    self._num_missing[example_index] -= 1
+    if self._num_missing[example_index] == 0:
+      self._finished.append(int(example_index))
+      if len(self._finished) >= self.flush_every:
+        self._flush()
+
+  def _flush(self):
+    example_indices = sorted(self._finished)
+    self._finished = []
+    if not example_indices:
+      return
+
+    offsets = self._offsets
+    positions = [np.arange(offsets[i], offsets[i + 1])
+                 for i in example_indices]
+    positions = np.concatenate(positions).astype(np.int64)
+    local_offsets = np.cumsum(
+        [0] + [offsets[i + 1] - offsets[i] for i in example_indices])
+    results = [self._results.pop(pos) for pos in positions.tolist()]
+    examples = [self.examples[i] for i in example_indices]
+
+    decoded = _decode_nbest(examples, self.features, self._rows[positions],
+                            local_offsets, results, self.n_best_size,
+                            self.max_answer_length)
+    for (example_index, example, (nbest, score_null)) in zip(
+        example_indices, examples, decoded):
+      nbest_json = _nbest_to_json(nbest)
+      self._predictions[example_index] = nbest_json[0]["text"]
+      self._scores_diff[example_index] = score_null
+      line = collections.OrderedDict()
+      line["id"] = example.qas_id
+      line["nbest"] = nbest_json
+      self._writer.write(json.dumps(line) + "\n")
+
+  def close(self):
+    """Decode the remaining examples.
+
+    Returns:
+      all_predictions, scores_diff_json: OrderedDicts from qas_id to the best
+        non-null answer and to the null score, in the order of the examples.
+    """
+    self._flush()
+    self._writer.close()
+    num_missing = int(self._num_missing.sum())
+    if num_missing:
+      raise ValueError("Missing results for {} features".format(num_missing))
+
+    all_predictions = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+    for (example_index, example) in enumerate(self.examples):
+      scores_diff_json[example.qas_id] = self._scores_diff[example_index]
+      all_predictions[example.qas_id] = self._predictions[example_index]
+    return all_predictions, scores_diff_json
+
+
 def _get_best_indexes(logits, n_best_size):
   """Get the n-best logits from a list."""
   index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
@@ -965,21 +1551,41 @@ def input_fn_builder(input_glob, seq_length, is_training, drop_remainder,
     else:
       batch_size = FLAGS.predict_batch_size
 
-    # Split tfrecords across hosts
+    # Split tfrecords across hosts, by records if the files have indices
+    file_slices = None
     if num_hosts > 1:
       host_id = params["context"].current_host
-      num_files = len(global_input_paths)
-      if num_files >= num_hosts:
-        num_files_per_host = (num_files + num_hosts - 1) // num_hosts
-        my_start_file_id = host_id * num_files_per_host
-        my_end_file_id = min((host_id + 1) * num_files_per_host, num_files)
-        input_paths = global_input_paths[my_start_file_id: my_end_file_id]
-      tf.logging.info("Host {} handles {} files".format(host_id,
-                                                        len(input_paths)))
+      file_slices = data_utils.shard_records(
+          global_input_paths, num_hosts, host_id)
+      if file_slices is None:
+        num_files = len(global_input_paths)
+        if num_files >= num_hosts:
+          num_files_per_host = (num_files + num_hosts - 1) // num_hosts
+          my_start_file_id = host_id * num_files_per_host
+          my_end_file_id = min((host_id + 1) * num_files_per_host, num_files)
+          input_paths = global_input_paths[my_start_file_id: my_end_file_id]
+        tf.logging.info("Host {} handles {} files".format(host_id,
+                                                          len(input_paths)))
     else:
       input_paths = global_input_paths
 
-    if len(input_paths) == 1:
+    if file_slices is not None:
+      d = data_utils.file_slices_dataset(file_slices)
+      if is_training:
+        d = d.shuffle(len(file_slices)).repeat()
+
+      cycle_length = min(num_threads, len(file_slices))
+
+      d = d.apply(
+          tf.contrib.data.parallel_interleave(
+              data_utils.read_file_slice,
+              sloppy=is_training,
+              cycle_length=cycle_length))
+
+      if is_training:
+        # sample level shuffle
+        d = d.shuffle(buffer_size=FLAGS.shuffle_buffer)
+    elif len(input_paths) == 1:
       d = tf.data.TFRecordDataset(input_paths[0])
       # For training, we want a lot of parallel reading and shuffling.
       # For eval, we want no shuffling and parallel reading doesn't matter.
@@ -1137,12 +1743,9 @@ def preprocess():
   train_writer = FeatureWriter(
       filename=train_rec_file,
       is_training=True)
-  convert_examples_to_features(
+  _convert_examples(
       examples=train_examples,
       sp_model=sp_model,
-      max_seq_length=FLAGS.max_seq_length,
-      doc_stride=FLAGS.doc_stride,
-      max_query_length=FLAGS.max_query_length,
       is_training=True,
       output_fn=train_writer.process_feature)
   train_writer.close()
@@ -1218,36 +1821,30 @@ def main(_):
         FLAGS.output_dir,
         "{}.slen-{}.qlen-{}.eval.tf_record".format(
             spm_basename, FLAGS.max_seq_length, FLAGS.max_query_length))
-    eval_feature_file = os.path.join(
+    eval_feature_dir = os.path.join(
         FLAGS.output_dir,
-        "{}.slen-{}.qlen-{}.eval.features.pkl".format(
+        "{}.slen-{}.qlen-{}.eval.features".format(
             spm_basename, FLAGS.max_seq_length, FLAGS.max_query_length))
 
-    if tf.gfile.Exists(eval_rec_file) and tf.gfile.Exists(
-        eval_feature_file) and not FLAGS.overwrite_data:
-      tf.logging.info("Loading eval features from {}".format(eval_feature_file))
-      with tf.gfile.Open(eval_feature_file, 'rb') as fin:
-        eval_features = pickle.load(fin)
-    else:
+    if not (tf.gfile.Exists(eval_rec_file) and
+            EvalFeatureStore.exists(eval_feature_dir)) or FLAGS.overwrite_data:
       eval_writer = FeatureWriter(filename=eval_rec_file, is_training=False)
-      eval_features = []
+      eval_feature_writer = EvalFeatureWriter(eval_feature_dir)
 
       def append_feature(feature):
-        eval_features.append(feature)
+        eval_feature_writer.process_feature(feature)
         eval_writer.process_feature(feature)
 
-      convert_examples_to_features(
+      _convert_examples(
           examples=eval_examples,
           sp_model=sp_model,
-          max_seq_length=FLAGS.max_seq_length,
-          doc_stride=FLAGS.doc_stride,
-          max_query_length=FLAGS.max_query_length,
           is_training=False,
           output_fn=append_feature)
       eval_writer.close()
+      eval_feature_writer.close()
 
-      with tf.gfile.Open(eval_feature_file, 'wb') as fout:
-        pickle.dump(eval_features, fout)
+    tf.logging.info("Loading eval features from {}".format(eval_feature_dir))
+    eval_features = EvalFeatureStore(eval_feature_dir)
 
     eval_input_fn = input_fn_builder(
         input_glob=eval_rec_file,
@@ -1256,13 +1853,22 @@ def main(_):
         drop_remainder=False,
         num_hosts=1)
 
-    cur_results = []
-    for result in estimator.predict(
+    output_prediction_file = os.path.join(
+        FLAGS.predict_dir, "predictions.json")
+    output_nbest_file = os.path.join(
+        FLAGS.predict_dir, "nbest_predictions.jsonl")
+    output_null_log_odds_file = os.path.join(
+        FLAGS.predict_dir, "null_odds.json")
+
+    prediction_stream = PredictionStream(
+        eval_examples, eval_features, FLAGS.n_best_size,
+        FLAGS.max_answer_length, output_nbest_file)
+    for num_results, result in enumerate(estimator.predict(
         input_fn=eval_input_fn,
-        yield_single_examples=True):
+        yield_single_examples=True)):
 
-      if len(cur_results) % 1000 == 0:
-        tf.logging.info("Processing example: %d" % (len(cur_results)))
+      if num_results % 1000 == 0:
+        tf.logging.info("Processing example: %d" % (num_results))
 
       unique_id = int(result["unique_ids"])
       start_top_log_probs = (
@@ -1274,7 +1880,7 @@ def main(_):
 
       cls_logits = float(result["cls_logits"].flat[0])
 
-      cur_results.append(
+      prediction_stream.add(
           RawResult(
               unique_id=unique_id,
               start_top_log_probs=start_top_log_probs,
@@ -1283,19 +1889,10 @@ def main(_):
               end_top_index=end_top_index,
               cls_logits=cls_logits))
 
-    output_prediction_file = os.path.join(
-        FLAGS.predict_dir, "predictions.json")
-    output_nbest_file = os.path.join(
-        FLAGS.predict_dir, "nbest_predictions.json")
-    output_null_log_odds_file = os.path.join(
-        FLAGS.predict_dir, "null_odds.json")
-
-    ret = write_predictions(eval_examples, eval_features, cur_results,
-                            FLAGS.n_best_size, FLAGS.max_answer_length,
-                            output_prediction_file,
-                            output_nbest_file,
-                            output_null_log_odds_file,
-                            orig_data)
+    all_predictions, scores_diff_json = prediction_stream.close()
+    ret = _evaluate_predictions(all_predictions, scores_diff_json,
+                                output_prediction_file,
+                                output_null_log_odds_file, orig_data)
 
     # Log current result
     tf.logging.info("=" * 80)
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import tensorflow as tf
+
+import data_utils
+import run_squad
+
+
+class FeatureWriterTest(tf.test.TestCase):
+
+  seq_length = 8
+
+  def setUp(self):
+    super(FeatureWriterTest, self).setUp()
+    # run_squad and data_utils are written against the TF 1.x API
+    self._tfs = run_squad.tf, data_utils.tf
+    run_squad.tf = data_utils.tf = tf.compat.v1
+
+  def tearDown(self):
+    run_squad.tf, data_utils.tf = self._tfs
+    super(FeatureWriterTest, self).tearDown()
+
+  def _feature(self, unique_id):
+    return run_squad.InputFeatures(
+        unique_id=unique_id,
+        example_index=unique_id,
+        doc_span_index=0,
+        tok_start_to_orig_index=[],
+        tok_end_to_orig_index=[],
+        token_is_max_context={},
+        input_ids=[unique_id] * self.seq_length,
+        input_mask=[0.] * self.seq_length,
+        p_mask=[0.] * self.seq_length,
+        segment_ids=[0] * self.seq_length,
+        paragraph_len=self.seq_length,
+        cls_index=self.seq_length - 1,
+        start_position=0,
+        end_position=0,
+        is_impossible=False)
+
+  def _read_unique_ids(self, path, skip, take):
+    unique_ids = []
+    for i, record in enumerate(tf.compat.v1.io.tf_record_iterator(path)):
+      if skip <= i < skip + take:
+        example = tf.train.Example.FromString(record)
+        unique_ids.append(
+            example.features.feature["unique_ids"].int64_list.value[0])
+    return unique_ids
+
+  def test_shard_written_records(self):
+    file_names = []
+    unique_id = 0
+    for i, num_features in enumerate([7, 12, 5]):
+      path = os.path.join(self.get_temp_dir(), "{}.tf_record".format(i))
+      writer = run_squad.FeatureWriter(path, is_training=True)
+      for _ in range(num_features):
+        writer.process_feature(self._feature(unique_id))
+        unique_id += 1
+      writer.close()
+      file_names.append(path)
+
+    num_hosts = 3
+    host_unique_ids = []
+    for host_id in range(num_hosts):
+      file_slices = data_utils.shard_records(file_names, num_hosts, host_id)
+      self.assertIsNotNone(file_slices)
+      host_unique_ids.append(sum(
+          [self._read_unique_ids(*file_slice) for file_slice in file_slices],
+          []))
+
+    self.assertEqual([len(ids) for ids in host_unique_ids], [8, 8, 8])
+    self.assertEqual(sum(host_unique_ids, []), list(range(unique_id)))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -18,7 +18,9 @@ python run_squad.py \
   --max_seq_length=512 \
   $@
 
-#### Potential multi-processing version
+#### Local multi-processing: add --num_workers=8 to the command above.
+
+#### Potential multi-host version (one record file per process)
 # NUM_PROC=8
 # for i in `seq 0 $((NUM_PROC - 1))`; do
 #   python run_squad.py \
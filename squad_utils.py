@@ -42,16 +42,17 @@ def make_qid_to_has_ans(dataset):
         qid_to_has_ans[qa['id']] = bool(qa['answers'])
   return qid_to_has_ans
 
+_ARTICLES_RE = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+_PUNC_TABLE = {ord(ch): None for ch in string.punctuation}
+
 def normalize_answer(s):
   """Lower text and remove punctuation, articles and extra whitespace."""
   def remove_articles(text):
-    regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-    return re.sub(regex, ' ', text)
+    return _ARTICLES_RE.sub(' ', text)
   def white_space_fix(text):
     return ' '.join(text.split())
   def remove_punc(text):
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in text if ch not in exclude)
+    return text.translate(_PUNC_TABLE)
   def lower(text):
     return text.lower()
   return white_space_fix(remove_articles(remove_punc(lower(s))))
@@ -78,25 +79,54 @@ def compute_f1(a_gold, a_pred):
   f1 = (2 * precision * recall) / (precision + recall)
   return f1
 
+class _AnswerCache(dict):
+  """Maps an answer to its normalized form, tokens and token counts,
+  computed once per distinct answer."""
+
+  def __missing__(self, s):
+    normalized = normalize_answer(s)
+    toks = normalized.split() if s else []
+    entry = (normalized, toks, collections.Counter(toks))
+    self[s] = entry
+    return entry
+
+def _f1_from_tokens(gold_toks, gold_counts, pred_toks, pred_counts):
+  """`compute_f1` on answers tokenized by `_AnswerCache`."""
+  if len(gold_toks) == 0 or len(pred_toks) == 0:
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    return int(gold_toks == pred_toks)
+  num_same = sum(min(count, gold_counts[tok])
+                 for tok, count in pred_counts.items() if tok in gold_counts)
+  if num_same == 0:
+    return 0
+  precision = 1.0 * num_same / len(pred_toks)
+  recall = 1.0 * num_same / len(gold_toks)
+  f1 = (2 * precision * recall) / (precision + recall)
+  return f1
+
 def get_raw_scores(dataset, preds):
   exact_scores = {}
   f1_scores = {}
+  answers = _AnswerCache()
   for article in dataset:
     for p in article['paragraphs']:
       for qa in p['qas']:
         qid = qa['id']
-        gold_answers = [a['text'] for a in qa['answers']
-                        if normalize_answer(a['text'])]
+        gold_answers = [answers[a['text']] for a in qa['answers']
+                        if answers[a['text']][0]]
         if not gold_answers:
           # For unanswerable questions, only correct answer is empty string
-          gold_answers = ['']
+          gold_answers = [answers['']]
         if qid not in preds:
           print('Missing prediction for %s' % qid)
           continue
-        a_pred = preds[qid]
+        pred_norm, pred_toks, pred_counts = answers[preds[qid]]
         # Take max over all gold answers
-        exact_scores[qid] = max(compute_exact(a, a_pred) for a in gold_answers)
-        f1_scores[qid] = max(compute_f1(a, a_pred) for a in gold_answers)
+        exact_scores[qid] = max(int(gold_norm == pred_norm)
+                                for gold_norm, _, _ in gold_answers)
+        f1_scores[qid] = max(
+            _f1_from_tokens(gold_toks, gold_counts, pred_toks, pred_counts)
+            for _, gold_toks, gold_counts in gold_answers)
   return exact_scores, f1_scores
 
 def apply_no_ans_threshold(scores, na_probs, qid_to_has_ans, na_prob_thresh):
@@ -199,68 +229,69 @@ def histogram_na_prob(na_probs, qid_list, image_dir, name):
   plt.savefig(os.path.join(image_dir, 'na_prob_hist_%s.png' % name))
   plt.clf()
 
-def find_best_thresh(preds, scores, na_probs, qid_to_has_ans):
-  num_no_ans = sum(1 for k in qid_to_has_ans if not qid_to_has_ans[k])
-  cur_score = num_no_ans
-  best_score = cur_score
-  best_thresh = 0.0
-  qid_list = sorted(na_probs, key=lambda k: na_probs[k])
-  for i, qid in enumerate(qid_list):
-    if qid not in scores: continue
-    if qid_to_has_ans[qid]:
-      diff = scores[qid]
-    else:
-      if preds[qid]:
-        diff = -1
-      else:
-        diff = 0
-    cur_score += diff
-    if cur_score > best_score:
-      best_score = cur_score
-      best_thresh = na_probs[qid]
-  return 100.0 * best_score / len(scores), best_thresh
-
-def find_best_thresh_v2(preds, scores, na_probs, qid_to_has_ans):
+def _sort_by_na_prob(na_probs):
+  """qids in increasing order of `na_probs`, ties in dict order."""
+  qid_list = list(na_probs)
+  probs = np.array([na_probs[k] for k in qid_list], dtype=np.float64)
+  return [qid_list[i] for i in np.argsort(probs, kind='mergesort')]
+
+def _sweep_thresh(preds, scores, na_probs, qid_to_has_ans, qid_list):
+  """Score change of abstaining on each qid of `qid_list` (sorted by
+  `na_probs`), and the best threshold along the cumulative sum."""
   num_no_ans = sum(1 for k in qid_to_has_ans if not qid_to_has_ans[k])
-  cur_score = num_no_ans
-  best_score = cur_score
-  best_thresh = 0.0
-  qid_list = sorted(na_probs, key=lambda k: na_probs[k])
+  has_ans = np.array([qid_to_has_ans.get(qid, False) for qid in qid_list],
+                     dtype=bool)
+  diff = np.zeros(len(qid_list) + 1, dtype=np.float64)
+  diff[0] = num_no_ans
   for i, qid in enumerate(qid_list):
     if qid not in scores: continue
-    if qid_to_has_ans[qid]:
-      diff = scores[qid]
-    else:
-      if preds[qid]:
-        diff = -1
-      else:
-        diff = 0
-    cur_score += diff
-    if cur_score > best_score:
-      best_score = cur_score
-      best_thresh = na_probs[qid]
-
-  has_ans_score, has_ans_cnt = 0, 0
-  for qid in qid_list:
-    if not qid_to_has_ans[qid]: continue
-    has_ans_cnt += 1
+    if has_ans[i]:
+      diff[i + 1] = scores[qid]
+    elif preds[qid]:
+      diff[i + 1] = -1
+  # np.cumsum adds sequentially, as the former loop did
+  cur_scores = np.cumsum(diff)
+  best = int(np.argmax(cur_scores))
+  if best == 0:
+    best_score, best_thresh = num_no_ans, 0.0
+  else:
+    best_score = float(cur_scores[best])
+    best_thresh = na_probs[qid_list[best - 1]]
+  return 100.0 * best_score / len(scores), best_thresh, has_ans, diff
 
-    if qid not in scores: continue
-    has_ans_score += scores[qid]
+def find_best_thresh(preds, scores, na_probs, qid_to_has_ans, qid_list=None):
+  if qid_list is None:
+    qid_list = _sort_by_na_prob(na_probs)
+  best_score, best_thresh, _, _ = _sweep_thresh(
+      preds, scores, na_probs, qid_to_has_ans, qid_list)
+  return best_score, best_thresh
+
+def find_best_thresh_v2(preds, scores, na_probs, qid_to_has_ans, qid_list=None):
+  if qid_list is None:
+    qid_list = _sort_by_na_prob(na_probs)
+  best_score, best_thresh, has_ans, diff = _sweep_thresh(
+      preds, scores, na_probs, qid_to_has_ans, qid_list)
+
+  # qids without a score have a zero diff
+  has_ans_cnt = int(has_ans.sum())
+  has_ans_score = np.cumsum(np.where(has_ans, diff[1:], 0.0))
+  has_ans_score = float(has_ans_score[-1]) if len(has_ans_score) else 0
 
-  return 100.0 * best_score / len(scores), best_thresh, 1.0 * has_ans_score / has_ans_cnt
+  return best_score, best_thresh, 1.0 * has_ans_score / has_ans_cnt
 
 def find_all_best_thresh(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans):
-  best_exact, exact_thresh = find_best_thresh(preds, exact_raw, na_probs, qid_to_has_ans)
-  best_f1, f1_thresh = find_best_thresh(preds, f1_raw, na_probs, qid_to_has_ans)
+  qid_list = _sort_by_na_prob(na_probs)
+  best_exact, exact_thresh = find_best_thresh(preds, exact_raw, na_probs, qid_to_has_ans, qid_list)
+  best_f1, f1_thresh = find_best_thresh(preds, f1_raw, na_probs, qid_to_has_ans, qid_list)
   main_eval['best_exact'] = best_exact
   main_eval['best_exact_thresh'] = exact_thresh
   main_eval['best_f1'] = best_f1
   main_eval['best_f1_thresh'] = f1_thresh
 
 def find_all_best_thresh_v2(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans):
-  best_exact, exact_thresh, has_ans_exact = find_best_thresh_v2(preds, exact_raw, na_probs, qid_to_has_ans)
-  best_f1, f1_thresh, has_ans_f1 = find_best_thresh_v2(preds, f1_raw, na_probs, qid_to_has_ans)
+  qid_list = _sort_by_na_prob(na_probs)
+  best_exact, exact_thresh, has_ans_exact = find_best_thresh_v2(preds, exact_raw, na_probs, qid_to_has_ans, qid_list)
+  best_f1, f1_thresh, has_ans_f1 = find_best_thresh_v2(preds, f1_raw, na_probs, qid_to_has_ans, qid_list)
   main_eval['best_exact'] = best_exact
   main_eval['best_exact_thresh'] = exact_thresh
   main_eval['best_f1'] = best_f1
@@ -79,6 +79,27 @@ flags.DEFINE_integer("mask_beta", default=1,
       help="How many tokens to mask within each group.")
 flags.DEFINE_integer("num_predict", default=None,
       help="Number of tokens to predict in partial prediction.")
+flags.DEFINE_enum("record_format", "int64", ["int64", "compact"],
+      help="Layout of the tfrecords, see `record_format` in corpus_info.json.")
+flags.DEFINE_integer("num_parallel_calls", default=None,
+      help="If set, parse batches of records with this many parallel calls "
+      "(-1 for autotune) instead of one record at a time.")
+flags.DEFINE_string("prefetch_to_device", default=None,
+      help="Device to prefetch input batches onto, e.g. /gpu:0. Only used "
+      "with `num_parallel_calls`.")
+flags.DEFINE_bool("compact_masks", default=False,
+      help="Feed the permutation ranks and target positions instead of the "
+      "dense `perm_mask` and `target_mapping`, which are then built inside "
+      "the model.")
+flags.DEFINE_enum("record_cache", "memory", ["memory", "none", "disk",
+                                             "bounded"],
+      help="How to cache the raw records: all in memory, not at all, in a "
+      "file per host under `record_cache_dir`, or in memory "
+      "up to `record_cache_mb`, streaming the files that do not fit.")
+flags.DEFINE_string("record_cache_dir", default=None,
+      help="Scratch dir for the `disk` record cache.")
+flags.DEFINE_integer("record_cache_mb", default=None,
+      help="Size limit in MB of the `bounded` record cache.")
 flags.DEFINE_integer('perm_size', default=None,
   help='perm size.')
 flags.DEFINE_bool("uncased", False,
@@ -198,7 +219,14 @@ def train(ps_device):
       uncased=FLAGS.uncased,
       num_passes=FLAGS.num_passes,
       use_bfloat16=FLAGS.use_bfloat16,
-      num_predict=FLAGS.num_predict)
+      num_predict=FLAGS.num_predict,
+      record_format=FLAGS.record_format,
+      num_parallel_calls=FLAGS.num_parallel_calls,
+      prefetch_to_device=FLAGS.prefetch_to_device,
+      compact_masks=FLAGS.compact_masks,
+      record_cache=FLAGS.record_cache,
+      record_cache_dir=FLAGS.record_cache_dir,
+      record_cache_mb=FLAGS.record_cache_mb)
 
   # for key, info in record_info_dict.items():
   tf.logging.info("num of batches {}".format(record_info_dict["num_batch"]))
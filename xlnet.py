@@ -156,7 +156,7 @@ class XLNetModel(object):
 
   def __init__(self, xlnet_config, run_config, input_ids, seg_ids, input_mask,
                mems=None, perm_mask=None, target_mapping=None, inp_q=None,
-               **kwargs):
+               perm_rank=None, target_index=None, mem_mask=None, **kwargs):
     """
     Args:
       xlnet_config: XLNetConfig,
@@ -168,6 +168,8 @@ class XLNetModel(object):
       mems: a list of float32 Tensors in shape [mem_len, bsz, d_model], memory
         from previous batches. The length of the list equals n_layer.
         If None, no memory is used.
+      mem_mask: float32 Tensor in shape [mem_len, bsz], the mask of `mems`.
+        0 for real tokens and 1 for padding. If None, no memory is masked.
       perm_mask: float32 Tensor in shape [len, len, bsz].
         If perm_mask[i, j, k] = 0, i attend to j in batch k;
         if perm_mask[i, j, k] = 1, i does not attend to j in batch k.
@@ -181,6 +183,10 @@ class XLNetModel(object):
         1 for tokens with losses and 0 for tokens without losses.
         Only used during pretraining for two-stream attention.
         Set to None during finetuning.
+      perm_rank: int32 Tensor in shape [len, bsz]. If not None, used instead
+        of `perm_mask`, see `modeling.transformer_xl`.
+      target_index: int32 Tensor in shape [num_predict, bsz]. If not None,
+        used instead of `target_mapping`, see `modeling.transformer_xl`.
     """
 
     initializer = _get_initializer(run_config)
@@ -217,7 +223,10 @@ class XLNetModel(object):
         mems=mems,
         perm_mask=perm_mask,
         target_mapping=target_mapping,
-        inp_q=inp_q)
+        inp_q=inp_q,
+        perm_rank=perm_rank,
+        target_index=target_index,
+        mem_mask=mem_mask)
     tfm_args.update(input_args)
 
     with tf.variable_scope("model", reuse=tf.AUTO_REUSE):
@@ -259,6 +268,43 @@ class XLNetModel(object):
 
     return summary
 
+  def get_pooled_out_at(self, positions, use_summ_proj=True):
+    """
+    Args:
+      positions: int32 Tensor in shape [bsz, num_pos], the positions to pool,
+        e.g. the CLS positions of the examples packed in each sequence.
+      use_summ_proj: bool, whether to use a linear projection during pooling.
+
+    Returns:
+      float32 Tensor in shape [bsz * num_pos, d_model], the representation
+      at each position, pooled as with summary_type "last".
+    """
+
+    xlnet_config = self.xlnet_config
+    run_config = self.run_config
+
+    bsz = tf.shape(positions)[0]
+    num_pos = tf.shape(positions)[1]
+    batch_index = tf.tile(tf.range(bsz)[:, None], [1, num_pos])
+    hidden = tf.gather_nd(self.output, tf.stack([positions, batch_index], -1))
+    hidden = tf.reshape(hidden, [1, -1, xlnet_config.d_model])
+
+    with tf.variable_scope("model", reuse=tf.AUTO_REUSE):
+      summary = modeling.summarize_sequence(
+          summary_type="last",
+          hidden=hidden,
+          d_model=xlnet_config.d_model,
+          n_head=xlnet_config.n_head,
+          d_head=xlnet_config.d_head,
+          dropout=run_config.dropout,
+          dropatt=run_config.dropatt,
+          is_training=run_config.is_training,
+          input_mask=None,
+          initializer=self.initializer,
+          use_proj=use_summ_proj)
+
+    return summary
+
   def get_sequence_output(self):
     """
     Returns: